@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""
+Album Gain
+Громкость на уровне альбома или плейлиста: громкость каждого трека измеряется
+один раз (параллельно, с кэшем), а общий для группы gain пишется в теги
+ReplayGain или применяется одним линейным проходом
+"""
+
+import math
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import art_cache
+import tagging
+from app_cache import get_cache_dir, load_json, locked_json
+from process_runner import OperationCancelled, run_command, short_error
+
+# Режимы громкости: track - loudnorm каждого трека (как раньше), album/playlist - общий gain группы
+LOUDNESS_MODES = ('track', 'album', 'playlist')
+
+# Как применять gain группы: tags - теги ReplayGain/R128 без перекодирования, apply - volume в ffmpeg
+GAIN_MODES = ('tags', 'apply')
+
+# Целевая громкость группы в режиме apply (как у loudnorm) и предел true peak (LUFS, dBTP)
+GROUP_TARGET_LOUDNESS = -16.0
+MAX_TRUE_PEAK = -1.5
+
+# Изменение gain меньше этого (dB) файл не перекодирует
+GAIN_EPSILON = 0.1
+
+# Сколько файлов анализировать одновременно (каждый анализ - отдельный ffmpeg)
+ANALYSIS_WORKERS = os.cpu_count() or 4
+
+# Таймаут анализа и применения gain для одного файла (секунды)
+ANALYSIS_TIMEOUT = 600
+ANALYSIS_STALL_TIMEOUT = 120
+
+# Сколько последних строк stderr анализа хранить для сообщения об ошибке
+ANALYSIS_STDERR_LINES = 50
+
+# Итоговая громкость ebur128 ("I: -16.1 LUFS")
+LOUDNESS_PATTERN = re.compile(r'\bI:\s+(-?[\d.]+|-inf)\s+LUFS')
+
+# True peak из сводки ebur128 ("Peak: -0.5 dBFS")
+PEAK_PATTERN = re.compile(r'\bPeak:\s+(-?[\d.]+|-inf)\s+dBFS')
+
+# Кодеки ffmpeg для применения gain: обложка (видеопоток в mp3/m4a) копируется как есть
+GAIN_CODECS = {
+    '.mp3': ['-map', '0:a', '-map', '0:v?', '-c:v', 'copy', '-c:a', 'libmp3lame', '-q:a', '0',
+             '-id3v2_version', '3'],
+    '.m4a': ['-map', '0:a', '-map', '0:v?', '-c:v', 'copy', '-c:a', 'aac', '-b:a', '192k',
+             '-disposition:v', 'attached_pic'],
+    '.opus': ['-map', '0:a', '-c:a', 'libopus', '-b:a', '160k'],
+    '.ogg': ['-map', '0:a', '-c:a', 'libvorbis', '-q:a', '6'],
+}
+
+
+def parse_db(value):
+    """Число из сводки ebur128 (-inf для тишины)"""
+    return float('-inf') if value == '-inf' else float(value)
+
+
+def analyze_file(path, cancel_token=None):
+    """
+    Измеряет интегральную громкость (EBU R128), true peak и длительность файла
+
+    Returns:
+        dict: loudness (LUFS), peak (dBTP), duration (секунды)
+
+    Raises:
+        OperationCancelled: анализ отменён
+        CommandTimeoutError: ffmpeg превысил таймаут или завис
+        subprocess.CalledProcessError: файл не декодируется
+        ValueError: в выводе ffmpeg нет сводки ebur128
+    """
+    position = [None]
+    summary = {'loudness': None, 'peak': None}
+
+    def on_line(line):
+        key, _, value = line.partition('=')
+        if key == 'out_time_us' and value.isdigit():
+            position[0] = int(value) / 1_000_000
+
+    def on_stderr_line(line):
+        # Сводка ebur128 идёт последней, поэтому последнее совпадение - итог по файлу
+        loudness = LOUDNESS_PATTERN.search(line)
+        if loudness:
+            summary['loudness'] = loudness.group(1)
+        peak = PEAK_PATTERN.search(line)
+        if peak:
+            summary['peak'] = peak.group(1)
+
+    # framelog=verbose опускает строки по кадрам ниже -loglevel info, а stderr
+    # разбирается построчно и хранится только хвост для сообщения об ошибке
+    run_command(
+        ['ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'level+info',
+         '-i', str(path), '-map', '0:a:0', '-af', 'ebur128=peak=true:framelog=verbose',
+         '-f', 'null', '-progress', 'pipe:1', '-nostats', '-'],
+        on_line=on_line, on_stderr_line=on_stderr_line, timeout=ANALYSIS_TIMEOUT,
+        stall_timeout=ANALYSIS_STALL_TIMEOUT, cancel_token=cancel_token, stderr_limit=ANALYSIS_STDERR_LINES
+    )
+    if summary['loudness'] is None:
+        raise ValueError(f"ffmpeg не вывел громкость для {Path(path).name}")
+    return {
+        'loudness': parse_db(summary['loudness']),
+        'peak': parse_db(summary['peak']) if summary['peak'] is not None else None,
+        'duration': position[0] or 0.0,
+    }
+
+
+def group_loudness(measurements):
+    """
+    Громкость группы треков
+
+    Энергетическое среднее громкостей с весом по длительности: приближение
+    интегральной громкости всех треков подряд без повторного декодирования.
+    Тишина (-inf) не учитывается.
+
+    Returns:
+        LUFS или None, если громких треков нет
+    """
+    audible = [m for m in measurements if m['loudness'] != float('-inf') and m['duration'] > 0]
+    total = sum(m['duration'] for m in audible)
+    if not total:
+        return None
+    energy = sum(m['duration'] * 10 ** (m['loudness'] / 10) for m in audible) / total
+    return 10 * math.log10(energy)
+
+
+def group_peak(measurements):
+    """Наибольший true peak группы (dBTP) или None"""
+    peaks = [m['peak'] for m in measurements if m['peak'] is not None and m['peak'] != float('-inf')]
+    return max(peaks) if peaks else None
+
+
+def current_measurement(entry):
+    """Громкость и пик файла в текущем виде (с учётом уже применённого gain)"""
+    applied = entry.get('applied_gain', 0.0)
+    return {
+        'loudness': entry['loudness'] + applied,
+        'peak': entry['peak'] + applied if entry['peak'] is not None else None,
+        'duration': entry['duration'],
+    }
+
+
+def group_gain(measurements):
+    """
+    Gain группы для режима apply: до GROUP_TARGET_LOUDNESS, но без превышения
+    MAX_TRUE_PEAK самым громким треком
+
+    Returns:
+        dB или None
+    """
+    loudness = group_loudness(measurements)
+    if loudness is None:
+        return None
+    gain = GROUP_TARGET_LOUDNESS - loudness
+    peak = group_peak(measurements)
+    if peak is not None:
+        gain = min(gain, MAX_TRUE_PEAK - peak)
+    return gain
+
+
+class LoudnessCache:
+    """
+    Кэш измерений громкости, общий для всех процессов
+
+    tracks.json: {абсолютный путь: {size, mtime_ns, loudness, peak, duration,
+    applied_gain, tagged_group_loudness}}. Измерения относятся к звуку до
+    применения gain (applied_gain - сколько уже применено), поэтому добавление трека в
+    плейлист требует анализа только нового трека. После записи тегов или
+    применения gain запись обновляется под новые размер и время изменения.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = Path(cache_dir) if cache_dir else get_cache_dir('loudness')
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.path = self.cache_dir / 'tracks.json'
+        self._entries = load_json(self.path, {})
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """Измерение или None, если файла нет в кэше или он изменился"""
+        entry = self._entries.get(str(path))
+        stat = Path(path).stat()
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry
+        return None
+
+    def put(self, path, measurement):
+        """Запоминает измерение с текущими размером и временем изменения файла"""
+        stat = Path(path).stat()
+        entry = {**measurement, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'updated_at': time.time()}
+        with self._lock:
+            self._entries[str(path)] = entry
+            self._pending[str(path)] = entry
+        return entry
+
+    def save(self):
+        """Записывает новые измерения под файловой блокировкой"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        with locked_json(self.path, {}) as entries:
+            for path in [path for path in entries if not Path(path).exists()]:
+                del entries[path]
+            entries.update(pending)
+
+
+def group_key(song, mode):
+    """
+    Группа трека: весь плейлист или альбом (первый артист + альбом)
+
+    Returns:
+        Строка ключа или None, если у трека нет альбома (gain только свой)
+    """
+    if mode == 'playlist':
+        return 'playlist'
+    return art_cache.album_key(song.get('Артист'), song.get('Альбом'))
+
+
+def detach_link(path):
+    """
+    Делает жёсткую ссылку (fingerprint.py --link) отдельным файлом
+
+    Теги пишутся на месте, а у ссылок они общие: без копии теги группы этого
+    плейлиста попали бы в файл другого.
+    """
+    if path.stat().st_nlink > 1:
+        temp_path = path.with_name(f".{path.name}.detach")
+        shutil.copy2(path, temp_path)
+        os.replace(temp_path, path)
+
+
+def apply_gain(path, gain, marker, cancel_token=None):
+    """
+    Меняет громкость файла на gain dB одним проходом ffmpeg (теги и обложка сохраняются)
+
+    Raises:
+        OperationCancelled: отмена
+        CommandTimeoutError: ffmpeg превысил таймаут или завис
+        subprocess.CalledProcessError: ошибка ffmpeg
+    """
+    path = Path(path)
+    temp_path = path.with_suffix('.tmp' + path.suffix)
+    cmd = [
+        'ffmpeg',
+        '-i', str(path),
+        '-af', f"volume={gain:.2f}dB",
+        *GAIN_CODECS.get(path.suffix, []),
+        '-metadata', f"comment={marker}",
+        '-y',
+        str(temp_path)
+    ]
+    try:
+        run_command(cmd, timeout=ANALYSIS_TIMEOUT, stall_timeout=ANALYSIS_STALL_TIMEOUT, cancel_token=cancel_token)
+        temp_path.replace(path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def applied_group_gain(group_entries):
+    """
+    Gain, уже применённый к файлам группы в режиме apply
+
+    Returns:
+        dB или None, если ни один файл группы ещё не перекодирован
+    """
+    applied = [entry['applied_gain'] for _, entry in group_entries if entry.get('applied_gain')]
+    return max(set(applied), key=applied.count) if applied else None
+
+
+def apply_group_gain(files, mode='album', gain_mode='tags', workers=ANALYSIS_WORKERS, log_callback=None,
+                     cancel_token=None):
+    """
+    Выравнивает громкость по альбомам или всему плейлисту
+
+    1. Громкость каждого файла измеряется параллельно (из кэша, если файл не менялся).
+    2. Для каждой группы считается общая громкость.
+    3. tags: в файлы пишутся ReplayGain (R128 для Opus) - трековый и групповой gain;
+       apply: файлы перекодируются с gain группы. Каждый файл перекодируется
+       не больше одного раза (без лишних поколений сжатия с потерями): новые
+       треки группы получают уже применённый к остальным gain, а если
+       группа изменилась, выровненные файлы остаются как есть.
+
+    Args:
+        files: список (строка CSV, label формата, Path файла) - см. download_music.track_files
+        mode: 'album' или 'playlist'
+        gain_mode: 'tags' или 'apply'
+        workers: сколько файлов обрабатывать одновременно
+        log_callback: функция для вывода логов (по умолчанию print)
+        cancel_token: CancelToken для прерывания
+
+    Returns:
+        dict: files, analyzed, cached, groups, updated
+
+    Raises:
+        OperationCancelled: отмена
+    """
+    log = log_callback or print
+    if gain_mode == 'tags' and not tagging.is_available():
+        log("   ⚠️  Для тегов ReplayGain нужен mutagen, gain группы будет применён перекодированием")
+        gain_mode = 'apply'
+
+    cache = LoudnessCache()
+    counts = {'analyzed': 0, 'cached': 0, 'updated': 0}
+    counts_lock = threading.Lock()
+    log(f"\n🎚️  Громкость по {'альбомам' if mode == 'album' else 'плейлисту'}: "
+        f"{len(files)} файлов ({workers} анализов параллельно)...")
+
+    def measure(item):
+        _, _, path = item
+        entry = cache.get(path)
+        with counts_lock:
+            counts['cached' if entry else 'analyzed'] += 1
+        if entry is None:
+            try:
+                entry = cache.put(path, {**analyze_file(path, cancel_token), 'applied_gain': 0.0})
+            except OperationCancelled:
+                raise
+            except Exception as e:
+                log(f"   ⚠️  Не удалось измерить {path.name}: {short_error(e)}")
+        return entry
+
+    started = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            measurements = list(pool.map(measure, files))
+
+        # Группы считаются отдельно для каждого формата (у кодеков разная громкость)
+        groups = {}
+        for (song, label, path), entry in zip(files, measurements):
+            if entry is not None:
+                key = group_key(song, mode) or f"track:{path}"
+                groups.setdefault((label, key), []).append((path, entry))
+
+        # Gain каждой группы для режима apply: уже применённый к её файлам или новый
+        group_gains = {}
+        if gain_mode == 'apply':
+            for (label, key), group_entries in groups.items():
+                gain = group_gain([entry for _, entry in group_entries])
+                applied = applied_group_gain(group_entries)
+                if applied is not None:
+                    if gain is not None and abs(gain - applied) >= GAIN_EPSILON:
+                        log(f"   ℹ️  Gain группы {key} ({label}) теперь {gain:+.1f} dB, выровненные файлы "
+                            f"остаются с {applied:+.1f} dB (повторное перекодирование добавило бы потери)")
+                    gain = applied
+                group_gains[(label, key)] = gain
+
+        def update(path, entry, group_entries, group_id):
+            if gain_mode == 'tags':
+                # Теги описывают файл как он есть: с учётом gain, применённого раньше
+                current = current_measurement(entry)
+                group = [current_measurement(group_entry) for _, group_entry in group_entries]
+                loudness = group_loudness(group)
+                if loudness is None or current['loudness'] == float('-inf'):
+                    return
+                if abs((entry.get('tagged_group_loudness') or 0.0) - loudness) < GAIN_EPSILON / 2:
+                    # Группа не изменилась: теги уже верные
+                    return
+                detach_link(path)
+                tagging.write_gain_tags(path, current['loudness'], current['peak'], loudness, group_peak(group))
+                entry = {**entry, 'tagged_group_loudness': loudness}
+            else:
+                # Уже перекодированный файл повторно не трогаем
+                gain = group_gains[group_id]
+                if gain is not None and entry['peak'] is not None:
+                    # Новый трек уже выровненной группы не должен клиппировать
+                    gain = min(gain, MAX_TRUE_PEAK - entry['peak'])
+                if gain is None or entry.get('applied_gain') or abs(gain) < GAIN_EPSILON:
+                    return
+                apply_gain(path, gain, f"{tagging.MARKER_PREFIX} {mode} gain {gain:+.1f} dB", cancel_token)
+                # Старые теги ReplayGain после перекодирования неверны
+                entry = {**entry, 'applied_gain': gain, 'tagged_group_loudness': None}
+            cache.put(path, {key: entry.get(key) for key in
+                             ('loudness', 'peak', 'duration', 'applied_gain', 'tagged_group_loudness')})
+            with counts_lock:
+                counts['updated'] += 1
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = [pool.submit(update, path, entry, group_entries, group_id)
+                       for group_id, group_entries in groups.items() for path, entry in group_entries]
+            for future in futures:
+                try:
+                    future.result()
+                except OperationCancelled:
+                    raise
+                except Exception as e:
+                    log(f"   ⚠️  Gain не записан: {short_error(e)}")
+    finally:
+        cache.save()
+
+    log(f"✅ Громкость выровнена за {time.monotonic() - started:.1f}s: групп {len(groups)}, "
+        f"измерено {counts['analyzed']}, из кэша {counts['cached']}, обновлено файлов {counts['updated']}")
+    return {'files': len(files), 'groups': len(groups), **counts}
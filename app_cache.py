@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+App Cache
+Общая папка кэша и состояния, файловые блокировки и атомарная запись JSON
+(состояние разделяется между одновременно запущенными процессами)
+"""
+
+import json
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировки только внутри процесса
+    fcntl = None
+
+_thread_lock = threading.Lock()
+
+
+def get_cache_dir(*parts):
+    """
+    Папка кэша (MUSIC_DOWNLOADER_CACHE или ~/.cache/music-downloader)
+
+    Args:
+        *parts: подпапки внутри кэша
+
+    Returns:
+        Path созданной папки
+    """
+    base = os.environ.get('MUSIC_DOWNLOADER_CACHE') or Path.home() / '.cache' / 'music-downloader'
+    path = Path(base).joinpath(*parts)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+@contextmanager
+def file_lock(lock_path):
+    """Эксклюзивная блокировка через flock (между процессами и потоками)"""
+    lock_path = Path(lock_path)
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    if fcntl is None:
+        with _thread_lock:
+            yield
+        return
+
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def load_json(path, default=None):
+    """Читает JSON, при отсутствии или повреждении файла возвращает default"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(path, data):
+    """Атомарно записывает JSON (через временный файл и rename)"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def locked_json(path, default):
+    """
+    Чтение-изменение-запись JSON под блокировкой
+
+    Example:
+        with locked_json(state_path, {'count': 0}) as state:
+            state['count'] += 1
+    """
+    path = Path(path)
+    with file_lock(path.with_name(path.name + '.lock')):
+        data = load_json(path, default)
+        yield data
+        save_json(path, data)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Art Cache
+Кэш обложек: одна загрузка и одно масштабирование на альбом или миниатюру,
+картинки хранятся по SHA-256 содержимого и встраиваются в треки из кэша
+"""
+
+import hashlib
+import re
+import threading
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+from app_cache import get_cache_dir, load_json, locked_json
+from process_runner import run_command
+
+# Сторона квадратной обложки после масштабирования (пиксели)
+ART_SIZE = 600
+
+# Таймаут загрузки миниатюры (секунды)
+ART_FETCH_TIMEOUT = 15
+
+# Миниатюры YouTube по id видео: maxresdefault есть не у всех видео, hqdefault - у всех
+THUMBNAIL_URLS = [
+    'https://i.ytimg.com/vi/{video_id}/maxresdefault.jpg',
+    'https://i.ytimg.com/vi/{video_id}/hqdefault.jpg',
+]
+
+# Число блокировок ключей: ключ берёт блокировку по хешу, поэтому их не больше этого
+# числа при любом размере библиотеки (разные альбомы изредка ждут друг друга)
+KEY_LOCK_STRIPES = 64
+
+# Центральный квадрат кадра 16:9 (у hqdefault 4:3 отрезает чёрные полосы), не больше ART_SIZE
+RESIZE_FILTER = (
+    r"crop=min(ih\,iw*9/16):min(ih\,iw*9/16),"
+    rf"scale=min(iw\,{ART_SIZE}):-2"
+)
+
+
+def album_key(artist, album):
+    """
+    Ключ альбома в индексе кэша
+
+    Берётся первый артист: у треков одного альбома с гостями список артистов разный.
+
+    Returns:
+        Строка ключа или None если альбом не указан
+    """
+    if not album or not album.strip():
+        return None
+    first_artist = re.split(r',\s*', artist or '')[0]
+    return f"album:{first_artist.strip().lower()}|{album.strip().lower()}"
+
+
+class ArtCache:
+    """
+    Кэш обложек, общий для всех треков и процессов
+
+    index.json сопоставляет ключи (альбом, id видео) с хешем картинки,
+    сами картинки лежат в <sha256>.jpg. Одинаковая миниатюра у разных
+    ключей хранится и масштабируется один раз.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = Path(cache_dir) if cache_dir else get_cache_dir('art')
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.cache_dir / 'index.json'
+        self._key_locks = [threading.Lock() for _ in range(KEY_LOCK_STRIPES)]
+
+    def _key_lock(self, key):
+        """Блокировка ключа: параллельные треки одного альбома качают обложку один раз"""
+        return self._key_locks[hash(key) % KEY_LOCK_STRIPES]
+
+    def _path(self, digest):
+        """Путь к картинке по хешу"""
+        return self.cache_dir / f"{digest}.jpg"
+
+    def lookup(self, keys):
+        """
+        Ищет обложку по первому известному ключу
+
+        Returns:
+            hex-дайджест картинки или None
+        """
+        index = load_json(self.index_path, {})
+        for key in keys:
+            digest = index.get(key)
+            if digest and self._path(digest).exists():
+                # Недостающие ключи (например, id видео другого трека альбома) запоминаем
+                if any(index.get(other) != digest for other in keys):
+                    self._remember(keys, digest)
+                return digest
+        return None
+
+    def _remember(self, keys, digest):
+        """Записывает ключи в индекс"""
+        with locked_json(self.index_path, {}) as index:
+            for key in keys:
+                index[key] = digest
+
+    def _fetch(self, video_id):
+        """Скачивает миниатюру видео (первую доступную из THUMBNAIL_URLS)"""
+        last_error = None
+        for template in THUMBNAIL_URLS:
+            url = template.format(video_id=video_id)
+            try:
+                with urllib.request.urlopen(url, timeout=ART_FETCH_TIMEOUT) as response:
+                    return response.read()
+            except (urllib.error.URLError, OSError) as e:
+                last_error = e
+        raise last_error
+
+    def _store(self, data, cancel_token=None):
+        """
+        Масштабирует картинку и кладёт в кэш под хешем исходных байтов
+
+        Returns:
+            hex-дайджест SHA-256
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        if path.exists():
+            return digest
+
+        source_path = self.cache_dir / f".{digest}.source"
+        tmp_path = self.cache_dir / f".{digest}.{threading.get_ident()}.tmp.jpg"
+        source_path.write_bytes(data)
+        try:
+            run_command([
+                'ffmpeg', '-i', str(source_path),
+                '-vf', RESIZE_FILTER,
+                '-q:v', '2',
+                '-y', str(tmp_path)
+            ], timeout=60, cancel_token=cancel_token)
+            tmp_path.replace(path)
+        finally:
+            source_path.unlink(missing_ok=True)
+            tmp_path.unlink(missing_ok=True)
+        return digest
+
+    def get_or_fetch(self, video_id, artist=None, album=None, cancel_token=None):
+        """
+        Обложка трека: из кэша по альбому или id видео, иначе скачивается
+
+        Для альбома используется миниатюра первого скачанного трека,
+        остальные треки альбома берут её из кэша без запросов.
+
+        Args:
+            video_id: id видео YouTube (может быть None, если известен альбом в кэше)
+            artist: артист из CSV
+            album: альбом из CSV (колонка «Альбом»)
+            cancel_token: CancelToken для прерывания масштабирования
+
+        Returns:
+            Path картинки или None если обложки нет
+        """
+        keys = [key for key in (album_key(artist, album), video_id and f"video:{video_id}") if key]
+        if not keys:
+            return None
+
+        with self._key_lock(keys[0]):
+            digest = self.lookup(keys)
+            if digest is None:
+                if not video_id:
+                    return None
+                digest = self._store(self._fetch(video_id), cancel_token=cancel_token)
+                self._remember(keys, digest)
+            return self._path(digest)
+
+
+_art_cache = None
+_art_cache_lock = threading.Lock()
+
+
+def get_art_cache():
+    """Общий кэш обложек в папке кэша приложения"""
+    global _art_cache
+    with _art_cache_lock:
+        if _art_cache is None:
+            _art_cache = ArtCache()
+        return _art_cache
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Artist Channels
+Выученные официальные каналы артистов: после выбора видео с официального
+канала следующие треки этого артиста ищутся сначала внутри канала
+"""
+
+import re
+import threading
+import time
+from pathlib import Path
+
+from app_cache import get_cache_dir, load_json, locked_json
+
+# Сколько промахов подряд (в канале нет трека) до того, как канал забывается
+MAX_CHANNEL_MISSES = 5
+
+
+def artist_key(artist):
+    """
+    Ключ артиста: первый артист из списка, в нижнем регистре
+
+    Returns:
+        Строка ключа или None
+    """
+    first_artist = re.split(r',\s*', artist or '')[0].strip().lower()
+    return first_artist or None
+
+
+class ArtistChannelCache:
+    """
+    Кэш артист -> id официального канала YouTube, общий для всех процессов
+
+    channels.json: {артист: {channel_id, channel, misses, updated_at}}.
+    Запись появляется после выбора видео уровня official_channel и
+    удаляется после MAX_CHANNEL_MISSES поисков подряд, не нашедших трек в канале.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = Path(cache_dir) if cache_dir else get_cache_dir('search')
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.path = self.cache_dir / 'channels.json'
+        self._memory = None
+        self._lock = threading.Lock()
+
+    def _channels(self):
+        """Карта каналов (читается с диска один раз на процесс, дальше - из памяти)"""
+        with self._lock:
+            if self._memory is None:
+                self._memory = load_json(self.path, {})
+            return self._memory
+
+    def lookup(self, artist):
+        """
+        Канал артиста
+
+        Returns:
+            dict (channel_id, channel) или None
+        """
+        key = artist_key(artist)
+        return self._channels().get(key) if key else None
+
+    def learn(self, artist, channel_id, channel=None):
+        """Запоминает канал по выбору official_channel (и сбрасывает счётчик промахов)"""
+        key = artist_key(artist)
+        if not key or not channel_id:
+            return
+        entry = self._channels().get(key)
+        if entry and entry['channel_id'] == channel_id and not entry.get('misses'):
+            # Уже известен: не переписываем файл на каждом треке
+            return
+        self._update(key, lambda entry: {
+            'channel_id': channel_id,
+            'channel': channel or (entry or {}).get('channel'),
+            'misses': 0,
+            'updated_at': time.time(),
+        })
+
+    def miss(self, artist):
+        """Трек не нашёлся в канале; после MAX_CHANNEL_MISSES подряд канал забывается"""
+        key = artist_key(artist)
+        if not key:
+            return
+
+        def update(entry):
+            if entry is None:
+                return None
+            misses = entry.get('misses', 0) + 1
+            return None if misses >= MAX_CHANNEL_MISSES else {**entry, 'misses': misses}
+
+        self._update(key, update)
+
+    def _update(self, key, update):
+        """Изменяет запись артиста под файловой блокировкой (None - удалить)"""
+        with locked_json(self.path, {}) as channels:
+            entry = update(channels.get(key))
+            if entry is None:
+                channels.pop(key, None)
+            else:
+                channels[key] = entry
+            snapshot = dict(channels)
+        with self._lock:
+            self._memory = snapshot
+
+
+_artist_channels = None
+_artist_channels_lock = threading.Lock()
+
+
+def get_artist_channels():
+    """Общий кэш каналов в папке кэша приложения"""
+    global _artist_channels
+    with _artist_channels_lock:
+        if _artist_channels is None:
+            _artist_channels = ArtistChannelCache()
+        return _artist_channels
@@ -9,9 +9,141 @@ import subprocess
 import os
 import re
 import json
+import signal
+import threading
+import time
+import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from collections import OrderedDict
+from contextlib import nullcontext
 from pathlib import Path
 import sys
 
+import album_gain
+import art_cache
+import artist_channels
+import profiling
+import negative_cache
+import ranking
+import retries
+import tagging
+import throttle
+from process_runner import CancelToken, CommandTimeoutError, OperationCancelled, run_command, short_error
+from run_metrics import RunMetrics, StageTracker
+
+# Множители единиц размера в выводе yt-dlp
+SIZE_UNITS = {
+    'B': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3,
+    'KB': 1000, 'MB': 1000 ** 2, 'GB': 1000 ** 3
+}
+
+# Попыток на трек в основном прогоне (потом трек уходит в очередь повторов)
+MAX_ATTEMPTS = 3
+
+# Пауза перед прогоном очереди повторов в конце (секунды)
+RETRY_QUEUE_DELAY = 30.0
+
+# Таймауты по этапам: общее время и время без вывода до признания зависшим (секунды)
+SEARCH_TIMEOUT = 90
+SEARCH_STALL_TIMEOUT = 60
+DOWNLOAD_TIMEOUT = 1200
+DOWNLOAD_STALL_TIMEOUT = 120
+NORMALIZE_TIMEOUT = 600
+NORMALIZE_STALL_TIMEOUT = 120
+
+# Форматы вывода: аргументы yt-dlp, расширения готовых файлов и откуда берутся теги и обложка.
+# mp3 перекодирует поток YouTube, остальные сохраняют Opus/AAC как есть (только перепаковка).
+# С mutagen теги из CSV и обложка из art_cache пишутся в процессе для всех форматов (tagging).
+# Без mutagen cover определяет запасной путь: 'cache' - теги и обложка одним проходом ffmpeg
+# после нормализации, 'ytdlp' - yt-dlp пишет теги YouTube и миниатюру сам
+OUTPUT_FORMATS = {
+    'mp3': {
+        'ytdlp': ['--audio-format', 'mp3', '--audio-quality', '0'],
+        'extensions': ('.mp3',),
+        'cover': 'cache',
+    },
+    'opus': {
+        'ytdlp': ['-f', 'bestaudio[acodec=opus]/bestaudio', '--audio-format', 'opus'],
+        'extensions': ('.opus',),
+        'cover': 'ytdlp',
+    },
+    'm4a': {
+        'ytdlp': ['-f', 'bestaudio[ext=m4a]/bestaudio', '--audio-format', 'm4a'],
+        'extensions': ('.m4a',),
+        'cover': 'cache',
+    },
+    # Лучший аудиопоток без перекодирования: обычно Opus (.opus), иногда AAC (.m4a)
+    'native': {
+        'ytdlp': ['-f', 'bestaudio', '--audio-format', 'best'],
+        'extensions': ('.opus', '.m4a', '.ogg'),
+        'cover': 'ytdlp',
+    },
+}
+DEFAULT_OUTPUT_FORMAT = 'mp3'
+
+# Кодировщики для вывода из одного декодирования (--format=mp3:320k,opus:128k):
+# исходный поток скачивается один раз, нормализуется один раз и через asplit
+# уходит во все кодировщики сразу. quality - настройки без явного битрейта
+ENCODERS = {
+    'mp3': {'extension': '.mp3', 'codec': ['-c:a', 'libmp3lame'], 'quality': ['-q:a', '0']},
+    'opus': {'extension': '.opus', 'codec': ['-c:a', 'libopus'], 'quality': ['-b:a', '160k']},
+    'm4a': {'extension': '.m4a', 'codec': ['-c:a', 'aac'], 'quality': ['-b:a', '192k']},
+}
+
+# Аргументы ffmpeg для встраивания обложки (без перекодирования аудио), если нет mutagen
+COVER_CODECS = {
+    '.mp3': ['-id3v2_version', '3', '-metadata:s:v', 'title=Album cover', '-metadata:s:v', 'comment=Cover (front)'],
+    '.m4a': [],
+}
+
+# Версия формата манифеста resolve
+MANIFEST_VERSION = 1
+
+# Сколько поисков одновременно в режиме resolve (все идут через общий лимит запросов)
+RESOLVE_WORKERS = 8
+
+# Сколько живёт запись кэша поиска в памяти (секунды) и сколько записей хранится
+SEARCH_CACHE_TTL = 6 * 3600
+SEARCH_CACHE_SIZE = 5000
+
+# Кэш поиска: (запрос, max_duration, max_results) -> (выбор resolve_video, время) в порядке
+# добавления (старые записи в начале); None - выключен
+_search_cache = None
+_search_cache_ttl = SEARCH_CACHE_TTL
+_search_cache_lock = threading.Lock()
+
+# Максимальная длительность видео, если длительность трека неизвестна (секунды)
+DEFAULT_MAX_DURATION = 420
+
+# Если в CSV есть длительность трека, видео длиннее трека больше чем на
+# DURATION_CAP_MARGIN секунд отбрасываются (вместо DEFAULT_MAX_DURATION);
+# близость к длительности учитывается в балле кандидата (ranking)
+DURATION_CAP_MARGIN = 90
+
+# Уровни выбора, после которых запасной запрос не нужен
+HEDGE_GOOD_TIERS = ('official_channel', 'official_audio')
+
+# Бюджет задержки основного поиска по умолчанию для --hedge (секунды)
+DEFAULT_HEDGE_DELAY = 4.0
+
+# id видео YouTube в выводе yt-dlp ("[youtube] <id>: Downloading webpage" или URL)
+VIDEO_ID_PATTERN = re.compile(r'(?:\[youtube\] |[?&]v=|youtu\.be/)([\w-]{11})(?![\w-])')
+
+# Параметры loudnorm и метка нормализации в теге comment (по ней проверка библиотеки
+# отличает нормализованные файлы от оставшихся после прерванного или неудачного прогона)
+LOUDNORM_FILTER = 'loudnorm=I=-16:TP=-1.5:LRA=11'
+MARKER_PREFIX = tagging.MARKER_PREFIX
+NORMALIZE_MARKER = f"{MARKER_PREFIX} {LOUDNORM_FILTER}"
+
+# Кодеки ffmpeg для нормализации по расширению файла (для .mp3 - настройки ffmpeg по умолчанию)
+NORMALIZE_CODECS = {
+    '.mp3': [],
+    '.opus': ['-map', '0:a', '-c:a', 'libopus', '-b:a', '160k'],
+    '.ogg': ['-map', '0:a', '-c:a', 'libvorbis', '-q:a', '6'],
+    # Обложка в m4a - отдельный видеопоток, копируем его без перекодирования
+    '.m4a': ['-c:a', 'aac', '-b:a', '192k', '-c:v', 'copy', '-disposition:v', 'attached_pic'],
+}
+
 def clean_filename(text, max_length=40):
     """Убирает скобки и лишние пробелы из названия, обрезает до max_length"""
     text = re.sub(r'\[.*?\]', '', text)
@@ -46,7 +178,390 @@ def extract_playlist_name(csv_path):
         pass
     return None
 
-def find_suitable_video(search_query, max_duration=420, max_results=5):
+def ytdlp_stage(line):
+    """Определяет этап работы yt-dlp по префиксу строки вывода"""
+    if line.startswith('[download]'):
+        return 'download'
+    if line.startswith(('[ExtractAudio]', '[Metadata]', '[EmbedThumbnail]', '[ThumbnailsConvertor]', '[Fixup')):
+        return 'transcode'
+    if line.startswith('['):
+        return 'extraction'
+    return None
+
+def parse_downloaded_bytes(line):
+    """Возвращает размер скачанного файла из строки '[download] 100% of 3.45MiB' или 0"""
+    match = re.match(r'\[download\]\s+100(?:\.0+)?% of\s+~?\s*([\d.]+)\s*([KMG]?i?B)', line)
+    if not match:
+        return 0
+    return int(float(match.group(1)) * SIZE_UNITS.get(match.group(2), 1))
+
+def parse_download_progress(line):
+    """
+    Разбирает строку прогресса yt-dlp '[download]  45.0% of 3.45MiB at 1.00MiB/s ETA 00:01'
+
+    Returns:
+        (percent, speed, eta) или None если строка не о прогрессе
+    """
+    match = re.match(
+        r'\[download\]\s+([\d.]+)% of\s+~?\s*\S+(?:\s+in\s+\S+)?(?:\s+at\s+(\S+))?(?:\s+ETA\s+(\S+))?',
+        line
+    )
+    if not match:
+        return None
+    speed = match.group(2)
+    eta = match.group(3)
+    return (
+        float(match.group(1)),
+        speed if speed and 'Unknown' not in speed else None,
+        eta if eta and 'Unknown' not in eta else None
+    )
+
+def parse_ffmpeg_time(value):
+    """Переводит '00:03:25.12' в секунды"""
+    hours, minutes, seconds = value.split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def format_timestamp(timestamp):
+    """Время в формате ГГГГ-ММ-ДД ЧЧ:ММ (локальное)"""
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp))
+
+def format_eta(seconds):
+    """Секунды в 'MM:SS'"""
+    seconds = max(0, int(seconds))
+    return f"{seconds // 60:02d}:{seconds % 60:02d}"
+
+def acquire_request_slot(cancel_token=None):
+    """Ждёт токен общего лимита запросов; при отмене бросает OperationCancelled"""
+    should_stop = (lambda: cancel_token.cancelled) if cancel_token else None
+    if not throttle.get_request_limiter().acquire(should_stop=should_stop):
+        raise OperationCancelled()
+
+def enable_search_cache(ttl=SEARCH_CACHE_TTL):
+    """Включает кэш результатов поиска в памяти процесса (режим демона)"""
+    global _search_cache, _search_cache_ttl
+    with _search_cache_lock:
+        if _search_cache is None:
+            _search_cache = OrderedDict()
+        _search_cache_ttl = ttl
+
+def find_suitable_video(search_query, max_duration=420, max_results=5, track_metrics=None, cancel_token=None,
+                        expected_duration=None):
+    """
+    Ищет подходящее видео на YouTube
+
+    Аргументы и исключения - как у resolve_video.
+
+    Returns:
+        URL подходящего видео или None
+    """
+    resolution = resolve_video(search_query, max_duration, max_results, track_metrics, cancel_token, expected_duration)
+    return resolution['url'] if resolution else None
+
+def resolve_video(search_query, max_duration=420, max_results=5, track_metrics=None, cancel_token=None,
+                  expected_duration=None):
+    """
+    Выбор видео с кандидатами и их уровнями, с кэшем в памяти если он включён
+
+    Выбор из кэша помечен source='cache'. В кэше не больше SEARCH_CACHE_SIZE
+    записей: при добавлении удаляются истёкшие и самые старые.
+
+    Аргументы и исключения - как у _resolve_video.
+    """
+    key = (search_query.lower(), max_duration, max_results, expected_duration)
+    if _search_cache is not None:
+        with _search_cache_lock:
+            cached = _search_cache.get(key)
+        if cached and time.monotonic() - cached[1] < _search_cache_ttl:
+            return {**cached[0], 'source': 'cache'}
+
+    resolution = _resolve_video(search_query, max_duration, max_results, track_metrics, cancel_token, expected_duration)
+
+    if resolution and _search_cache is not None:
+        now = time.monotonic()
+        with _search_cache_lock:
+            _search_cache.pop(key, None)
+            _search_cache[key] = (resolution, now)
+            while _search_cache and (len(_search_cache) > SEARCH_CACHE_SIZE or
+                                     now - next(iter(_search_cache.values()))[1] >= _search_cache_ttl):
+                _search_cache.popitem(last=False)
+    return resolution
+
+def hedge_query(artist, track_name):
+    """
+    Запасной вариант запроса: только первый артист или с "official audio"
+
+    Returns:
+        Строка запроса
+    """
+    first_artist = re.split(r',\s*', artist)[0].strip()
+    if first_artist and first_artist != artist.strip():
+        return f"{first_artist} {track_name}"
+    return f"{artist} {track_name} official audio"
+
+def is_good_resolution(resolution):
+    """True если выбор достаточно хорош, чтобы не ждать другой запрос"""
+    return bool(resolution) and resolution['tier'] in HEDGE_GOOD_TIERS
+
+def resolve_track_video(artist, track_name, max_duration=420, max_results=5, track_metrics=None, cancel_token=None,
+                        hedge_delay=None, expected_duration=None):
+    """
+    Выбор видео для трека
+
+    Если официальный канал артиста уже известен (artist_channels), трек сначала
+    ищется внутри канала - один узкий запрос. Иначе (или если в канале трека нет)
+    выполняется обычный поиск, при hedge_delay - с запасным запросом
+    (см. _resolve_hedged). Выбор с официального канала запоминается для
+    следующих треков артиста.
+
+    Args:
+        artist, track_name: из CSV
+        hedge_delay: бюджет задержки основного запроса (секунды); None - без хеджирования
+        expected_duration: длительность трека из CSV (секунды, опционально)
+        остальные - как у resolve_video
+
+    Returns:
+        dict выбора (как у resolve_video) или None
+    """
+    channels = artist_channels.get_artist_channels()
+    known_channel = channels.lookup(artist)
+    if known_channel:
+        search_stage = track_metrics.stage('search') if track_metrics else nullcontext()
+        with search_stage:
+            resolution = _resolve_in_channel(known_channel, artist, track_name, max_duration, max_results,
+                                             cancel_token, expected_duration)
+        if resolution:
+            channels.learn(artist, known_channel['channel_id'])
+            return resolution
+        channels.miss(artist)
+
+    primary_query = f"{artist} {track_name}"
+    if hedge_delay is None:
+        resolution = resolve_video(primary_query, max_duration, max_results, track_metrics, cancel_token,
+                                   expected_duration)
+    else:
+        resolution = _resolve_hedged(artist, track_name, max_duration, max_results, track_metrics, cancel_token,
+                                     hedge_delay, expected_duration)
+
+    if resolution and resolution['tier'] == 'official_channel' and resolution.get('channel_id'):
+        channels.learn(artist, resolution['channel_id'], resolution['uploader'])
+    return resolution
+
+def _resolve_hedged(artist, track_name, max_duration, max_results, track_metrics, cancel_token, hedge_delay,
+                    expected_duration=None):
+    """
+    Поиск с «хеджированием» медленного запроса
+
+    Если основной запрос за hedge_delay секунд не вернул видео хорошего уровня
+    (HEDGE_GOOD_TIERS), параллельно запускается запасной (hedge_query). Берётся
+    первый хороший ответ, второй поиск отменяется; если хороших нет - лучший
+    по баллу (при равенстве - основной).
+
+    Returns:
+        dict выбора (как у resolve_video) или None
+
+    Raises:
+        ThrottledError: основной запрос упёрся в троттлинг до запуска запасного
+            (запасной тогда не запускается)
+        Исключение основного запроса, если оба запроса завершились ошибкой
+    """
+    primary_query = f"{artist} {track_name}"
+    parent_token = cancel_token or CancelToken()
+    search_stage = track_metrics.stage('search') if track_metrics else nullcontext()
+    pool = ThreadPoolExecutor(max_workers=2)
+    tokens = {}
+
+    def start(query):
+        token = parent_token.child()
+        future = pool.submit(resolve_video, query, max_duration, max_results, None, token, expected_duration)
+        tokens[future] = token
+        return future
+
+    try:
+        with search_stage:
+            primary = start(primary_query)
+            # Ждём основной запрос в пределах бюджета
+            wait([primary], timeout=hedge_delay)
+            if primary.done() and primary.exception() is None and is_good_resolution(primary.result()):
+                return primary.result()
+            # При троттлинге второй запрос только усугубит ограничение
+            if primary.done() and isinstance(primary.exception(), throttle.ThrottledError):
+                raise primary.exception()
+
+            secondary_query = hedge_query(artist, track_name)
+            print(f"   🏁 Запасной запрос: {secondary_query}")
+            secondary = start(secondary_query)
+
+            pending = {primary, secondary}
+            while pending:
+                done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                parent_token.raise_if_cancelled()
+                for future in done:
+                    if future.exception() is None and is_good_resolution(future.result()):
+                        return future.result()
+
+            results = [future.result() for future in (primary, secondary)
+                       if future.exception() is None and future.result()]
+            if results:
+                return max(results, key=lambda resolution: resolution['score'])
+            if primary.exception() is not None:
+                raise primary.exception()
+            return None
+    finally:
+        # Проигравший поиск больше не нужен: его yt-dlp завершается сразу
+        for token in tokens.values():
+            token.cancel()
+        pool.shutdown(wait=False)
+
+def candidate_from_info(video_info, channel=None):
+    """Кандидат из JSON yt-dlp (полного или --flat-playlist)"""
+    video_id = video_info.get('id')
+    url = video_info.get('webpage_url') or video_info.get('url') or ''
+    if video_id and not url.startswith('http'):
+        url = f"https://www.youtube.com/watch?v={video_id}"
+    return {
+        'video_id': video_id,
+        'url': url,
+        'title': video_info.get('title') or 'Unknown',
+        'duration': video_info.get('duration') or 0,
+        'uploader': (video_info.get('uploader') or video_info.get('channel') or channel or '').lower(),
+        'channel_id': video_info.get('channel_id'),
+    }
+
+def parse_track_duration(text):
+    """
+    Длительность трека из столбца CSV "Длительность" ("3:45", "1:02:03" или секунды)
+
+    Returns:
+        Секунды или None, если значения нет или его не разобрать
+    """
+    parts = (text or '').strip().split(':')
+    if not all(part.isdigit() for part in parts):
+        return None
+    seconds = 0
+    for part in parts:
+        seconds = seconds * 60 + int(part)
+    return seconds or None
+
+def track_max_duration(expected_duration):
+    """Максимальная длительность видео для трека: длительность из CSV с запасом или DEFAULT_MAX_DURATION"""
+    if expected_duration:
+        return expected_duration + DURATION_CAP_MARGIN
+    return DEFAULT_MAX_DURATION
+
+def pick_candidate(ranked_videos):
+    """
+    Лучший кандидат после ranking.rank_candidates (с выводом причины выбора)
+
+    Returns:
+        dict выбранного кандидата
+    """
+    chosen = ranked_videos[0]
+    if chosen['tier'] == 'official_channel':
+        print(f"   ✓ Выбрано (официальный канал, балл {chosen['score']}): {chosen['title']} ({chosen['duration']}s)")
+        print(f"      Канал: {chosen['uploader']}")
+    else:
+        print(f"   ✓ Выбрано ({chosen['tier']}, балл {chosen['score']}): {chosen['title']} ({chosen['duration']}s)")
+    return chosen
+
+def title_matches(track_name, title):
+    """True если в названии видео есть все значимые слова названия трека"""
+    words = [word for word in re.findall(r'\w+', track_name.lower()) if len(word) > 1]
+    title_lower = title.lower()
+    return all(word in title_lower for word in words)
+
+def _resolve_in_channel(known_channel, artist, track_name, max_duration=420, max_results=5, cancel_token=None,
+                        expected_duration=None):
+    """
+    Ищет трек внутри известного официального канала артиста
+
+    Один запрос к поиску канала (--flat-playlist, без загрузки страниц видео).
+    Берутся только видео, в названии которых есть название трека.
+
+    Returns:
+        dict выбора (как у _resolve_video) или None, если трека в канале нет
+
+    Raises:
+        ThrottledError: если YouTube ограничил запросы
+        OperationCancelled: при отмене
+    """
+    channel_id = known_channel['channel_id']
+    cmd = [
+        'yt-dlp',
+        '--dump-json',
+        '--flat-playlist',
+        '--playlist-end', str(max_results),
+        '--quiet',
+        '--no-warnings',
+        f"https://www.youtube.com/channel/{channel_id}/search?query={urllib.parse.quote(track_name)}"
+    ]
+
+    try:
+        acquire_request_slot(cancel_token)
+        result = run_command(cmd, timeout=SEARCH_TIMEOUT, stall_timeout=SEARCH_STALL_TIMEOUT,
+                             cancel_token=cancel_token)
+    except subprocess.CalledProcessError as e:
+        if throttle.is_throttled(e.stderr):
+            raise throttle.ThrottledError(e.stderr.strip()) from e
+        # Поиск в канале - оптимизация: при ошибке просто ищем как обычно
+        return None
+    except CommandTimeoutError:
+        return None
+
+    candidates = []
+    for line in result.stdout.strip().split('\n'):
+        if line:
+            video = candidate_from_info(json.loads(line), known_channel.get('channel'))
+            video['channel_id'] = video['channel_id'] or channel_id
+            candidates.append(video)
+
+    same_track = []
+    for video in candidates:
+        if title_matches(track_name, video['title']):
+            same_track.append(video)
+        else:
+            video['tier'] = 'other_track'
+            video['score'] = 0
+
+    query = ranking.RankQuery(track_name, expected_duration, in_artist_channel=True)
+    ranked_videos = ranking.rank_candidates(query, same_track, max_duration)
+    if not ranked_videos:
+        return None
+
+    print(f"   📺 Поиск в канале артиста: {known_channel.get('channel') or channel_id}")
+    return {**pick_candidate(ranked_videos), 'candidates': candidates, 'source': 'channel'}
+
+def search_videos(search_query, max_results=5, track_metrics=None, cancel_token=None):
+    """
+    Топ-N результатов поиска YouTube с метаданными (через общий лимит запросов)
+
+    Returns:
+        Список JSON yt-dlp (dict) в порядке выдачи
+
+    Raises:
+        CommandTimeoutError, CalledProcessError, OperationCancelled: как у run_command
+    """
+    cmd = [
+        'yt-dlp',
+        '--dump-json',
+        '--skip-download',
+        '--quiet',
+        '--no-warnings',
+        f'ytsearch{max_results}:{search_query}'
+    ]
+
+    # Общий лимит запросов на все процессы хоста
+    acquire_request_slot(cancel_token)
+
+    search_stage = track_metrics.stage('search') if track_metrics else nullcontext()
+    with search_stage:
+        result = run_command(cmd, timeout=SEARCH_TIMEOUT, stall_timeout=SEARCH_STALL_TIMEOUT,
+                             cancel_token=cancel_token)
+
+    # yt-dlp возвращает по одному JSON на строку
+    return [json.loads(line) for line in result.stdout.strip().split('\n') if line]
+
+def _resolve_video(search_query, max_duration=420, max_results=5, track_metrics=None, cancel_token=None,
+                   expected_duration=None):
     """
     Ищет подходящее видео на YouTube с ограничением по длительности
 
@@ -54,127 +569,105 @@ def find_suitable_video(search_query, max_duration=420, max_results=5):
         search_query: поисковый запрос
         max_duration: максимальная длительность в секундах (по умолчанию 420 = 7 минут)
         max_results: сколько результатов проверить
+        track_metrics: TrackMetrics для замера этапа поиска (опционально)
+        cancel_token: CancelToken для прерывания поиска (опционально)
+        expected_duration: длительность трека из CSV (секунды) - близость к ней
+            входит в балл кандидата (опционально)
 
     Returns:
-        URL подходящего видео или None
+        dict выбора: url, video_id, title, duration, uploader, channel_id, tier, score,
+        source ('search' или 'channel') и candidates (все результаты поиска
+        с уровнем и баллом) или None
+
+    Raises:
+        ThrottledError: если YouTube ограничил запросы (чтобы трек не потерялся)
+        CommandTimeoutError, CalledProcessError: при временных ошибках (сеть, таймаут)
     """
     try:
-        # Получаем топ-N результатов поиска с метаданными
-        cmd = [
-            'yt-dlp',
-            '--dump-json',
-            '--skip-download',
-            '--quiet',
-            '--no-warnings',
-            f'ytsearch{max_results}:{search_query}'
-        ]
+        # Все кандидаты (для манифеста) ранжируются за один проход
+        candidates = [candidate_from_info(video_info)
+                      for video_info in search_videos(search_query, max_results, track_metrics, cancel_token)]
+        query = ranking.RankQuery(search_query, expected_duration)
+        ranked_videos = ranking.rank_candidates(query, candidates, max_duration)
 
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        for video in candidates:
+            if video['tier'] == 'too_long':
+                print(f"   ⏩ Пропускаем (слишком длинное {video['duration']}s): {video['title']}")
 
-        # Собираем подходящие видео
-        suitable_videos = []
-
-        # yt-dlp возвращает по одному JSON на строку
-        for line in result.stdout.strip().split('\n'):
-            if not line:
-                continue
-
-            video_info = json.loads(line)
-            duration = video_info.get('duration', 0)
-            title = video_info.get('title', 'Unknown')
-            url = video_info.get('webpage_url', '')
-            uploader = (video_info.get('uploader') or video_info.get('channel') or '').lower()
-
-            # Проверяем длительность
-            if duration and duration <= max_duration:
-                suitable_videos.append({
-                    'url': url,
-                    'title': title,
-                    'duration': duration,
-                    'uploader': uploader
-                })
-            else:
-                print(f"   ⏩ Пропускаем (слишком длинное {duration}s): {title}")
-
-        if not suitable_videos:
+        if not ranked_videos:
             print(f"   ⚠️  Не найдено видео короче {max_duration}s")
             return None
 
-        # Извлекаем имя артиста из запроса (первое слово/слова до названия песни)
-        # Простая эвристика: берём первую часть запроса
-        artist_keywords = search_query.lower().split()[:3]  # Первые 3 слова как ключевые
-
-        # Простая транслитерация для кириллицы
-        translit_map = {
-            'a': 'а', 'b': 'б', 'c': 'с', 'd': 'д', 'e': 'е', 'f': 'ф', 'g': 'г',
-            'h': 'х', 'i': 'и', 'j': 'й', 'k': 'к', 'l': 'л', 'm': 'м', 'n': 'н',
-            'o': 'о', 'p': 'п', 'r': 'р', 's': 'с', 't': 'т', 'u': 'у', 'v': 'в',
-            'w': 'в', 'x': 'кс', 'y': 'й', 'z': 'з'
-        }
-
-        def transliterate(text):
-            """Простая транслитерация латиницы в кириллицу"""
-            return ''.join(translit_map.get(c, c) for c in text.lower())
-
-        # Приоритизация:
-        # 1. Ищем видео с официального канала артиста (канал содержит имя артиста)
-        official_channel_videos = []
-        for video in suitable_videos:
-            uploader_lower = video['uploader']
-            # Проверяем совпадение с учётом транслитерации
-            matched = False
-            for keyword in artist_keywords:
-                if len(keyword) <= 3:
-                    continue
-                # Проверяем прямое совпадение или транслитерированное
-                if keyword in uploader_lower or transliterate(keyword) in uploader_lower:
-                    matched = True
-                    break
-
-            if matched:
-                # Дополнительно избегаем live версий
-                if 'live' not in video['title'].lower() or 'official' in video['title'].lower():
-                    official_channel_videos.append(video)
-
-        # Если нашли видео с официального канала, выбираем самое короткое (обычно студийная версия)
-        if official_channel_videos:
-            shortest = min(official_channel_videos, key=lambda v: v['duration'])
-            print(f"   ✓ Выбрано (официальный канал, самое короткое): {shortest['title']} ({shortest['duration']}s)")
-            print(f"      Канал: {shortest['uploader']}")
-            return shortest['url']
-
-        # 2. Ищем "official audio" или просто "audio" (приоритет выше чем video)
-        for priority_keyword in ['official audio', 'audio']:
-            for video in suitable_videos:
-                title_lower = video['title'].lower()
-                if priority_keyword in title_lower and 'live' not in title_lower:
-                    print(f"   ✓ Выбрано: {video['title']} ({video['duration']}s)")
-                    return video['url']
-
-        # 3. Ищем "official video" или "official" (но только если нет audio версии)
-        for priority_keyword in ['official video', 'official']:
-            for video in suitable_videos:
-                title_lower = video['title'].lower()
-                if priority_keyword in title_lower and 'live' not in title_lower:
-                    print(f"   ✓ Выбрано: {video['title']} ({video['duration']}s)")
-                    return video['url']
-
-        # 3. Если не нашли с приоритетными словами, берём первое подходящее
-        video = suitable_videos[0]
-        print(f"   ✓ Выбрано первое подходящее: {video['title']} ({video['duration']}s)")
-        return video['url']
+        return {**pick_candidate(ranked_videos), 'candidates': candidates, 'source': 'search'}
 
+    except subprocess.CalledProcessError as e:
+        if throttle.is_throttled(e.stderr):
+            raise throttle.ThrottledError(e.stderr.strip()) from e
+        # Временную ошибку сети пробрасываем, чтобы трек повторили, а не скачали вслепую
+        if retries.is_retryable(retries.classify_failure(e)):
+            raise
+        print(f"   ⚠️  Ошибка поиска: {e}")
+        return None
+    except (CommandTimeoutError, OperationCancelled, OSError):
+        # OSError - проблема окружения (нет yt-dlp, нет места), а не трека
+        raise
     except Exception as e:
         print(f"   ⚠️  Ошибка поиска: {e}")
         return None
 
-def normalize_audio(input_path, output_path):
+def run_ffmpeg(cmd, on_progress=None, cancel_token=None):
+    """
+    Запускает ffmpeg с -progress pipe:1 и передаёт прогресс в on_progress
+
+    Args:
+        cmd: команда ffmpeg (с '-progress', 'pipe:1', '-nostats')
+        on_progress: функция (percent, speed, eta), опционально
+        cancel_token: CancelToken для прерывания
+
+    Raises:
+        OperationCancelled: отмена через cancel_token
+        CommandTimeoutError: ffmpeg превысил таймаут или завис
+        subprocess.CalledProcessError: ошибка ffmpeg
+    """
+    # Длительность берём из заголовка ffmpeg в stderr, позицию - из -progress в stdout
+    duration = [None]
+    speed = [None]
+
+    def on_stderr_line(line):
+        match = re.search(r'Duration:\s+(\d+:\d+:[\d.]+)', line)
+        if match and duration[0] is None:
+            duration[0] = parse_ffmpeg_time(match.group(1))
+
+    def on_line(line):
+        key, _, value = line.partition('=')
+        if key == 'speed' and value.rstrip('x') not in ('', 'N/A'):
+            speed[0] = float(value.rstrip('x'))
+        elif key == 'out_time_us' and value.isdigit() and duration[0]:
+            position = int(value) / 1_000_000
+            percent = min(100.0, position / duration[0] * 100)
+            eta = None
+            if speed[0]:
+                eta = format_eta((duration[0] - position) / speed[0])
+            on_progress(percent, f"{speed[0]:.1f}x" if speed[0] else None, eta)
+
+    run_command(
+        cmd,
+        on_line=on_line if on_progress else None,
+        on_stderr_line=on_stderr_line if on_progress else None,
+        timeout=NORMALIZE_TIMEOUT,
+        stall_timeout=NORMALIZE_STALL_TIMEOUT,
+        cancel_token=cancel_token
+    )
+
+def normalize_audio(input_path, output_path, on_progress=None, cancel_token=None):
     """
     Нормализует громкость аудио файла с помощью FFmpeg loudnorm
 
     Args:
         input_path: путь к исходному файлу
         output_path: путь для сохранения нормализованного файла
+        on_progress: функция (percent, speed, eta) для прогресса из ffmpeg -progress
+        cancel_token: CancelToken для прерывания (отмена пробрасывается как OperationCancelled)
 
     Returns:
         True если успешно, False если ошибка
@@ -187,19 +680,694 @@ def normalize_audio(input_path, output_path):
         cmd = [
             'ffmpeg',
             '-i', str(input_path),
-            '-af', 'loudnorm=I=-16:TP=-1.5:LRA=11',
+            '-af', LOUDNORM_FILTER,
             '-ar', '48000',  # sample rate 48kHz
+            *NORMALIZE_CODECS.get(Path(output_path).suffix, []),  # кодек по расширению
+            '-metadata', f"comment={NORMALIZE_MARKER}",  # метка для проверки библиотеки
+            '-progress', 'pipe:1',  # машиночитаемый прогресс в stdout
+            '-nostats',
             '-y',  # overwrite без запроса
             str(output_path)
         ]
-
-        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        run_ffmpeg(cmd, on_progress=on_progress, cancel_token=cancel_token)
         return True
+    except OperationCancelled:
+        raise
     except Exception as e:
         print(f"   ⚠️  Ошибка нормализации: {e}")
         return False
 
-def download_from_csv(csv_path, output_dir, normalize=True, progress_callback=None, log_callback=None, stop_check=None):
+def encode_outputs(input_path, outputs, normalize=True, on_progress=None, cancel_token=None):
+    """
+    Кодирует исходный файл сразу в несколько форматов за одно декодирование
+
+    Граф фильтров: декодирование -> loudnorm (один раз, если normalize) -> asplit
+    на все кодировщики. Файлы пишутся во временные пути и переименовываются
+    только когда ffmpeg закончил все выходы.
+
+    Args:
+        input_path: исходный файл (поток YouTube без перекодирования)
+        outputs: список (путь выходного файла, spec из parse_output_formats)
+        normalize: применять ли нормализацию громкости
+        on_progress: функция (percent, speed, eta) для прогресса
+        cancel_token: CancelToken для прерывания
+
+    Raises:
+        OperationCancelled: отмена через cancel_token
+        CommandTimeoutError: ffmpeg превысил таймаут или завис
+        subprocess.CalledProcessError: ошибка ffmpeg
+    """
+    chain = [LOUDNORM_FILTER, 'aresample=48000'] if normalize else []
+    labels = ''.join(f"[out{index}]" for index in range(len(outputs)))
+    filter_graph = f"[0:a]{','.join(chain + [f'asplit={len(outputs)}'])}{labels}"
+
+    temp_paths = [Path(path).with_suffix('.tmp' + Path(path).suffix) for path, _ in outputs]
+    output_args = []
+    for index, ((path, spec), temp_path) in enumerate(zip(outputs, temp_paths)):
+        encoder = ENCODERS[spec['format']]
+        output_args += [
+            '-map', f"[out{index}]",
+            *encoder['codec'],
+            *(['-b:a', spec['bitrate']] if spec['bitrate'] else encoder['quality']),
+            *(['-metadata', f"comment={NORMALIZE_MARKER}"] if normalize else []),
+            str(temp_path),
+        ]
+
+    cmd = [
+        'ffmpeg',
+        '-i', str(input_path),
+        '-filter_complex', filter_graph,
+        '-progress', 'pipe:1',
+        '-nostats',
+        '-y',
+        *output_args,
+    ]
+    try:
+        run_ffmpeg(cmd, on_progress=on_progress, cancel_token=cancel_token)
+        for (path, _), temp_path in zip(outputs, temp_paths):
+            temp_path.replace(path)
+    finally:
+        for temp_path in temp_paths:
+            temp_path.unlink(missing_ok=True)
+
+def tag_with_ffmpeg(audio_path, tags, cover_path=None, cancel_token=None):
+    """
+    Записывает теги из CSV и обложку одним проходом ffmpeg (запасной путь без mutagen)
+
+    Аудио копируется без перекодирования, но файл переписывается целиком.
+
+    Args:
+        audio_path: путь к готовому треку (.mp3 или .m4a)
+        tags: dict из tagging.build_tags
+        cover_path: путь к картинке из art_cache (опционально)
+        cancel_token: CancelToken для прерывания (отмена пробрасывается как OperationCancelled)
+
+    Returns:
+        True если успешно, False если ошибка
+    """
+    audio_path = Path(audio_path)
+    temp_path = audio_path.with_suffix('.tmp' + audio_path.suffix)
+    try:
+        metadata_args = []
+        for key in ('artist', 'title', 'album'):
+            if key in tags:
+                metadata_args += ['-metadata', f"{key}={tags[key]}"]
+        if 'track' in tags:
+            track = f"{tags['track']}/{tags['total']}" if 'total' in tags else str(tags['track'])
+            metadata_args += ['-metadata', f"track={track}"]
+
+        cover_args = []
+        if cover_path:
+            cover_args = [
+                '-i', str(cover_path),
+                '-map', '0:a', '-map', '1:v',
+                '-c', 'copy',
+                *COVER_CODECS.get(audio_path.suffix, []),
+                '-disposition:v', 'attached_pic',
+            ]
+
+        cmd = [
+            'ffmpeg',
+            '-i', str(audio_path),
+            *(cover_args or ['-map', '0:a', '-c', 'copy']),
+            *metadata_args,
+            '-y',
+            str(temp_path)
+        ]
+        run_command(cmd, timeout=NORMALIZE_TIMEOUT, stall_timeout=NORMALIZE_STALL_TIMEOUT,
+                    cancel_token=cancel_token)
+        temp_path.replace(audio_path)
+        return True
+    except OperationCancelled:
+        raise
+    except Exception as e:
+        print(f"   ⚠️  Ошибка записи тегов: {e}")
+        return False
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+def read_songs(csv_path):
+    """Читает треки из CSV (строка метаданных '# Playlist:' пропускается)"""
+    with open(csv_path, 'r', encoding='utf-8') as f:
+        # Пропускаем первую строку если это метаданные плейлиста
+        first_line = f.readline()
+        if not first_line.startswith('# Playlist:'):
+            # Если не метаданные, возвращаемся в начало
+            f.seek(0)
+
+        reader = csv.DictReader(f)
+        return list(reader)
+
+def build_base_filename(num, artist, track_name):
+    """
+    Формирует имя файла трека без расширения: "01. Artist - Track"
+
+    Returns:
+        (base_filename, clean_artist, clean_track)
+    """
+    # Очищаем названия
+    clean_artist = clean_filename(artist, max_length=100)  # Без ограничения пока
+    clean_track = clean_filename(track_name, max_length=100)
+
+    # Формируем название файла
+    base_filename = f"{num}. {clean_artist} - {clean_track}"
+
+    # Ограничиваем общую длину названия (без .mp3)
+    max_base_length = 40
+    if len(base_filename) > max_base_length:
+        # Обрезаем, оставляя место для номера и разделителей
+        # Формат: "01. Artist - Track"
+        prefix_len = len(f"{num}. ")  # "01. " = 4 символа
+        available = max_base_length - prefix_len
+
+        # Делим доступное место 50/50 между артистом и треком
+        artist_max = available // 2 - 3  # -3 для " - "
+        track_max = available - artist_max - 3
+
+        clean_artist = clean_filename(artist, max_length=artist_max)
+        clean_track = clean_filename(track_name, max_length=track_max)
+
+        base_filename = f"{num}. {clean_artist} - {clean_track}"
+
+    return base_filename, clean_artist, clean_track
+
+def remove_partial_files(output_dir, base_filename):
+    """
+    Удаляет недоделанные файлы трека (.mp3/.opus/.m4a, .tmp.*, .temp.*, исходный .webm, миниатюры)
+
+    Файлы .part и .ytdl оставляем: по ним yt-dlp докачает трек при следующем запуске.
+    """
+    prefix = f"{base_filename}."
+    for path in Path(output_dir).iterdir():
+        if not path.name.startswith(prefix):
+            continue
+        if path.name.endswith(('.part', '.ytdl')):
+            continue
+        try:
+            path.unlink()
+        except OSError:
+            pass
+
+def parse_output_formats(text):
+    """
+    Разбирает --format: один ключ OUTPUT_FORMATS или список "формат[:битрейт]" через запятую
+
+    Returns:
+        Список dict (format, bitrate, label); label - имя подпапки при нескольких форматах
+
+    Raises:
+        ValueError: неизвестный формат, битрейт или повтор
+    """
+    if text in OUTPUT_FORMATS:
+        return [{'format': text, 'bitrate': None, 'label': text}]
+
+    specs = []
+    for item in text.split(','):
+        output_format, _, bitrate = item.strip().partition(':')
+        if output_format not in ENCODERS:
+            raise ValueError(f"Неизвестный формат: {output_format} (для нескольких форматов: {', '.join(ENCODERS)})")
+        if bitrate and not re.fullmatch(r'\d+k', bitrate):
+            raise ValueError(f"Неверный битрейт: {bitrate} (например, 192k)")
+        label = f"{output_format}-{bitrate}" if bitrate else output_format
+        if any(spec['label'] == label for spec in specs):
+            raise ValueError(f"Формат указан дважды: {label}")
+        specs.append({'format': output_format, 'bitrate': bitrate or None, 'label': label})
+    return specs
+
+def is_encoded_output(output_format):
+    """True если файлы кодируются из одного декодирования (несколько форматов или битрейт)"""
+    return output_format not in OUTPUT_FORMATS
+
+def output_targets(output_dir, output_format):
+    """
+    Куда и с какими расширениями сохраняется трек
+
+    Один формат - в output_dir, несколько - каждый в подпапку output_dir/<label>.
+
+    Returns:
+        Список (Path папки, кортеж расширений, spec из parse_output_formats)
+    """
+    specs = parse_output_formats(output_format)
+    if not is_encoded_output(output_format):
+        return [(Path(output_dir), OUTPUT_FORMATS[output_format]['extensions'], specs[0])]
+    return [
+        (Path(output_dir) / spec['label'] if len(specs) > 1 else Path(output_dir),
+         (ENCODERS[spec['format']]['extension'],), spec)
+        for spec in specs
+    ]
+
+def find_output_file(output_dir, base_filename, extensions):
+    """
+    Ищет готовый файл трека с одним из расширений формата
+
+    Returns:
+        Path файла или None
+    """
+    for extension in extensions:
+        path = Path(output_dir) / f"{base_filename}{extension}"
+        if path.exists():
+            return path
+    return None
+
+def track_files(songs, output_dir, output_format=DEFAULT_OUTPUT_FORMAT):
+    """
+    Готовые файлы треков плейлиста во всех форматах (для album_gain)
+
+    Returns:
+        Список (строка CSV, label формата, абсолютный Path файла)
+    """
+    files = []
+    for song in songs:
+        num = song.get('№', '').zfill(2)
+        base_filename, _, _ = build_base_filename(num, song['Артист'], song['Песня'])
+        for target_dir, extensions, spec in output_targets(output_dir, output_format):
+            path = find_output_file(target_dir, base_filename, extensions)
+            if path:
+                files.append((song, spec['label'], path.resolve()))
+    return files
+
+
+class EmptyDownloadError(Exception):
+    """yt-dlp завершился без ошибки, но файла нет (ytsearch1 ничего не нашёл)"""
+
+
+def download_audio(download_target, output_dir, base_filename, track_metrics, output_format=DEFAULT_OUTPUT_FORMAT,
+                   embed_metadata=False, on_progress=None, cancel_token=None):
+    """
+    Скачивает аудио через yt-dlp
+
+    Args:
+        download_target: URL видео или ytsearch1:запрос
+        output_dir: папка для сохранения
+        base_filename: имя файла без расширения
+        track_metrics: TrackMetrics для замеров этапов и байтов
+        output_format: ключ OUTPUT_FORMATS (mp3 перекодирует, opus/m4a/native - нет)
+        embed_metadata: пусть yt-dlp сам пишет теги YouTube и миниатюру
+            (лишние проходы по файлу; нужно только без mutagen для opus/native)
+        on_progress: функция (stage, percent, speed, eta) для прогресса трека
+        cancel_token: CancelToken для прерывания скачивания
+
+    Returns:
+        Path скачанного файла (расширение зависит от формата и исходного потока)
+
+    Raises:
+        OperationCancelled: скачивание отменено
+        ThrottledError: если YouTube ограничил запросы
+        subprocess.CalledProcessError: при других ошибках yt-dlp
+        EmptyDownloadError: yt-dlp завершился успешно, но файла нужного формата нет
+    """
+    audio_format = OUTPUT_FORMATS[output_format]
+    # Расширение подставит yt-dlp; % в имени экранируем, чтобы он не счёл его шаблоном
+    output_template = Path(output_dir) / f"{base_filename.replace('%', '%%')}.%(ext)s"
+    cmd = [
+        'yt-dlp',
+        '-x',
+        *audio_format['ytdlp'],
+        '--output', str(output_template),
+        *(['--add-metadata', '--embed-thumbnail'] if embed_metadata else []),
+        '--newline',
+        '--no-warnings',
+        download_target
+    ]
+
+    # Вывод yt-dlp читаем построчно, чтобы разделить время на этапы
+    # (извлечение, скачивание, перекодирование) и посчитать байты
+    tracker = StageTracker(track_metrics, ytdlp_stage)
+
+    video_match = VIDEO_ID_PATTERN.search(download_target)
+    if video_match:
+        track_metrics.video_id = video_match.group(1)
+
+    def on_line(line):
+        tracker.feed(line)
+        track_metrics.bytes += parse_downloaded_bytes(line)
+        if not track_metrics.video_id:
+            match = VIDEO_ID_PATTERN.search(line)
+            if match:
+                track_metrics.video_id = match.group(1)
+        if on_progress:
+            progress = parse_download_progress(line)
+            if progress:
+                on_progress('downloading', *progress)
+            elif ytdlp_stage(line) == 'transcode':
+                on_progress('converting', None, None, None)
+
+    # Извлечение метаданных видео - такой же запрос к YouTube, как поиск
+    acquire_request_slot(cancel_token)
+    try:
+        # Доля общего бюджета полосы хоста на время этого скачивания
+        with throttle.get_bandwidth_shaper().download_slot(cancel_token) as limit_rate:
+            if limit_rate:
+                cmd[-1:-1] = ['--limit-rate', str(limit_rate)]
+            run_command(cmd, on_line=on_line, timeout=DOWNLOAD_TIMEOUT, stall_timeout=DOWNLOAD_STALL_TIMEOUT,
+                        cancel_token=cancel_token)
+        track_metrics.exit_status = 0
+    except subprocess.CalledProcessError as e:
+        track_metrics.exit_status = e.returncode
+        if throttle.is_throttled(e.stderr):
+            raise throttle.ThrottledError(e.stderr.strip()) from e
+        raise
+    finally:
+        tracker.close()
+
+    output_path = find_output_file(output_dir, base_filename, audio_format['extensions'])
+    if output_path is None:
+        raise EmptyDownloadError(f"yt-dlp не создал файл {base_filename} ({output_format})")
+
+    if not track_metrics.bytes:
+        track_metrics.bytes = output_path.stat().st_size
+    return output_path
+
+
+class TrackDownloader:
+    """
+    Обработка одного трека: поиск, скачивание, нормализация, теги
+
+    Настройки и общее состояние (папка, формат, лимит параллельности, отмена,
+    колбэки) задаются один раз, а process() вызывается из рабочих потоков
+    для каждого трека. Используется download_from_csv и очередью заданий.
+    """
+
+    def __init__(self, output_dir, normalize=True, output_format=DEFAULT_OUTPUT_FORMAT, concurrency=None,
+                 cancel_token=None, log_callback=None, track_callback=None, stop_check=None, total_songs=None,
+                 manifest=None, hedge_delay=None, recheck_failed=False):
+        """
+        Args:
+            output_dir: директория для сохранения (создаётся при необходимости)
+            normalize: применять ли нормализацию громкости
+            output_format: ключ OUTPUT_FORMATS или список форматов (см. parse_output_formats)
+            concurrency: AIMDConcurrency, получающий сигналы успеха и троттлинга
+            cancel_token: CancelToken для прерывания yt-dlp/ffmpeg
+            log_callback: функция для вывода логов (по умолчанию print)
+            track_callback: функция (num, stage, percent, speed, eta)
+            stop_check: функция которая возвращает True если нужно остановить
+            total_songs: число треков в плейлисте (для тега номера трека)
+            manifest: манифест resolve_playlist; для треков из него поиск не выполняется
+            hedge_delay: бюджет задержки поиска до запасного запроса (None - без него)
+            recheck_failed: не пропускать треки из кэша неудач (negative_cache)
+        """
+        self.output_dir = output_dir
+        self.normalize = normalize
+        self.output_format = output_format
+        self.concurrency = concurrency or throttle.AIMDConcurrency()
+        throttle.get_bandwidth_shaper().declare_workers(self.concurrency.maximum)
+        self.cancel_token = cancel_token or CancelToken()
+        self.log_callback = log_callback
+        self.track_callback = track_callback
+        self.stop_check = stop_check
+        self.total_songs = total_songs
+        self.resolutions = manifest_resolutions(manifest) if manifest else {}
+        self.hedge_delay = hedge_delay
+        self.negative_cache = negative_cache.get_negative_cache()
+        self.recheck_failed = recheck_failed
+
+        # Папки и расширения готовых файлов; encoded - несколько форматов из одного декодирования
+        self.targets = output_targets(output_dir, output_format)
+        self.encoded = is_encoded_output(output_format)
+        # Теги из CSV пишем сами: через mutagen или (для mp3/m4a) одним проходом ffmpeg
+        self.in_process_tags = tagging.is_available()
+        self.ytdlp_tags = (not self.in_process_tags and not self.encoded
+                           and OUTPUT_FORMATS[output_format]['cover'] == 'ytdlp')
+
+        # Создаём директории если не существуют
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+        for target_dir, _, _ in self.targets:
+            target_dir.mkdir(parents=True, exist_ok=True)
+
+    def log(self, message):
+        """Вывод лога в консоль или через callback"""
+        if self.log_callback:
+            self.log_callback(message)
+        else:
+            print(message)
+
+    def should_stop(self):
+        """Проверка нужно ли остановить"""
+        if not self.cancel_token.cancelled and self.stop_check and self.stop_check():
+            self.cancel_token.cancel()
+        return self.cancel_token.cancelled
+
+    def report_track(self, num, stage, percent=None, speed=None, eta=None):
+        """Прогресс отдельного трека (для таблицы в GUI)"""
+        if self.track_callback:
+            self.track_callback(num, stage, percent, speed, eta)
+
+    def log_failure(self, num, clean_artist, clean_track, error):
+        """Пишет в лог итоговую ошибку трека"""
+        self.log(f"❌ [{num}] Ошибка: {clean_artist} - {clean_track}")
+        stderr = getattr(error, 'stderr', None)
+        self.log(f"   {stderr.strip() if stderr else error}\n")
+
+    def fail_track(self, song, num, clean_artist, clean_track, error, track_metrics, cause):
+        """Итоговая ошибка трека: лог, метрики и запись в кэш неудач"""
+        track_metrics.finish('failed')
+        self.report_track(num, 'failed')
+        self.log_failure(num, clean_artist, clean_track, error)
+        entry = self.negative_cache.record(song['Артист'], song['Песня'], cause, short_error(error))
+        if entry:
+            self.log(f"   🚫 [{num}] Запомнено как неудача ({cause}), перепроверка после {format_timestamp(entry['retry_after'])}")
+        return 'failed'
+
+    def find_outputs(self, base_filename):
+        """Готовые файлы трека во всех форматах (None там, где файла нет)"""
+        return [find_output_file(target_dir, base_filename, extensions) for target_dir, extensions, _ in self.targets]
+
+    def remove_outputs(self, base_filename):
+        """Удаляет недоделанные файлы трека во всех папках форматов"""
+        remove_partial_files(self.output_dir, base_filename)
+        for target_dir, _, _ in self.targets:
+            if target_dir != Path(self.output_dir):
+                remove_partial_files(target_dir, base_filename)
+
+    def cancel_track(self, num, base_filename, track_metrics):
+        """Отмена трека: удаляет недоделанные файлы и помечает трек отменённым"""
+        self.remove_outputs(base_filename)
+        track_metrics.finish('cancelled')
+        self.report_track(num, 'cancelled')
+        return 'cancelled'
+
+    def on_throttled(self, num):
+        """Реакция на троттлинг: пауза для всех процессов и снижение параллельности"""
+        throttle.get_request_limiter().cooldown(throttle.THROTTLE_COOLDOWN)
+        if self.concurrency.on_throttle():
+            self.log(f"🐢 [{num}] YouTube ограничивает запросы, параллельность снижена до {self.concurrency.current_limit}")
+
+    def process(self, song, track_metrics, final=False):
+        """
+        Ищет, скачивает и нормализует один трек
+
+        Временные ошибки повторяются до MAX_ATTEMPTS раз с экспоненциальной
+        задержкой. Если попытки кончились, трек откладывается в очередь повторов
+        (или, при final=True, помечается ошибкой).
+
+        Returns:
+            'ok', 'skipped', 'failed', 'retry' или 'cancelled'
+        """
+        num = song.get('№', '').zfill(2)
+        track_name = song['Песня']
+        artist = song['Артист']
+
+        base_filename, clean_artist, clean_track = build_base_filename(num, artist, track_name)
+        search_query = f"{artist} {track_name}"
+
+        # Пропускаем если уже скачан во всех выбранных форматах
+        if all(self.find_outputs(base_filename)):
+            self.log(f"⏭️  [{num}] Уже скачан: {clean_artist} - {clean_track}")
+            track_metrics.finish('skipped')
+            self.report_track(num, 'skipped', 100.0)
+            return 'skipped'
+
+        # Известная неудача: не тратим поиск и скачивание до срока перепроверки
+        known_failure = None if self.recheck_failed else self.negative_cache.check(artist, track_name)
+        if known_failure:
+            self.log(f"🚫 [{num}] Пропущен (известная ошибка: {known_failure['cause']}, "
+                     f"перепроверка после {format_timestamp(known_failure['retry_after'])}): {clean_artist} - {clean_track}")
+            track_metrics.failure = known_failure['cause']
+            track_metrics.finish('known_failed')
+            self.report_track(num, 'skipped', 100.0)
+            return 'skipped'
+
+        self.log(f"⬇️  [{num}] Скачиваю: {clean_artist} - {clean_track}")
+
+        attempt = 0
+        while True:
+            attempt += 1
+            searched = False
+            video_url = None
+            try:
+                resolution = self.resolutions.get(search_query.lower())
+                if resolution is not None:
+                    # Видео уже выбрано на этапе resolve
+                    video_url = resolution.get('url')
+                else:
+                    # Ищем подходящее видео (не длиннее трека с запасом, без длительности в CSV - 7 минут)
+                    self.report_track(num, 'searching')
+                    expected_duration = parse_track_duration(song.get('Длительность'))
+                    resolution = resolve_track_video(artist, track_name, max_duration=track_max_duration(expected_duration),
+                                                     max_results=5, track_metrics=track_metrics,
+                                                     cancel_token=self.cancel_token, hedge_delay=self.hedge_delay,
+                                                     expected_duration=expected_duration)
+                    video_url = resolution['url'] if resolution else None
+                    if resolution and resolution['source'] == 'cache':
+                        self.log(f"   ✓ [{num}] Из кэша поиска: {video_url}")
+                searched = True
+
+                # Формируем команду скачивания
+                if video_url:
+                    # Скачиваем конкретное видео
+                    download_target = video_url
+                else:
+                    # Fallback: используем первый результат поиска
+                    download_target = f'ytsearch1:{search_query}'
+
+                if self.encoded:
+                    # Исходный поток без перекодирования: форматы сделает encode_outputs
+                    output_path = download_audio(download_target, self.output_dir, f"{base_filename}.source",
+                                                 track_metrics, output_format='native',
+                                                 on_progress=lambda *progress: self.report_track(num, *progress),
+                                                 cancel_token=self.cancel_token)
+                else:
+                    output_path = download_audio(download_target, self.output_dir, base_filename, track_metrics,
+                                                 output_format=self.output_format, embed_metadata=self.ytdlp_tags,
+                                                 on_progress=lambda *progress: self.report_track(num, *progress),
+                                                 cancel_token=self.cancel_token)
+                self.concurrency.on_success()
+                break
+
+            except OperationCancelled:
+                return self.cancel_track(num, base_filename, track_metrics)
+
+            except Exception as e:
+                # Недокачанный файл нельзя оставлять: следующий запуск счёл бы его готовым.
+                # Скачивался только исходный поток (или единственный формат), поэтому
+                # готовые файлы других форматов не трогаем (.part и .ytdl остаются для докачки)
+                remove_partial_files(self.output_dir, f"{base_filename}.source" if self.encoded else base_filename)
+
+                failure = retries.classify_failure(e)
+                track_metrics.failure = failure
+                if failure == 'throttled':
+                    self.on_throttled(num)
+
+                if self.should_stop():
+                    return self.cancel_track(num, base_filename, track_metrics)
+
+                # Не найден - только если поиск ничего не дал и ytsearch1 тоже: пустой
+                # результат или постоянная ошибка yt-dlp (не сеть и не окружение)
+                not_found = searched and video_url is None and (
+                    isinstance(e, EmptyDownloadError) or failure == 'permanent')
+                cause = 'not_found' if not_found else failure
+
+                if not_found or not retries.is_retryable(failure):
+                    return self.fail_track(song, num, clean_artist, clean_track, e, track_metrics, cause)
+
+                if attempt >= MAX_ATTEMPTS:
+                    if final:
+                        return self.fail_track(song, num, clean_artist, clean_track, e, track_metrics, cause)
+                    self.report_track(num, 'retrying')
+                    self.log(f"   ⏳ [{num}] Не удалось после {attempt} попыток ({failure}), трек отложен в очередь повторов")
+                    return 'retry'
+
+                delay = retries.backoff_delay(attempt)
+                track_metrics.retries += 1
+                self.report_track(num, 'retrying', eta=format_eta(delay))
+                self.log(f"   🔁 [{num}] Повтор {attempt}/{MAX_ATTEMPTS - 1} через {delay:.0f}s ({failure}: {short_error(e)})")
+                if not retries.sleep_unless_stopped(delay, self.should_stop):
+                    return self.cancel_track(num, base_filename, track_metrics)
+
+        if self.encoded:
+            # Все форматы из одного декодирования (и одной нормализации)
+            output_paths = [target_dir / f"{base_filename}{extensions[0]}" for target_dir, extensions, _ in self.targets]
+            labels = ', '.join(spec['label'] for _, _, spec in self.targets)
+            self.log(f"   🎛️  Кодирование: {labels}{' с нормализацией' if self.normalize else ''}...")
+            self.report_track(num, 'converting', 0.0)
+            try:
+                with track_metrics.stage('encode'):
+                    encode_outputs(
+                        output_path, [(path, spec) for path, (_, _, spec) in zip(output_paths, self.targets)],
+                        normalize=self.normalize,
+                        on_progress=lambda *progress: self.report_track(num, 'converting', *progress),
+                        cancel_token=self.cancel_token
+                    )
+            except OperationCancelled:
+                return self.cancel_track(num, base_filename, track_metrics)
+            except Exception as e:
+                self.remove_outputs(base_filename)
+                return self.fail_track(song, num, clean_artist, clean_track, e, track_metrics,
+                                       retries.classify_failure(e))
+            finally:
+                output_path.unlink(missing_ok=True)
+            self.log(f"✅ [{num}] Готово ({labels}): {clean_artist} - {clean_track}\n")
+
+        # Нормализация громкости если включена
+        elif self.normalize:
+            self.log(f"   🔊 Нормализация громкости...")
+            temp_path = output_path.with_suffix('.tmp' + output_path.suffix)
+
+            self.report_track(num, 'normalizing', 0.0)
+            try:
+                with track_metrics.stage('normalize'):
+                    normalized = normalize_audio(
+                        output_path, temp_path,
+                        on_progress=lambda *progress: self.report_track(num, 'normalizing', *progress),
+                        cancel_token=self.cancel_token
+                    )
+            except OperationCancelled:
+                # Ненормализованный файл тоже удаляем, иначе он будет пропущен при следующем запуске
+                return self.cancel_track(num, base_filename, track_metrics)
+
+            if normalized:
+                # Заменяем оригинальный файл нормализованным
+                temp_path.replace(output_path)
+                self.log(f"✅ [{num}] Готово (с нормализацией): {clean_artist} - {clean_track}\n")
+            else:
+                # Если нормализация не удалась, удаляем временный файл
+                if temp_path.exists():
+                    temp_path.unlink()
+                self.log(f"✅ [{num}] Готово (без нормализации): {clean_artist} - {clean_track}\n")
+        else:
+            self.log(f"✅ [{num}] Готово: {clean_artist} - {clean_track}\n")
+
+        if not self.encoded:
+            output_paths = [output_path]
+
+        # Теги из CSV и обложка (одна загрузка на альбом) одним проходом
+        if not self.ytdlp_tags:
+            tags = tagging.build_tags(song, self.total_songs)
+            try:
+                with track_metrics.stage('tag'):
+                    try:
+                        cover_path = art_cache.get_art_cache().get_or_fetch(
+                            track_metrics.video_id, artist, song.get('Альбом'), cancel_token=self.cancel_token
+                        )
+                    except OperationCancelled:
+                        raise
+                    except Exception as e:
+                        # Без обложки теги всё равно пишем
+                        cover_path = None
+                        self.log(f"   ⚠️  [{num}] Обложка не получена: {short_error(e)}")
+
+                    for path in output_paths:
+                        if self.in_process_tags:
+                            tagging.write_tags(path, tags, cover_path)
+                        else:
+                            # Без mutagen обложку ffmpeg встраивает только в mp3/m4a, в opus - только теги
+                            tag_with_ffmpeg(path, tags, cover_path if path.suffix in COVER_CODECS else None,
+                                            cancel_token=self.cancel_token)
+            except OperationCancelled:
+                return self.cancel_track(num, base_filename, track_metrics)
+            except Exception as e:
+                # Без тегов трек всё равно готов
+                self.log(f"   ⚠️  [{num}] Теги не записаны: {short_error(e)}")
+
+        self.negative_cache.clear(artist, track_name)
+        track_metrics.finish('ok')
+        self.report_track(num, 'done', 100.0)
+        return 'ok'
+
+def download_from_csv(csv_path, output_dir, normalize=True, progress_callback=None, log_callback=None, stop_check=None,
+                      report_dir=None, prometheus_path=None, workers=1, track_callback=None, cancel_token=None,
+                      output_format=DEFAULT_OUTPUT_FORMAT, concurrency=None, manifest=None, hedge_delay=None,
+                      recheck_failed=False, loudness='track', gain_mode='tags'):
     """
     Скачивает музыку из CSV файла
 
@@ -216,146 +1384,362 @@ def download_from_csv(csv_path, output_dir, normalize=True, progress_callback=No
         progress_callback: функция для обновления прогресса (current, total)
         log_callback: функция для вывода логов
         stop_check: функция которая возвращает True если нужно остановить
+        report_dir: папка для отчёта о прогоне (run_trace.jsonl и run_summary.json)
+        prometheus_path: путь к textfile с метриками для Prometheus (опционально)
+        workers: максимум треков одновременно; фактическая параллельность
+            подстраивается под троттлинг YouTube (AIMD)
+        track_callback: функция (num, stage, percent, speed, eta) для прогресса
+            отдельных треков; stage: searching, downloading, converting,
+            normalizing, retrying, done, skipped, failed, cancelled
+        cancel_token: CancelToken; cancel() прерывает текущие yt-dlp/ffmpeg
+            в течение нескольких секунд и удаляет недокачанные файлы
+        output_format: ключ OUTPUT_FORMATS; opus/m4a/native сохраняют поток
+            YouTube без перекодирования в MP3
+        concurrency: общий AIMDConcurrency (демон делит один лимит между
+            всеми заданиями); по умолчанию свой на прогон
+        manifest: манифест resolve_playlist (режим fetch): выбранные видео
+            скачиваются без повторного поиска
+        hedge_delay: если основной поиск не дал хорошего видео за столько
+            секунд, параллельно запускается запасной запрос (None - выключено)
+        recheck_failed: проверить и треки из кэша неудач, не дожидаясь срока
+        loudness: 'track' - loudnorm каждого трека; 'album'/'playlist' - общий gain
+            группы после скачивания (album_gain), треки не нормализуются по одному
+        gain_mode: для album/playlist: 'tags' - теги ReplayGain, 'apply' - перекодирование
+
+    Returns:
+        RunMetrics с замерами по всем трекам
     """
 
-    def log(message):
-        """Вывод лога в консоль или через callback"""
-        if log_callback:
-            log_callback(message)
-        else:
-            print(message)
+    # Читаем CSV
+    songs = read_songs(csv_path)
+    total_songs = len(songs)
 
-    def should_stop():
-        """Проверка нужно ли остановить"""
-        return stop_check and stop_check()
+    # Параллельность начинаем с малого и наращиваем, пока YouTube не начнёт ограничивать
+    if concurrency is None:
+        concurrency = throttle.AIMDConcurrency(initial=min(2, workers), maximum=workers)
+
+    downloader = TrackDownloader(
+        output_dir,
+        normalize=normalize and loudness == 'track',
+        output_format=output_format,
+        concurrency=concurrency,
+        cancel_token=cancel_token,
+        log_callback=log_callback,
+        track_callback=track_callback,
+        stop_check=stop_check,
+        total_songs=total_songs,
+        manifest=manifest,
+        hedge_delay=hedge_delay,
+        recheck_failed=recheck_failed
+    )
+    log = downloader.log
+    should_stop = downloader.should_stop
 
-    # Создаём директорию если не существует
-    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    log(f"📀 Найдено {total_songs} треков для скачивания\n")
 
-    # Читаем CSV
-    with open(csv_path, 'r', encoding='utf-8') as f:
-        # Пропускаем первую строку если это метаданные плейлиста
-        first_line = f.readline()
-        if not first_line.startswith('# Playlist:'):
-            # Если не метаданные, возвращаемся в начало
-            f.seek(0)
+    metrics = RunMetrics(trace_path=Path(report_dir) / 'run_trace.jsonl' if report_dir else None)
 
-        reader = csv.DictReader(f)
-        songs = list(reader)
+    completed = [0]
+    completed_lock = threading.Lock()
 
-    total_songs = len(songs)
-    log(f"📀 Найдено {total_songs} треков для скачивания\n")
+    def report_progress():
+        """Обновляет прогресс по числу завершённых треков"""
+        with completed_lock:
+            completed[0] += 1
+            current = completed[0]
+        if progress_callback:
+            progress_callback(current, total_songs)
 
-    # Скачиваем каждый трек
-    for idx, song in enumerate(songs, 1):
-        # Проверяем, нужно ли остановить
-        if should_stop():
-            log("\n⏸️  Скачивание остановлено пользователем")
-            break
+    retry_queue = []
+    retry_queue_lock = threading.Lock()
 
-        num = song.get('№', '').zfill(2)
-        track_name = song['Песня']
-        artist = song['Артист']
+    def run_track(song, track_metrics=None, final=False):
+        """Обрабатывает трек в рабочем потоке и освобождает слот параллельности"""
+        outcome = 'failed'
+        if track_metrics is None:
+            track_metrics = metrics.start_track(song.get('№', '').zfill(2), song['Артист'], song['Песня'])
+        try:
+            with profiling.thread_profile():
+                outcome = downloader.process(song, track_metrics, final)
+        except Exception as e:
+            log(f"❌ Ошибка: {e}\n")
+        finally:
+            concurrency.release()
+            if outcome == 'retry':
+                with retry_queue_lock:
+                    retry_queue.append((song, track_metrics))
+            elif outcome != 'cancelled':
+                report_progress()
+
+    def run_pass(items, final):
+        """
+        Прогон по списку (song, track_metrics)
+
+        Returns:
+            False если прогон остановлен пользователем
+        """
+        # Новый трек запускается, когда AIMD-лимит даёт свободный слот
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            for song, track_metrics in items:
+                # Проверяем, нужно ли остановить
+                if should_stop() or not concurrency.acquire(should_stop=should_stop):
+                    log("\n⏸️  Скачивание остановлено пользователем")
+                    return False
+                pool.submit(run_track, song, track_metrics, final)
+        return True
 
-        # Очищаем названия
-        clean_artist = clean_filename(artist, max_length=100)  # Без ограничения пока
-        clean_track = clean_filename(track_name, max_length=100)
+    # Скачиваем треки
+    completed_all = run_pass([(song, None) for song in songs], final=False)
 
-        # Формируем название файла
-        base_filename = f"{num}. {clean_artist} - {clean_track}"
+    # Очередь повторов: треки с временными ошибками пробуем ещё раз в конце прогона,
+    # когда сеть или YouTube, возможно, уже пришли в норму
+    if completed_all and retry_queue:
+        log(f"\n🔁 Очередь повторов: {len(retry_queue)} треков, пауза {RETRY_QUEUE_DELAY:.0f}s...")
+        if retries.sleep_unless_stopped(RETRY_QUEUE_DELAY, should_stop):
+            queued = list(retry_queue)
+            retry_queue.clear()
+            run_pass(queued, final=True)
 
-        # Ограничиваем общую длину названия (без .mp3)
-        max_base_length = 40
-        if len(base_filename) > max_base_length:
-            # Обрезаем, оставляя место для номера и разделителей
-            # Формат: "01. Artist - Track"
-            prefix_len = len(f"{num}. ")  # "01. " = 4 символа
-            available = max_base_length - prefix_len
+    # Громкость альбомов/плейлиста: нужна громкость всех треков группы
+    if normalize and loudness != 'track' and not should_stop():
+        try:
+            album_gain.apply_group_gain(track_files(songs, output_dir, output_format), mode=loudness,
+                                        gain_mode=gain_mode, log_callback=log, cancel_token=downloader.cancel_token)
+        except OperationCancelled:
+            log("\n⏸️  Выравнивание громкости остановлено пользователем")
 
-            # Делим доступное место 50/50 между артистом и треком
-            artist_max = available // 2 - 3  # -3 для " - "
-            track_max = available - artist_max - 3
+    log(f"\n🎵 Все треки скачаны в: {output_dir}")
 
-            clean_artist = clean_filename(artist, max_length=artist_max)
-            clean_track = clean_filename(track_name, max_length=track_max)
+    metrics.finish()
+    for line in metrics.format_summary():
+        log(line)
 
-            base_filename = f"{num}. {clean_artist} - {clean_track}"
+    if report_dir:
+        metrics.write_summary(Path(report_dir) / 'run_summary.json')
+        log(f"📈 Отчёт о прогоне: {report_dir}")
+    if prometheus_path:
+        metrics.write_prometheus(prometheus_path)
 
-        output_filename = f"{base_filename}.mp3"
-        search_query = f"{artist} {track_name}"
-        output_path = Path(output_dir) / output_filename
+    return metrics
 
-        # Пропускаем если уже скачан
-        if output_path.exists():
-            log(f"⏭️  [{num}] Уже скачан: {clean_artist} - {clean_track}")
-            if progress_callback:
-                progress_callback(idx, total_songs)
-            continue
+def manifest_resolutions(manifest):
+    """Записи манифеста по поисковому запросу (в нижнем регистре)"""
+    return {track['query'].lower(): track for track in manifest.get('tracks', []) if not track.get('error')}
 
-        log(f"⬇️  [{num}] Скачиваю: {clean_artist} - {clean_track}")
+def resolve_track(song, cancel_token=None, hedge_delay=None):
+    """
+    Выбор видео для строки CSV (без скачивания), с повторами временных ошибок
 
+    Returns:
+        dict записи манифеста
+    """
+    artist = song['Артист']
+    title = song['Песня']
+    query = f"{artist} {title}"
+    expected_duration = parse_track_duration(song.get('Длительность'))
+    track = {
+        'num': song.get('№', '').zfill(2),
+        'artist': artist,
+        'title': title,
+        'album': song.get('Альбом', ''),
+        'query': query,
+        'expected_duration': expected_duration,
+    }
+
+    attempt = 0
+    while True:
+        attempt += 1
         try:
-            # Ищем подходящее видео (не длиннее 7 минут)
-            video_url = find_suitable_video(search_query, max_duration=420, max_results=5)
+            resolution = resolve_track_video(artist, title, max_duration=track_max_duration(expected_duration),
+                                             max_results=5, cancel_token=cancel_token, hedge_delay=hedge_delay,
+                                             expected_duration=expected_duration)
+            break
+        except OperationCancelled:
+            raise
+        except Exception as e:
+            failure = retries.classify_failure(e)
+            if failure == 'throttled':
+                throttle.get_request_limiter().cooldown(throttle.THROTTLE_COOLDOWN)
+            if not retries.is_retryable(failure) or attempt >= MAX_ATTEMPTS:
+                track['error'] = short_error(e)
+                return track
+            if not retries.sleep_unless_stopped(retries.backoff_delay(attempt),
+                                                lambda: cancel_token is not None and cancel_token.cancelled):
+                raise OperationCancelled()
+
+    if resolution is None:
+        # Подходящего видео нет: при скачивании будет взят первый результат поиска
+        track.update({'video_id': None, 'url': None, 'tier': None, 'candidates': []})
+        return track
+
+    track.update({
+        'video_id': resolution['video_id'],
+        'url': resolution['url'],
+        'title_found': resolution['title'],
+        'duration': resolution['duration'],
+        'uploader': resolution['uploader'],
+        'channel_id': resolution.get('channel_id'),
+        'source': resolution.get('source'),
+        'tier': resolution['tier'],
+        'score': resolution['score'],
+        'candidates': resolution['candidates'],
+    })
+    return track
+
+def resolve_playlist(csv_path, workers=RESOLVE_WORKERS, log_callback=None, cancel_token=None, hedge_delay=None):
+    """
+    Режим resolve: выбирает видео для всех треков CSV параллельно, ничего не скачивая
 
-            # Формируем команду скачивания
-            if video_url:
-                # Скачиваем конкретное видео
-                download_target = video_url
-            else:
-                # Fallback: используем первый результат поиска
-                download_target = f'ytsearch1:{search_query}'
-
-            cmd = [
-                'yt-dlp',
-                '-x',
-                '--audio-format', 'mp3',
-                '--audio-quality', '0',
-                '--output', str(output_path),
-                '--add-metadata',
-                '--embed-thumbnail',
-                '--quiet',
-                '--no-warnings',
-                download_target
-            ]
+    Поиски идут через общий лимит запросов хоста, поэтому workers ограничивает
+    только число одновременных yt-dlp.
 
-            subprocess.run(cmd, check=True, capture_output=True, text=True)
+    Args:
+        csv_path: путь к CSV файлу
+        workers: сколько поисков выполнять одновременно
+        log_callback: функция для вывода логов (по умолчанию print)
+        cancel_token: CancelToken для прерывания
+        hedge_delay: бюджет задержки поиска до запасного запроса (None - без него)
+
+    Returns:
+        dict манифеста: version, playlist, csv_path, created_at, tracks
+    """
+    log = log_callback or print
+    songs = read_songs(csv_path)
+    log(f"🔎 Выбор видео для {len(songs)} треков ({workers} поисков параллельно)...")
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        tracks = list(pool.map(lambda song: resolve_track(song, cancel_token, hedge_delay), songs))
+
+    resolved = sum(1 for track in tracks if track.get('url'))
+    failed = sum(1 for track in tracks if track.get('error'))
+    log(f"✅ Выбрано: {resolved}/{len(tracks)}, ошибок: {failed} за {time.monotonic() - started:.1f}s")
+
+    return {
+        'version': MANIFEST_VERSION,
+        'playlist': extract_playlist_name(csv_path),
+        'csv_path': str(Path(csv_path).resolve()),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'tracks': tracks,
+    }
+
+def write_manifest(manifest, path):
+    """Сохраняет манифест в JSON"""
+    path = Path(path)
+    tmp_path = path.with_suffix(path.suffix + '.tmp')
+    tmp_path.write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding='utf-8')
+    tmp_path.replace(path)
+
+def load_manifest(path):
+    """
+    Читает манифест
 
-            # Нормализация громкости если включена
-            if normalize:
-                log(f"   🔊 Нормализация громкости...")
-                temp_path = output_path.with_suffix('.tmp.mp3')
+    Raises:
+        ValueError: неизвестная версия манифеста
+    """
+    manifest = json.loads(Path(path).read_text(encoding='utf-8'))
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError(f"Неизвестная версия манифеста: {manifest.get('version')}")
+    return manifest
 
-                if normalize_audio(output_path, temp_path):
-                    # Заменяем оригинальный файл нормализованным
-                    temp_path.replace(output_path)
-                    log(f"✅ [{num}] Готово (с нормализацией): {clean_artist} - {clean_track}\n")
-                else:
-                    # Если нормализация не удалась, удаляем временный файл
-                    if temp_path.exists():
-                        temp_path.unlink()
-                    log(f"✅ [{num}] Готово (без нормализации): {clean_artist} - {clean_track}\n")
-            else:
-                log(f"✅ [{num}] Готово: {clean_artist} - {clean_track}\n")
-
-            # Обновляем прогресс
-            if progress_callback:
-                progress_callback(idx, total_songs)
-
-        except subprocess.CalledProcessError as e:
-            log(f"❌ [{num}] Ошибка: {clean_artist} - {clean_track}")
-            if e.stderr:
-                log(f"   {e.stderr}\n")
-            if progress_callback:
-                progress_callback(idx, total_songs)
-            continue
-        except Exception as e:
-            log(f"❌ [{num}] Ошибка: {e}\n")
-            if progress_callback:
-                progress_callback(idx, total_songs)
-            continue
+def default_manifest_path(csv_path):
+    """Манифест рядом с CSV: <имя>.manifest.json"""
+    return str(Path(csv_path).with_suffix('.manifest.json'))
 
-    log(f"\n🎵 Все треки скачаны в: {output_dir}")
+def record_ranking_corpus(csv_path, corpus_path, max_results=5):
+    """
+    Записывает кандидатов поиска для треков CSV в корпус ranking (дописывает в конец)
+
+    Метка - выбор текущего ранжирования (reviewed: false); после проверки
+    глазами её нужно исправить при необходимости и поставить reviewed: true.
+
+    Returns:
+        Сколько записей добавлено
+    """
+    added = 0
+    with open(corpus_path, 'a', encoding='utf-8') as f:
+        for song in read_songs(csv_path):
+            query = f"{song['Артист']} {song['Песня']}"
+            expected_duration = parse_track_duration(song.get('Длительность'))
+            max_duration = track_max_duration(expected_duration)
+            try:
+                candidates = [candidate_from_info(info) for info in search_videos(query, max_results)]
+            except (CommandTimeoutError, subprocess.CalledProcessError, throttle.ThrottledError) as e:
+                print(f"   ⚠️  {query}: {e}")
+                continue
+            [pick] = ranking.rank_batch([(ranking.RankQuery(query, expected_duration),
+                                          [dict(candidate) for candidate in candidates], max_duration)])
+            f.write(json.dumps({
+                'query': query,
+                'artist': song['Артист'],
+                'title': song['Песня'],
+                'expected_duration': expected_duration,
+                'max_duration': max_duration,
+                'candidates': candidates,
+                'label': pick['video_id'] if pick else None,
+                'reviewed': False,
+            }, ensure_ascii=False) + '\n')
+            added += 1
+            print(f"   📼 {query}: {len(candidates)} кандидатов")
+    return added
+
+def download_via_daemon(daemon_url, csv_path, output_dir, normalize=True, output_format=DEFAULT_OUTPUT_FORMAT,
+                        report_dir=None, loudness='track', gain_mode='tags'):
+    """
+    Тонкий клиент: отправляет задание демону и печатает его лог
+
+    Ctrl+C отменяет задание на стороне демона.
+    """
+    from music_daemon import DaemonClient
+
+    client = DaemonClient(daemon_url)
+    if not client.is_running():
+        print(f"❌ Демон не отвечает: {daemon_url} (запустите python3 music_daemon.py)")
+        sys.exit(1)
+
+    job = client.submit_download(output_dir, csv_path=csv_path, normalize=normalize,
+                                 output_format=output_format, report_dir=report_dir,
+                                 loudness=loudness, gain_mode=gain_mode)
+    print(f"🛰️  Задание {job['id']} отправлено демону {daemon_url}\n")
+
+    def on_event(event):
+        if event['type'] == 'log':
+            print(event['message'])
+        elif event['type'] == 'state' and event['state'] == 'failed':
+            print(f"❌ Ошибка задания: {event.get('error')}")
+
+    try:
+        status = client.follow(job['id'], on_event)
+    except KeyboardInterrupt:
+        client.cancel(job['id'])
+        print("\n⏹️  Задание отменено")
+        sys.exit(1)
+
+    if status['state'] != 'done':
+        sys.exit(1)
+
+def default_output_dir(csv_path, playlist_name=None):
+    """Папка рядом с CSV: по названию плейлиста или Downloaded_Music"""
+    if playlist_name:
+        safe_name = re.sub(r'[^\w\s-]', '', playlist_name).strip().replace(' ', '_')
+        return str(Path(csv_path).parent / safe_name)
+    return str(Path(csv_path).parent / "Downloaded_Music")
+
+
+def get_option(argv, name, default=None):
+    """Возвращает значение опции вида --name=value или default"""
+    prefix = f"--{name}="
+    for arg in argv:
+        if arg.startswith(prefix):
+            return arg[len(prefix):]
+    return default
+
+def get_daemon_url(argv):
+    """Адрес демона из --daemon[=URL] или None"""
+    if '--daemon' in argv:
+        from music_daemon import DEFAULT_DAEMON_URL
+        return DEFAULT_DAEMON_URL
+    return get_option(argv, 'daemon')
 
 def main():
     """Главная функция"""
@@ -370,10 +1754,64 @@ def main():
         print("\nCSV файл должен содержать колонки: №, Песня, Артист")
         print("\nОпции:")
         print("  --no-normalize  Отключить нормализацию громкости (по умолчанию включена)")
+        print("  --loudness=MODE track - каждый трек к -16 LUFS (по умолчанию); album или playlist -")
+        print("                  общий gain альбома/плейлиста, сохраняет разницу громкости между треками")
+        print("  --gain=MODE     Для album/playlist: tags - теги ReplayGain (по умолчанию), apply - перекодировать")
+        print(f"  --format=FMT    Формат: {', '.join(OUTPUT_FORMATS)} (по умолчанию {DEFAULT_OUTPUT_FORMAT});")
+        print("                  opus/m4a/native сохраняют поток YouTube без перекодирования в MP3")
+        print("  --format=mp3:320k,opus:128k  Несколько форматов из одного скачивания и декодирования")
+        print("                  (каждый в подпапку папки плейлиста; битрейт необязателен)")
+        print("  --report=DIR    Сохранить трассу (run_trace.jsonl) и сводку (run_summary.json) прогона")
+        print("  --prometheus=FILE  Записать метрики прогона в textfile для Prometheus")
+        print("  --workers=N     Скачивать до N треков параллельно (подстраивается под троттлинг YouTube)")
+        print(f"  --rate=R        Общий лимит запросов к YouTube в секунду (по умолчанию {throttle.DEFAULT_REQUEST_RATE})")
+        print("  --bandwidth=S   Общий бюджет полосы скачиваний на хосте: 2M или по времени суток")
+        print("                  08:00-19:00=2M,19:00-08:00=20M; off - снять ограничение")
+        print("                  (действует, пока идёт прогон; с --bandwidth-persist - и после него)")
+        print("  --daemon[=URL]  Отправить задание запущенному демону (music_daemon.py) и следить за ним")
+        print("  --resolve[=FILE]  Только выбрать видео для всех треков и записать манифест")
+        print("                  (по умолчанию <csv>.manifest.json), ничего не скачивая")
+        print("  --manifest=FILE Скачать по манифесту --resolve без повторного поиска")
+        print("  --record-corpus=FILE  Дописать кандидатов поиска треков в корпус ranking.py --bench")
+        print("  --verify        Проверить скачанные файлы (обрезанные, битые, тихие, ненормализованные)")
+        print("  --repair        Вместе с --verify: удалить проблемные файлы и скачать только их заново")
+        print("  --recheck       Не пропускать треки, которые раньше не нашлись или не скачались")
+        print(f"  --hedge[=SEC]   Если поиск не дал официального видео за SEC секунд (по умолчанию {DEFAULT_HEDGE_DELAY:.0f}),")
+        print("                  параллельно запустить запасной запрос и взять первый хороший ответ")
+        print("  --profile[=DIR] Профилировать прогон (pstats, collapsed-стеки, разбивка по этапам)")
+        print("  --profile-memory  Дополнительно снимать tracemalloc на границах этапов")
         sys.exit(1)
 
     # Парсим флаги
     normalize = '--no-normalize' not in sys.argv
+    output_format = get_option(sys.argv, 'format', DEFAULT_OUTPUT_FORMAT)
+    try:
+        parse_output_formats(output_format)
+    except ValueError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    report_dir = get_option(sys.argv, 'report')
+    prometheus_path = get_option(sys.argv, 'prometheus')
+    profile_dir, profile_memory = profiling.get_profile_options(sys.argv)
+    workers = int(get_option(sys.argv, 'workers', 1))
+    rate = get_option(sys.argv, 'rate')
+    if rate:
+        throttle.configure_request_limiter(float(rate))
+    bandwidth = get_option(sys.argv, 'bandwidth')
+    if bandwidth:
+        try:
+            throttle.configure_bandwidth(bandwidth, persist='--bandwidth-persist' in sys.argv)
+        except ValueError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+    hedge_delay = DEFAULT_HEDGE_DELAY if '--hedge' in sys.argv else get_option(sys.argv, 'hedge')
+    hedge_delay = float(hedge_delay) if hedge_delay is not None else None
+
+    loudness = get_option(sys.argv, 'loudness', 'track')
+    gain_mode = get_option(sys.argv, 'gain', 'tags')
+    if loudness not in album_gain.LOUDNESS_MODES or gain_mode not in album_gain.GAIN_MODES:
+        print(f"❌ Неизвестный режим громкости: --loudness={loudness} --gain={gain_mode}")
+        sys.exit(1)
 
     # Убираем флаги из аргументов
     args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
@@ -385,28 +1823,99 @@ def main():
         print(f"❌ Файл не найден: {csv_path}")
         sys.exit(1)
 
+    # Режим resolve: только выбор видео, скачивание позже по манифесту
+    if '--resolve' in sys.argv or get_option(sys.argv, 'resolve'):
+        manifest_path = get_option(sys.argv, 'resolve') or default_manifest_path(csv_path)
+        cancel_token = CancelToken()
+        signal.signal(signal.SIGINT, lambda signum, frame: cancel_token.cancel())
+        try:
+            manifest = resolve_playlist(csv_path, workers=int(get_option(sys.argv, 'workers', RESOLVE_WORKERS)),
+                                        cancel_token=cancel_token, hedge_delay=hedge_delay)
+        except OperationCancelled:
+            print("\n⏹️  Отменено")
+            sys.exit(1)
+        write_manifest(manifest, manifest_path)
+        print(f"📝 Манифест: {manifest_path}")
+        return
+
+    # Запись корпуса для ranking.py --bench: только поиск, без скачивания
+    corpus_path = get_option(sys.argv, 'record-corpus')
+    if corpus_path:
+        added = record_ranking_corpus(csv_path, corpus_path)
+        print(f"📼 Записано в {corpus_path}: {added}")
+        return
+
+    # Режим fetch: видео уже выбраны в манифесте
+    manifest_path = get_option(sys.argv, 'manifest')
+    manifest = load_manifest(manifest_path) if manifest_path else None
+
     # Извлекаем название плейлиста из CSV
     playlist_name = extract_playlist_name(csv_path)
 
-    # Папка для сохранения
-    if len(args) > 1:
-        # Если указана явно
-        output_dir = args[1]
-    elif playlist_name:
-        # Используем название плейлиста
-        safe_name = re.sub(r'[^\w\s-]', '', playlist_name).strip().replace(' ', '_')
-        output_dir = str(Path(csv_path).parent / safe_name)
+    # Папка для сохранения: указанная явно или по названию плейлиста
+    output_dir = args[1] if len(args) > 1 else default_output_dir(csv_path, playlist_name)
+    if len(args) <= 1 and playlist_name:
         print(f"📀 Плейлист: {playlist_name}")
-    else:
-        # По умолчанию
-        output_dir = str(Path(csv_path).parent / "Downloaded_Music")
 
     print(f"📂 CSV файл: {csv_path}")
     print(f"📁 Папка для сохранения: {output_dir}")
+    print(f"🎼 Формат: {output_format}")
+    if manifest_path:
+        print(f"📝 Манифест: {manifest_path}")
     print(f"🔊 Нормализация громкости: {'включена' if normalize else 'отключена'}\n")
 
+    # Проверка библиотеки: с --repair проблемные файлы удаляются и скачиваются заново ниже
+    if '--verify' in sys.argv:
+        import library_verify
+
+        verify_manifest = manifest
+        if verify_manifest is None and Path(default_manifest_path(csv_path)).exists():
+            verify_manifest = load_manifest(default_manifest_path(csv_path))
+        cancel_token = CancelToken()
+        signal.signal(signal.SIGINT, lambda signum, frame: cancel_token.cancel())
+        try:
+            report = library_verify.verify_library(
+                csv_path, output_dir, output_format=output_format, normalize=normalize, manifest=verify_manifest,
+                workers=int(get_option(sys.argv, 'workers', library_verify.VERIFY_WORKERS)), cancel_token=cancel_token
+            )
+        except OperationCancelled:
+            print("\n⏹️  Отменено")
+            sys.exit(1)
+        for line in library_verify.format_report(report):
+            print(line)
+        if '--repair' not in sys.argv or not report['broken']:
+            sys.exit(1 if report['broken'] else 0)
+        removed = library_verify.remove_broken(report)
+        print(f"\n🔧 Удалено проблемных файлов: {removed}, скачиваю заново\n")
+
+    # Режим клиента: всё делает демон с тёплым состоянием и общим лимитом
+    daemon_url = get_daemon_url(sys.argv)
+    if daemon_url and manifest:
+        print("❌ --manifest пока не поддерживается вместе с --daemon")
+        sys.exit(1)
+    if daemon_url:
+        download_via_daemon(daemon_url, csv_path, output_dir, normalize=normalize,
+                            output_format=output_format, report_dir=report_dir,
+                            loudness=loudness, gain_mode=gain_mode)
+        return
+
+    # Ctrl+C: сразу завершаем yt-dlp/ffmpeg и убираем недокачанные файлы
+    cancel_token = CancelToken()
+    signal.signal(signal.SIGINT, lambda signum, frame: cancel_token.cancel())
+
     # Запускаем скачивание
-    download_from_csv(csv_path, output_dir, normalize=normalize)
+    def run():
+        download_from_csv(csv_path, output_dir, normalize=normalize,
+                          report_dir=report_dir, prometheus_path=prometheus_path, workers=workers,
+                          cancel_token=cancel_token, output_format=output_format, manifest=manifest,
+                          hedge_delay=hedge_delay, recheck_failed='--recheck' in sys.argv,
+                          loudness=loudness, gain_mode=gain_mode)
+
+    if profile_dir:
+        with profiling.profiled(profile_dir, memory=profile_memory):
+            run()
+    else:
+        run()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+"""
+Fingerprint
+Акустические отпечатки треков библиотеки (NumPy): одинаковые записи под разными
+id видео заменяются жёсткими ссылками, а файлы, звучащие как другой трек или
+как другая версия того же трека, попадают в отчёт
+"""
+
+import hashlib
+import itertools
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+try:
+    import numpy as np
+except ImportError:  # без numpy отпечатки недоступны (остальное приложение работает)
+    np = None
+
+from app_cache import get_cache_dir, load_json, locked_json
+from process_runner import CommandTimeoutError, run_command
+
+# Версия алгоритма: отпечатки другой версии считаются заново
+FINGERPRINT_VERSION = 2
+
+# Декодирование: моно 11025 Гц, первые FINGERPRINT_SECONDS секунд трека
+SAMPLE_RATE = 11025
+FINGERPRINT_SECONDS = 120
+
+# Кадр FFT и шаг между кадрами (отсчёты): ~0.37 с кадр, ~0.023 с шаг.
+# Кадры сильно перекрываются, чтобы сдвиг записи на долю кадра почти не менял биты
+FRAME_SIZE = 4096
+HOP_SIZE = 256
+
+# 33 полосы в логарифмической шкале 300-2000 Гц дают 32 бита на кадр (Haitsma-Kalker)
+BAND_COUNT = 33
+BAND_RANGE = (300.0, 2000.0)
+
+# Доля несовпавших бит, ниже которой два файла - одна запись
+MATCH_BIT_ERROR_RATE = 0.25
+
+# Поиск выравнивания: сдвиг до MAX_OFFSET кадров (~4.6 с тишины или вступления)
+MAX_OFFSET = 200
+
+# Кандидаты на сравнение: сколько одинаковых 32-битных кадров должно совпасть
+MIN_SHARED_FRAMES = 20
+
+# Кадры, встречающиеся у большего числа файлов, не используются для поиска (тишина и т.п.)
+MAX_BUCKET_FILES = 50
+
+# Сколько файлов обрабатывать одновременно (декодирование и FFT в отдельных процессах)
+FINGERPRINT_WORKERS = os.cpu_count() or 4
+
+# Таймаут декодирования одного файла (секунды)
+DECODE_TIMEOUT = 300
+
+# Таймаут чтения тегов перед связыванием копий (секунды)
+PROBE_TIMEOUT = 60
+
+# Расширения треков библиотеки
+AUDIO_EXTENSIONS = ('.mp3', '.opus', '.m4a', '.ogg')
+
+# Имя файла трека: "01. Artist - Track"
+TRACK_NAME_PATTERN = re.compile(r'^\d+\.\s+(?P<artist>.+?)\s+-\s+(?P<title>.+)$')
+
+
+def is_available():
+    """True если установлен numpy"""
+    return np is not None
+
+
+def file_hash(path):
+    """SHA-256 содержимого файла"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def song_key(path):
+    """
+    Ключ трека по имени файла: артист и название в нижнем регистре без номера
+
+    Returns:
+        Строка или None, если имя не в формате "NN. Artist - Track"
+    """
+    match = TRACK_NAME_PATTERN.match(Path(path).stem)
+    if not match:
+        return None
+    return f"{match.group('artist').lower()}|{match.group('title').lower()}"
+
+
+def decode_pcm(path):
+    """
+    Декодирует начало трека в моно PCM
+
+    Returns:
+        numpy.ndarray float32 в диапазоне [-1, 1]
+
+    Raises:
+        CommandTimeoutError: ffmpeg превысил таймаут или завис
+        subprocess.CalledProcessError: файл не декодируется
+    """
+    # run_command читает вывод как текст, поэтому PCM идёт через временный файл
+    with tempfile.TemporaryDirectory(prefix='fingerprint-') as temp_dir:
+        pcm_path = Path(temp_dir) / 'audio.pcm'
+        run_command(
+            ['ffmpeg', '-nostdin', '-v', 'error', '-i', str(path), '-t', str(FINGERPRINT_SECONDS),
+             '-map', '0:a:0', '-ac', '1', '-ar', str(SAMPLE_RATE), '-f', 's16le', '-y', str(pcm_path)],
+            timeout=DECODE_TIMEOUT, stall_timeout=DECODE_TIMEOUT
+        )
+        samples = np.fromfile(pcm_path, dtype='<i2')
+    return samples.astype(np.float32) / 32768.0
+
+
+def _band_edges():
+    """Границы полос в номерах бинов FFT"""
+    edges_hz = np.geomspace(BAND_RANGE[0], BAND_RANGE[1], BAND_COUNT + 1)
+    return np.round(edges_hz * FRAME_SIZE / SAMPLE_RATE).astype(np.int64)
+
+
+def compute_fingerprint(samples):
+    """
+    Отпечаток из PCM: по 32 бита на кадр
+
+    Бит m кадра n - знак разности энергий соседних полос, взятой как
+    разность между кадрами n и n-1. Все кадры считаются одним rfft по
+    матрице окон, без циклов по кадрам.
+
+    Returns:
+        numpy.ndarray uint32 (пустой, если трек короче кадра)
+    """
+    if len(samples) < FRAME_SIZE + HOP_SIZE:
+        return np.zeros(0, dtype=np.uint32)
+
+    frames = np.lib.stride_tricks.sliding_window_view(samples, FRAME_SIZE)[::HOP_SIZE]
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(FRAME_SIZE).astype(np.float32), axis=1)) ** 2
+
+    edges = _band_edges()
+    # Без среза последняя полоса reduceat тянулась бы до частоты Найквиста
+    energy = np.add.reduceat(spectrum[:, :edges[-1]], edges[:-1], axis=1)
+
+    band_diff = energy[:, :-1] - energy[:, 1:]
+    bits = (band_diff[1:] - band_diff[:-1]) > 0
+    weights = (np.uint32(1) << np.arange(BAND_COUNT - 1, dtype=np.uint32))
+    return (bits.astype(np.uint32) * weights).sum(axis=1, dtype=np.uint32)
+
+
+def bit_error_rate(first, second, max_offset=MAX_OFFSET):
+    """
+    Доля несовпавших бит при лучшем сдвиге одного отпечатка относительно другого
+
+    Returns:
+        float от 0 (одинаковые) до ~0.5 (разные записи); 1.0, если сравнить нечего
+    """
+    best = 1.0
+    for offset in range(-max_offset, max_offset + 1):
+        a = first[max(0, offset):]
+        b = second[max(0, -offset):]
+        overlap = min(len(a), len(b))
+        if overlap < MIN_SHARED_FRAMES:
+            continue
+        errors = np.unpackbits((a[:overlap] ^ b[:overlap]).view(np.uint8)).sum()
+        best = min(best, errors / (overlap * 32))
+    return best
+
+
+def fingerprint_filename(digest):
+    """Имя файла отпечатка: хеш содержимого и версия алгоритма"""
+    return f"{digest}.v{FINGERPRINT_VERSION}.npy"
+
+
+def fingerprint_file(path, cache_dir):
+    """
+    Хеширует файл и считает отпечаток (выполняется в процессе пула)
+
+    Отпечаток сохраняется в cache_dir/<sha256>.v<версия>.npy; если файл с таким же
+    содержимым уже обработан, декодирование пропускается.
+
+    Returns:
+        (путь, sha256, ошибка или None)
+    """
+    try:
+        digest = file_hash(path)
+        fingerprint_path = Path(cache_dir) / fingerprint_filename(digest)
+        if not fingerprint_path.exists():
+            fingerprint = compute_fingerprint(decode_pcm(path))
+            temp_path = fingerprint_path.with_name(f".{digest}.{os.getpid()}.npy")
+            np.save(temp_path, fingerprint)
+            os.replace(temp_path, fingerprint_path)
+        return str(path), digest, None
+    except Exception as e:
+        return str(path), None, str(e).strip().splitlines()[-1] if str(e).strip() else type(e).__name__
+
+
+class FingerprintIndex:
+    """
+    Индекс отпечатков библиотеки, общий для всех процессов
+
+    index.json: {version, files: {путь: {size, mtime_ns, hash}}}, отпечатки -
+    <sha256 файла>.v<версия>.npy рядом. Файл хешируется заново только при изменении
+    размера или времени изменения, отпечаток считается один раз на содержимое.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = Path(cache_dir) if cache_dir else get_cache_dir('fingerprint')
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.path = self.cache_dir / 'index.json'
+        index = load_json(self.path, {})
+        self.files = index.get('files', {}) if index.get('version') == FINGERPRINT_VERSION else {}
+
+    def cached_hash(self, path):
+        """sha256 файла из индекса или None, если файл изменился"""
+        entry = self.files.get(str(path))
+        stat = Path(path).stat()
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            if (self.cache_dir / fingerprint_filename(entry['hash'])).exists():
+                return entry['hash']
+        return None
+
+    def update(self, path, digest):
+        """Запоминает хеш файла с текущими размером и временем изменения"""
+        stat = Path(path).stat()
+        self.files[str(path)] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': digest}
+
+    def load(self, digest):
+        """Отпечаток по хешу файла"""
+        return np.load(self.cache_dir / fingerprint_filename(digest))
+
+    def save(self):
+        """Записывает индекс (записи исчезнувших файлов удаляются)"""
+        with locked_json(self.path, {}) as index:
+            files = index.get('files', {}) if index.get('version') == FINGERPRINT_VERSION else {}
+            files.update(self.files)
+            index['version'] = FINGERPRINT_VERSION
+            index['files'] = {path: entry for path, entry in files.items() if Path(path).exists()}
+
+
+def find_audio_files(roots):
+    """Треки во всех папках (рекурсивно), без временных файлов"""
+    files = []
+    for root in roots:
+        for path in sorted(Path(root).rglob('*')):
+            if path.suffix.lower() in AUDIO_EXTENSIONS and '.tmp.' not in path.name and path.is_file():
+                files.append(path.resolve())
+    return files
+
+
+def candidate_pairs(fingerprints):
+    """
+    Пары файлов, у которых совпадает много 32-битных кадров (быстрый поиск без сравнения всех со всеми)
+
+    Args:
+        fingerprints: список отпечатков
+
+    Returns:
+        set пар индексов (i, j), i < j
+    """
+    lengths = [len(fingerprint) for fingerprint in fingerprints]
+    if not sum(lengths):
+        return set()
+    values = np.concatenate(fingerprints)
+    owners = np.repeat(np.arange(len(fingerprints)), lengths)
+
+    # Уникальные пары (значение кадра, файл), отсортированные по значению
+    order = np.lexsort((owners, values))
+    values, owners = values[order], owners[order]
+    keep = np.ones(len(values), dtype=bool)
+    keep[1:] = (values[1:] != values[:-1]) | (owners[1:] != owners[:-1])
+    values, owners = values[keep], owners[keep]
+
+    starts = np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+    sizes = np.diff(np.r_[starts, len(values)])
+    shared = Counter()
+    for start, size in zip(starts[(sizes > 1) & (sizes <= MAX_BUCKET_FILES)],
+                           sizes[(sizes > 1) & (sizes <= MAX_BUCKET_FILES)]):
+        shared.update(itertools.combinations(owners[start:start + size].tolist(), 2))
+    return {pair for pair, count in shared.items() if count >= MIN_SHARED_FRAMES}
+
+
+def scan_library(roots, workers=FINGERPRINT_WORKERS, log_callback=None):
+    """
+    Отпечатки всех треков и сравнение: дубликаты, чужие треки, другие версии
+
+    Args:
+        roots: папки библиотеки
+        workers: размер пула процессов
+        log_callback: функция для вывода логов (по умолчанию print)
+
+    Returns:
+        dict: files, computed, errors, duplicates (пары одной записи одного трека),
+        wrong_song (одна запись под разными треками), version_mismatch (один трек,
+        разные записи)
+    """
+    log = log_callback or print
+    index = FingerprintIndex()
+    files = find_audio_files(roots)
+    hashes = {}
+    pending = []
+    for path in files:
+        digest = index.cached_hash(path)
+        if digest:
+            hashes[path] = digest
+        else:
+            pending.append(path)
+
+    log(f"🔍 Отпечатки: {len(files)} файлов, посчитать {len(pending)} ({workers} процессов)...")
+    started = time.monotonic()
+    errors = {}
+    try:
+        if pending:
+            with ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+                for path, digest, error in pool.map(fingerprint_file, pending, itertools.repeat(index.cache_dir),
+                                                    chunksize=4):
+                    if error:
+                        errors[path] = error
+                        log(f"   ⚠️  {Path(path).name}: {error}")
+                    else:
+                        hashes[Path(path)] = digest
+                        index.update(path, digest)
+    finally:
+        index.save()
+
+    paths = [path for path in files if path in hashes]
+    fingerprints = [index.load(hashes[path]) for path in paths]
+    keys = [song_key(path) for path in paths]
+
+    # Сравниваем кандидатов по кадрам и все файлы с одинаковым ключом трека
+    pairs = candidate_pairs(fingerprints)
+    by_key = {}
+    for position, key in enumerate(keys):
+        if key:
+            by_key.setdefault(key, []).append(position)
+    for positions in by_key.values():
+        pairs.update(itertools.combinations(positions, 2))
+
+    matches = set()
+    for i, j in pairs:
+        if hashes[paths[i]] == hashes[paths[j]] or \
+                bit_error_rate(fingerprints[i], fingerprints[j]) < MATCH_BIT_ERROR_RATE:
+            matches.add((i, j))
+
+    duplicates = []
+    wrong_song = []
+    for i, j in sorted(matches):
+        if keys[i] and keys[i] == keys[j]:
+            # Уже связанные жёсткой ссылкой копии места не занимают
+            if not os.path.samefile(paths[i], paths[j]):
+                duplicates.append((str(paths[i]), str(paths[j])))
+        else:
+            wrong_song.append((str(paths[i]), str(paths[j])))
+
+    # Один трек, несколько файлов: всё, что не совпало с самой большой группой одной записи
+    version_mismatch = []
+    for positions in by_key.values():
+        if len(positions) < 2:
+            continue
+        clusters = {position: {position} for position in positions}
+        for i, j in itertools.combinations(positions, 2):
+            if (i, j) in matches:
+                merged = clusters[i] | clusters[j]
+                for position in merged:
+                    clusters[position] = merged
+        largest = max((clusters[position] for position in positions), key=len)
+        if len(largest) == len(positions):
+            continue
+        # Без большинства (две разные записи) под подозрением оба файла
+        suspects = positions if len(largest) * 2 <= len(positions) else \
+            [position for position in positions if position not in largest]
+        version_mismatch.append([str(paths[position]) for position in suspects])
+
+    log(f"✅ Готово за {time.monotonic() - started:.1f}s: посчитано {len(pending) - len(errors)}, "
+        f"дубликатов {len(duplicates)}, чужих треков {len(wrong_song)}, разных версий {len(version_mismatch)}")
+    return {
+        'files': len(files),
+        'computed': len(pending) - len(errors),
+        'errors': errors,
+        'duplicates': duplicates,
+        'wrong_song': wrong_song,
+        'version_mismatch': version_mismatch,
+    }
+
+
+def read_tags(path):
+    """
+    Теги файла через ffprobe (ключи в нижнем регистре)
+
+    Returns:
+        dict тегов или None, если файл не прочитать
+    """
+    try:
+        result = run_command(['ffprobe', '-v', 'error', '-show_entries', 'format_tags', '-of', 'json', str(path)],
+                             timeout=PROBE_TIMEOUT, stall_timeout=PROBE_TIMEOUT)
+        tags = json.loads(result.stdout or '{}').get('format', {}).get('tags') or {}
+    except (OSError, ValueError, subprocess.CalledProcessError, CommandTimeoutError):
+        return None
+    return {key.lower(): value for key, value in tags.items()}
+
+
+def link_duplicates(duplicates, log_callback=None):
+    """
+    Заменяет копии одной записи жёсткими ссылками на один файл
+
+    Связываются только файлы одного формата на одной файловой системе и только
+    с одинаковыми тегами: у ссылок общие теги, и номер трека или gain другого
+    плейлиста иначе был бы потерян. album_gain перед записью тегов на месте
+    превращает ссылку обратно в отдельный файл.
+
+    Returns:
+        Сколько байт освобождено
+    """
+    log = log_callback or print
+    saved = 0
+    for keep, duplicate in duplicates:
+        keep, duplicate = Path(keep), Path(duplicate)
+        if keep.suffix != duplicate.suffix or not keep.exists() or not duplicate.exists():
+            continue
+        keep_stat, duplicate_stat = keep.stat(), duplicate.stat()
+        if keep_stat.st_ino == duplicate_stat.st_ino or keep_stat.st_dev != duplicate_stat.st_dev:
+            continue
+        keep_tags = read_tags(keep)
+        if keep_tags is None or keep_tags != read_tags(duplicate):
+            log(f"   ⏭️  {duplicate}: теги отличаются от {keep.name} (номер трека, альбом или gain), не связан")
+            continue
+        temp_path = duplicate.with_name(f".{duplicate.name}.link")
+        os.link(keep, temp_path)
+        os.replace(temp_path, duplicate)
+        saved += duplicate_stat.st_size
+        log(f"   🔗 {duplicate} -> {keep.name}")
+    return saved
+
+
+def main():
+    """Главная функция"""
+    roots = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if not roots:
+        print("Использование:")
+        print(f"  python3 {sys.argv[0]} <папка> [папка...] [--link] [--workers=N]")
+        print("\nОпции:")
+        print("  --link        Заменить копии одной записи одного трека жёсткими ссылками")
+        print(f"  --workers=N   Процессов для отпечатков (по умолчанию {FINGERPRINT_WORKERS})")
+        sys.exit(1)
+    if not is_available():
+        print("❌ Для отпечатков нужен numpy: pip3 install numpy")
+        sys.exit(1)
+
+    workers = FINGERPRINT_WORKERS
+    for arg in sys.argv[1:]:
+        if arg.startswith('--workers='):
+            workers = int(arg.split('=', 1)[1])
+
+    report = scan_library(roots, workers=workers)
+    for first, second in report['wrong_song']:
+        print(f"   ❓ Одна запись под разными треками:\n      {first}\n      {second}")
+    for paths in report['version_mismatch']:
+        print("   🎤 Другая версия (live, ремикс или не тот трек):")
+        for path in paths:
+            print(f"      {path}")
+    if report['duplicates']:
+        if '--link' in sys.argv:
+            saved = link_duplicates(report['duplicates'])
+            print(f"🔗 Освобождено: {saved / 1024 ** 2:.1f} MiB")
+        else:
+            print(f"💡 Копий одной записи: {len(report['duplicates'])} (--link заменит их жёсткими ссылками)")
+
+
+if __name__ == "__main__":
+    main()
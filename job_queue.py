@@ -0,0 +1,803 @@
+#!/usr/bin/env python3
+"""
+Job Queue
+Надёжная очередь заданий в SQLite: плейлисты с приоритетами и задачи по трекам,
+справедливое разделение между плейлистами и продолжение после перезапуска.
+Задачи выдаются в аренду (lease) на время, поэтому очередь в общей папке
+могут разбирать несколько процессов и машин: задачи упавшего узла
+возвращаются в очередь, когда истекает аренда.
+"""
+
+import json
+import os
+import signal
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import album_gain
+import download_music
+import profiling
+import throttle
+from app_cache import get_cache_dir
+from process_runner import CancelToken, OperationCancelled
+from run_metrics import RunMetrics
+
+# Приоритеты заданий: больше - раньше
+PRIORITIES = {
+    'interactive': 10,  # запросы из GUI
+    'normal': 0,
+    'batch': -10,       # ночная синхронизация
+}
+
+# Сколько раз задача трека возвращается в очередь после временных ошибок
+MAX_TASK_ATTEMPTS = 3
+
+# Пауза перед повтором задачи, вернувшейся в очередь (секунды)
+TASK_RETRY_DELAY = 30.0
+
+# Как часто исполнитель проверяет очередь, когда задач нет (секунды)
+POLL_INTERVAL = 2.0
+
+# Срок аренды задачи (секунды): исполнитель продлевает её, пока трек в работе,
+# а задачу узла, который перестал продлевать аренду, забирает другой узел
+LEASE_DURATION = 300.0
+
+# Как часто продлевается аренда (доля срока аренды)
+LEASE_RENEW_FRACTION = 1 / 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT,
+    output_dir TEXT NOT NULL,
+    options TEXT NOT NULL DEFAULT '{}',
+    priority INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL DEFAULT 'queued',
+    total INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    finished_at REAL,
+    last_served_at REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id INTEGER NOT NULL REFERENCES jobs(id),
+    num TEXT NOT NULL,
+    song TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    error TEXT,
+    updated_at REAL,
+    UNIQUE (job_id, num)
+);
+CREATE INDEX IF NOT EXISTS tasks_by_state ON tasks (state, job_id);
+"""
+
+# Задание: queued (ждёт), running (есть взятые задачи), done, cancelled
+# Задача: pending, running, ok, skipped, failed, cancelled
+TASK_FINISHED_STATES = ('ok', 'skipped', 'failed', 'cancelled')
+
+
+def worker_id():
+    """Идентификатор исполнителя: хост и pid"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def number_songs(songs):
+    """
+    Уникальные номера треков для задач очереди
+
+    Задача определяется парой (задание, номер), а по номеру называется файл,
+    поэтому трекам без номера и с повторным номером выдаются свободные
+    номера после уже занятых.
+
+    Args:
+        songs: список строк CSV
+
+    Returns:
+        (songs, renumbered) - копии строк с уникальным '№' и число перенумерованных
+    """
+    taken = {song.get('№', '').strip().zfill(2) for song in songs if song.get('№', '').strip()}
+    used = set()
+    next_number = 1
+    numbered = []
+    renumbered = 0
+    for song in songs:
+        num = song.get('№', '').strip()
+        if num and num.zfill(2) not in used:
+            used.add(num.zfill(2))
+        else:
+            while str(next_number).zfill(2) in taken or str(next_number).zfill(2) in used:
+                next_number += 1
+            num = str(next_number)
+            used.add(num.zfill(2))
+            renumbered += 1
+        numbered.append({**song, '№': num})
+    return numbered, renumbered
+
+
+def is_local_worker_alive(worker):
+    """
+    Жив ли исполнитель на этом хосте
+
+    Returns:
+        True/False для исполнителей этого хоста, None для чужих хостов
+    """
+    host, _, pid = (worker or '').rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return None
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobQueue:
+    """
+    Очередь заданий (плейлистов) и задач (треков) в SQLite
+
+    Все изменения - короткие транзакции (BEGIN IMMEDIATE), поэтому очередь можно
+    использовать из нескольких потоков и процессов. Задача выдаётся одному
+    исполнителю в аренду на lease_duration секунд; если аренда не продлена
+    (процесс или машина упали), задачу забирает следующий claim_task().
+    Готовые треки не скачиваются повторно (их файлы уже на диске).
+    """
+
+    def __init__(self, db_path=None, shared=False, lease_duration=LEASE_DURATION):
+        """
+        Args:
+            db_path: файл очереди (по умолчанию в кэше приложения)
+            shared: очередь в сетевой папке (NFS/SMB), которую разбирают несколько машин;
+                WAL там не работает, используется обычный журнал отката
+            lease_duration: срок аренды задачи (секунды)
+        """
+        self.db_path = Path(db_path) if db_path else get_cache_dir('queue') / 'jobs.db'
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.shared = shared
+        self.lease_duration = lease_duration
+        self._local = threading.local()
+        # executescript сам фиксирует транзакцию, CREATE ... IF NOT EXISTS идемпотентны
+        db = self._connect()
+        db.executescript(SCHEMA)
+        # Очереди, созданные до появления аренды
+        columns = {row['name'] for row in db.execute('PRAGMA table_info(tasks)')}
+        if 'lease_expires' not in columns:
+            db.execute('ALTER TABLE tasks ADD COLUMN lease_expires REAL')
+
+    def _connect(self):
+        """Соединение текущего потока (sqlite3 не делит соединения между потоками)"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            # WAL требует общей памяти и работает только на локальном диске
+            db.execute('PRAGMA journal_mode=DELETE' if self.shared else 'PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=FULL' if self.shared else 'PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def _transaction(self):
+        """Транзакция с блокировкой на запись с самого начала"""
+        return _Transaction(self._connect())
+
+    def add_job(self, songs, output_dir, priority='normal', options=None, name=None):
+        """
+        Ставит плейлист в очередь
+
+        Args:
+            songs: список строк CSV (dict со столбцами №, Песня, Артист, Альбом)
+            output_dir: папка для сохранения
+            priority: ключ PRIORITIES или число
+            options: настройки скачивания (normalize, output_format, report_dir)
+            name: название плейлиста
+
+        Returns:
+            id задания
+        """
+        priority = PRIORITIES.get(priority, priority)
+        songs, renumbered = number_songs(songs)
+        if renumbered:
+            print(f"⚠️  Треков без номера или с повторным номером: {renumbered}, выданы свободные номера")
+        now = time.time()
+        with self._transaction() as db:
+            cursor = db.execute(
+                'INSERT INTO jobs (name, output_dir, options, priority, total, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (name, str(Path(output_dir).resolve()), json.dumps(options or {}, ensure_ascii=False),
+                 int(priority), len(songs), now)
+            )
+            job_id = cursor.lastrowid
+            db.executemany(
+                'INSERT INTO tasks (job_id, num, song, updated_at) VALUES (?, ?, ?, ?)',
+                [(job_id, song.get('№', '').zfill(2), json.dumps(song, ensure_ascii=False), now) for song in songs]
+            )
+        return job_id
+
+    def claim_task(self, worker=None):
+        """
+        Выдаёт следующую задачу
+
+        Порядок: сначала задания с большим приоритетом, внутри приоритета -
+        по кругу (задание, которое дольше всех не обслуживалось), внутри
+        задания - по номеру трека. Поэтому большой плейлист не задерживает
+        маленькие: они получают свою долю исполнителей сразу.
+
+        Перед выдачей в очередь возвращаются задачи с истёкшей арендой.
+
+        Args:
+            worker: идентификатор исполнителя (по умолчанию хост:pid)
+
+        Returns:
+            dict задачи (id, job_id, num, song, attempts, output_dir, options, lease_expires) или None
+        """
+        now = time.time()
+        with self._transaction() as db:
+            self._reclaim_expired(db, now)
+            row = db.execute(
+                '''
+                SELECT t.id, t.job_id, t.num, t.song, t.attempts, j.output_dir, j.options, j.name
+                FROM tasks t JOIN jobs j ON j.id = t.job_id
+                WHERE t.state = 'pending' AND t.not_before <= ? AND j.state IN ('queued', 'running')
+                ORDER BY j.priority DESC, j.last_served_at ASC, t.id ASC
+                LIMIT 1
+                ''',
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            lease_expires = now + self.lease_duration
+            db.execute(
+                "UPDATE tasks SET state = 'running', worker = ?, lease_expires = ?, updated_at = ? WHERE id = ?",
+                (worker or worker_id(), lease_expires, now, row['id'])
+            )
+            db.execute(
+                "UPDATE jobs SET state = 'running', last_served_at = ? WHERE id = ?",
+                (now, row['job_id'])
+            )
+
+        task = dict(row)
+        task['song'] = json.loads(task['song'])
+        task['options'] = json.loads(task['options'])
+        task['lease_expires'] = lease_expires
+        return task
+
+    def _reclaim_expired(self, db, now):
+        """
+        Возвращает в очередь задачи, аренду которых исполнитель перестал продлевать
+
+        Попытка засчитывается: если трек роняет исполнителя, следующая
+        попытка станет последней, а не будет повторяться бесконечно.
+        """
+        db.execute(
+            "UPDATE tasks SET state = 'pending', worker = NULL, lease_expires = NULL, attempts = attempts + 1, "
+            "error = 'аренда истекла', updated_at = ? "
+            "WHERE state = 'running' AND COALESCE(lease_expires, 0) < ?",
+            (now, now)
+        )
+
+    def renew_leases(self, worker):
+        """
+        Продлевает аренду всех задач исполнителя
+
+        Returns:
+            Сколько задач продлено
+        """
+        now = time.time()
+        with self._transaction() as db:
+            return db.execute(
+                "UPDATE tasks SET lease_expires = ? WHERE state = 'running' AND worker = ?",
+                (now + self.lease_duration, worker)
+            ).rowcount
+
+    def complete_task(self, task_id, outcome, error=None, worker=None):
+        """
+        Записывает результат задачи
+
+        Args:
+            outcome: 'ok', 'skipped', 'failed', 'cancelled' или 'retry'
+                ('retry' возвращает задачу в очередь с паузой, пока не кончатся попытки)
+            worker: исполнитель; если аренда уже перешла к другому узлу, результат не записывается
+
+        Returns:
+            id задания, если оно завершилось этой задачей, иначе None
+        """
+        now = time.time()
+        with self._transaction() as db:
+            task = db.execute('SELECT job_id, attempts, state, worker FROM tasks WHERE id = ?', (task_id,)).fetchone()
+            if task is None:
+                return None
+            if worker and (task['state'] != 'running' or task['worker'] != worker):
+                return None
+
+            if outcome == 'retry':
+                attempts = task['attempts'] + 1
+                if attempts >= MAX_TASK_ATTEMPTS:
+                    outcome = 'failed'
+                else:
+                    db.execute(
+                        "UPDATE tasks SET state = 'pending', attempts = ?, not_before = ?, worker = NULL, "
+                        "lease_expires = NULL, error = ?, updated_at = ? WHERE id = ?",
+                        (attempts, now + TASK_RETRY_DELAY, error, now, task_id)
+                    )
+                    return None
+
+            db.execute(
+                'UPDATE tasks SET state = ?, worker = NULL, lease_expires = NULL, error = ?, updated_at = ? WHERE id = ?',
+                (outcome, error, now, task_id)
+            )
+            return self._finish_job_if_done(db, task['job_id'])
+
+    def _finish_job_if_done(self, db, job_id):
+        """Помечает задание выполненным, если задач в работе не осталось"""
+        remaining = db.execute(
+            "SELECT COUNT(*) FROM tasks WHERE job_id = ? AND state IN ('pending', 'running')", (job_id,)
+        ).fetchone()[0]
+        if remaining:
+            return None
+        updated = db.execute(
+            "UPDATE jobs SET state = 'done', finished_at = ? WHERE id = ? AND state IN ('queued', 'running')",
+            (time.time(), job_id)
+        )
+        return job_id if updated.rowcount else None
+
+    def cancel_job(self, job_id):
+        """Отменяет задание: ждущие задачи снимаются, взятые исполнитель прервёт сам"""
+        now = time.time()
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE tasks SET state = 'cancelled', updated_at = ? WHERE job_id = ? AND state = 'pending'",
+                (now, job_id)
+            )
+            db.execute(
+                "UPDATE jobs SET state = 'cancelled', finished_at = ? WHERE id = ? AND state IN ('queued', 'running')",
+                (now, job_id)
+            )
+
+    def cancelled_job_ids(self):
+        """id отменённых заданий, у которых ещё есть задачи в работе"""
+        rows = self._connect().execute(
+            "SELECT DISTINCT t.job_id FROM tasks t JOIN jobs j ON j.id = t.job_id "
+            "WHERE j.state = 'cancelled' AND t.state = 'running'"
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def release_task(self, task_id, worker=None):
+        """Возвращает взятую задачу в очередь без траты попытки (остановка исполнителя)"""
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE tasks SET state = 'pending', worker = NULL, lease_expires = NULL, updated_at = ? "
+                "WHERE id = ? AND state = 'running' AND worker = COALESCE(?, worker)",
+                (time.time(), task_id, worker)
+            )
+
+    def recover(self):
+        """
+        Возвращает в очередь задачи, взятые исполнителями, которые больше не работают
+
+        Проверяются только исполнители этого хоста (по pid), не дожидаясь
+        конца аренды; задачи других машин вернутся, когда истечёт их аренда.
+
+        Returns:
+            Сколько задач возвращено
+        """
+        with self._transaction() as db:
+            rows = db.execute("SELECT id, worker FROM tasks WHERE state = 'running'").fetchall()
+            dead = [row['id'] for row in rows if is_local_worker_alive(row['worker']) is False]
+            db.executemany(
+                "UPDATE tasks SET state = 'pending', worker = NULL, lease_expires = NULL, updated_at = ? WHERE id = ?",
+                [(time.time(), task_id) for task_id in dead]
+            )
+        return len(dead)
+
+    def job_status(self, job_id):
+        """
+        Состояние задания и число задач по состояниям
+
+        Returns:
+            dict или None
+        """
+        db = self._connect()
+        job = db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if job is None:
+            return None
+        status = dict(job)
+        status['options'] = json.loads(status['options'])
+        status['tasks'] = {
+            row['state']: row['count']
+            for row in db.execute(
+                'SELECT state, COUNT(*) AS count FROM tasks WHERE job_id = ? GROUP BY state', (job_id,)
+            )
+        }
+        return status
+
+    def job_songs(self, job_id):
+        """Треки задания (строки CSV) в порядке номеров"""
+        rows = self._connect().execute('SELECT song FROM tasks WHERE job_id = ? ORDER BY id', (job_id,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def list_jobs(self, include_finished=True):
+        """Задания по убыванию приоритета и в порядке постановки"""
+        query = 'SELECT id FROM jobs'
+        if not include_finished:
+            query += " WHERE state IN ('queued', 'running')"
+        query += ' ORDER BY priority DESC, id ASC'
+        return [self.job_status(row[0]) for row in self._connect().execute(query).fetchall()]
+
+    def has_unfinished_tasks(self):
+        """True если в очереди есть ждущие или взятые задачи"""
+        row = self._connect().execute(
+            "SELECT 1 FROM tasks t JOIN jobs j ON j.id = t.job_id "
+            "WHERE t.state IN ('pending', 'running') AND j.state IN ('queued', 'running') LIMIT 1"
+        ).fetchone()
+        return row is not None
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute('ROLLBACK' if exc_type else 'COMMIT')
+        return False
+
+
+class QueueRunner:
+    """
+    Исполнитель очереди: берёт задачи треков и обрабатывает их TrackDownloader
+
+    Все задания делят один пул потоков и один AIMD-лимит параллельности.
+    observer (опционально) получает события: on_log(job_id, message),
+    on_track(job_id, num, stage, percent, speed, eta),
+    on_task_done(job_id, task, outcome), on_job_finished(job_id, state, summary).
+    """
+
+    def __init__(self, job_queue, workers=4, concurrency=None, observer=None, log_callback=None):
+        self.queue = job_queue
+        self.workers = workers
+        self.concurrency = concurrency or throttle.AIMDConcurrency(initial=min(2, workers), maximum=workers)
+        self.observer = observer
+        self.log_callback = log_callback
+        self.worker = worker_id()
+        self._stop = threading.Event()
+        self._jobs = {}
+        # Сколько задач каждого задания сейчас обрабатывает этот процесс
+        self._active_tasks = {}
+        self._finished_jobs = set()
+        self._jobs_lock = threading.Lock()
+        self._running = 0
+        self._running_lock = threading.Lock()
+
+    def log(self, message):
+        """Лог исполнителя (не относящийся к конкретному заданию)"""
+        if self.log_callback:
+            self.log_callback(message)
+        else:
+            print(message)
+
+    def stop(self):
+        """Останавливает исполнителя и прерывает текущие треки (они вернутся в очередь)"""
+        self._stop.set()
+        with self._jobs_lock:
+            for _, cancel_token, _ in self._jobs.values():
+                cancel_token.cancel()
+
+    @property
+    def stopped(self):
+        """True если вызван stop()"""
+        return self._stop.is_set()
+
+    def _notify(self, method, *args):
+        """Передаёт событие наблюдателю, если у него есть такой метод"""
+        if self.observer and hasattr(self.observer, method):
+            getattr(self.observer, method)(*args)
+
+    def _job_context(self, task):
+        """(TrackDownloader, CancelToken, RunMetrics) задания; создаются при первой задаче"""
+        job_id = task['job_id']
+        with self._jobs_lock:
+            if job_id not in self._jobs:
+                options = task['options']
+                cancel_token = CancelToken()
+                report_dir = options.get('report_dir')
+                metrics = RunMetrics(trace_path=Path(report_dir) / 'run_trace.jsonl' if report_dir else None)
+                # В режимах album/playlist громкость выравнивается после всех треков (_finish_job)
+                downloader = download_music.TrackDownloader(
+                    task['output_dir'],
+                    normalize=options.get('normalize', True) and options.get('loudness', 'track') == 'track',
+                    output_format=options.get('output_format', download_music.DEFAULT_OUTPUT_FORMAT),
+                    concurrency=self.concurrency,
+                    cancel_token=cancel_token,
+                    log_callback=lambda message: self._notify_log(job_id, message),
+                    track_callback=lambda *update: self._notify('on_track', job_id, *update),
+                    total_songs=(self.queue.job_status(job_id) or {}).get('total')
+                )
+                self._jobs[job_id] = (downloader, cancel_token, metrics)
+            return self._jobs[job_id]
+
+    def _notify_log(self, job_id, message):
+        """Лог трека: наблюдателю или в консоль"""
+        if self.observer and hasattr(self.observer, 'on_log'):
+            self.observer.on_log(job_id, message)
+        else:
+            print(message)
+
+    def _run_task(self, task):
+        """Обрабатывает задачу в рабочем потоке; пока она в работе, контекст задания не закрывается"""
+        job_id = task['job_id']
+        with self._jobs_lock:
+            self._active_tasks[job_id] = self._active_tasks.get(job_id, 0) + 1
+        try:
+            self._process_task(task)
+        finally:
+            with self._jobs_lock:
+                self._active_tasks[job_id] -= 1
+                if not self._active_tasks[job_id]:
+                    del self._active_tasks[job_id]
+
+    def _process_task(self, task):
+        """Скачивает трек задачи и записывает результат в очередь"""
+        outcome = 'failed'
+        error = None
+        try:
+            downloader, cancel_token, metrics = self._job_context(task)
+            song = task['song']
+            track_metrics = metrics.start_track(task['num'], song.get('Артист', ''), song.get('Песня', ''))
+            # Последняя попытка в очереди: временная ошибка становится окончательной
+            final = task['attempts'] + 1 >= MAX_TASK_ATTEMPTS
+            with profiling.thread_profile():
+                outcome = downloader.process(song, track_metrics, final=final)
+            error = track_metrics.failure
+        except Exception as e:
+            error = str(e)
+            self.log(f"❌ Ошибка задачи {task['id']}: {e}")
+        finally:
+            self.concurrency.release()
+            with self._running_lock:
+                self._running -= 1
+
+        if outcome == 'cancelled' and self._stop.is_set():
+            # Остановка исполнителя, а не отмена задания: трек вернётся в очередь
+            self.queue.release_task(task['id'], self.worker)
+            return
+        finished_job = self.queue.complete_task(task['id'], outcome, error, worker=self.worker)
+        self._notify('on_task_done', task['job_id'], task, outcome)
+        if finished_job:
+            self._finish_job(finished_job, 'done')
+        elif outcome == 'cancelled':
+            self._finish_if_cancelled(task['job_id'])
+
+    def cancel_job(self, job_id):
+        """Отменяет задание в очереди и сразу прерывает его треки в этом процессе"""
+        self.queue.cancel_job(job_id)
+        with self._jobs_lock:
+            context = self._jobs.get(job_id)
+        if context:
+            context[1].cancel()
+        self._finish_if_cancelled(job_id)
+
+    def _finish_if_cancelled(self, job_id):
+        """Завершает отменённое задание, когда у него не осталось треков в работе"""
+        status = self.queue.job_status(job_id)
+        if status and status['state'] == 'cancelled' and not status['tasks'].get('running'):
+            self._finish_job(job_id, 'cancelled')
+
+    def _finish_job(self, job_id, state):
+        """Итоги задания: сводка метрик и отчёт, если он запрошен (один раз на задание)"""
+        with self._jobs_lock:
+            if job_id in self._finished_jobs:
+                return
+            self._finished_jobs.add(job_id)
+            context = self._jobs.pop(job_id, None)
+        summary = None
+        status = self.queue.job_status(job_id) or {}
+        options = status.get('options', {})
+        if state == 'done' and options.get('normalize', True) and options.get('loudness', 'track') != 'track':
+            self._apply_group_gain(job_id, status, context[1] if context else None)
+        if context:
+            _, _, metrics = context
+            metrics.finish()
+            summary = metrics.summary()
+            report_dir = options.get('report_dir')
+            if report_dir:
+                metrics.write_summary(Path(report_dir) / 'run_summary.json')
+        self._notify('on_job_finished', job_id, state, summary)
+
+    def _apply_group_gain(self, job_id, status, cancel_token):
+        """Громкость альбомов/плейлиста задания (на узле, завершившем последний трек)"""
+        options = status['options']
+        try:
+            album_gain.apply_group_gain(
+                download_music.track_files(self.queue.job_songs(job_id), status['output_dir'],
+                                           options.get('output_format', download_music.DEFAULT_OUTPUT_FORMAT)),
+                mode=options['loudness'], gain_mode=options.get('gain_mode', 'tags'),
+                log_callback=lambda message: self._notify_log(job_id, message), cancel_token=cancel_token
+            )
+        except OperationCancelled:
+            self._notify_log(job_id, "⏸️  Выравнивание громкости прервано")
+        except Exception as e:
+            self._notify_log(job_id, f"⚠️  Громкость не выровнена: {download_music.short_error(e)}")
+
+    def _close_finished_contexts(self):
+        """
+        Закрывает контексты заданий, которые завершились без _finish_job на этом узле
+
+        Последний трек задания мог завершить другой узел: тогда контекст (и
+        открытый файл трассы) остался бы здесь навсегда. Сводку и отчёт пишет
+        узел, завершивший задание, здесь только закрывается трасса.
+        """
+        with self._jobs_lock:
+            idle = [job_id for job_id in self._jobs if not self._active_tasks.get(job_id)]
+        for job_id in idle:
+            status = self.queue.job_status(job_id)
+            if status and status['state'] not in ('done', 'cancelled'):
+                continue
+            with self._jobs_lock:
+                if self._active_tasks.get(job_id):
+                    continue
+                context = self._jobs.pop(job_id, None)
+            if context:
+                context[2].finish()
+
+    def _cancel_jobs(self):
+        """Прерывает треки отменённых заданий"""
+        for job_id in self.queue.cancelled_job_ids():
+            with self._jobs_lock:
+                context = self._jobs.get(job_id)
+            if context:
+                context[1].cancel()
+
+    def run(self, until_empty=False):
+        """
+        Обрабатывает очередь до stop() (или до опустошения при until_empty)
+
+        Returns:
+            None
+        """
+        recovered = self.queue.recover()
+        if recovered:
+            self.log(f"♻️  Возвращено в очередь задач после перезапуска: {recovered}")
+
+        finished = threading.Event()
+        housekeeping = threading.Thread(target=self._housekeeping, args=(finished,), name='queue-housekeeping',
+                                        daemon=True)
+        housekeeping.start()
+        try:
+            self._dispatch(until_empty)
+        finally:
+            finished.set()
+            housekeeping.join()
+
+    def _dispatch(self, until_empty):
+        """Главный цикл: ждёт слот параллельности, берёт задачу и отдаёт её в пул"""
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as pool:
+            while not self._stop.is_set():
+                if not self.concurrency.acquire(should_stop=self._stop.is_set):
+                    break
+
+                task = self.queue.claim_task(self.worker)
+                if task is not None and self._stop.is_set():
+                    self.queue.release_task(task['id'], self.worker)
+                    task = None
+                if task is None:
+                    self.concurrency.release()
+                    with self._running_lock:
+                        idle = self._running == 0
+                    if until_empty and idle and not self.queue.has_unfinished_tasks():
+                        break
+                    self._stop.wait(POLL_INTERVAL)
+                    continue
+
+                with self._running_lock:
+                    self._running += 1
+                pool.submit(self._run_task, task)
+
+    def _housekeeping(self, finished):
+        """
+        Фоновый поток: продление аренды задач в работе, отмена заданий
+        и закрытие контекстов заданий, завершённых другими узлами
+
+        Отдельно от главного цикла, который может долго ждать свободный слот.
+        """
+        renew_interval = self.queue.lease_duration * LEASE_RENEW_FRACTION
+        last_renew = time.monotonic()
+        while not finished.wait(min(POLL_INTERVAL, renew_interval)):
+            self._cancel_jobs()
+            self._close_finished_contexts()
+            if time.monotonic() - last_renew >= renew_interval:
+                self.queue.renew_leases(self.worker)
+                last_renew = time.monotonic()
+
+
+def main():
+    """Главная функция"""
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if not args or args[0] not in ('add', 'list', 'cancel', 'run'):
+        print("Использование:")
+        print(f"  python3 {sys.argv[0]} add <songs.csv> [папка] [--priority=interactive|normal|batch|N]")
+        print("        [--format=FMT] [--no-normalize] [--loudness=track|album|playlist] [--gain=tags|apply]")
+        print("        [--report=DIR]")
+        print(f"  python3 {sys.argv[0]} list")
+        print(f"  python3 {sys.argv[0]} cancel <id>")
+        print(f"  python3 {sys.argv[0]} run [--workers=N] [--until-empty] [--rate=R] [--bandwidth=S [--bandwidth-persist]] [--lease=SECONDS]")
+        print(f"\nОчередь: {get_cache_dir('queue') / 'jobs.db'} (или --db=FILE)")
+        print("Несколько машин: --db=/общая/папка/jobs.db --shared на каждом узле")
+        sys.exit(1)
+
+    job_queue = JobQueue(download_music.get_option(sys.argv, 'db'), shared='--shared' in sys.argv,
+                         lease_duration=float(download_music.get_option(sys.argv, 'lease', LEASE_DURATION)))
+    command = args[0]
+
+    if command == 'add':
+        csv_path = args[1]
+        playlist_name = download_music.extract_playlist_name(csv_path)
+        output_dir = args[2] if len(args) > 2 else download_music.default_output_dir(csv_path, playlist_name)
+        priority = download_music.get_option(sys.argv, 'priority', 'normal')
+        if priority not in PRIORITIES:
+            priority = int(priority)
+        output_format = download_music.get_option(sys.argv, 'format', download_music.DEFAULT_OUTPUT_FORMAT)
+        try:
+            download_music.parse_output_formats(output_format)
+        except ValueError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+        report_dir = download_music.get_option(sys.argv, 'report')
+        loudness = download_music.get_option(sys.argv, 'loudness', 'track')
+        gain_mode = download_music.get_option(sys.argv, 'gain', 'tags')
+        if loudness not in album_gain.LOUDNESS_MODES or gain_mode not in album_gain.GAIN_MODES:
+            print(f"❌ Неизвестный режим громкости: --loudness={loudness} --gain={gain_mode}")
+            sys.exit(1)
+        options = {
+            'normalize': '--no-normalize' not in sys.argv,
+            'output_format': output_format,
+            'loudness': loudness,
+            'gain_mode': gain_mode,
+            'report_dir': report_dir and str(Path(report_dir).resolve()),
+        }
+        songs = download_music.read_songs(csv_path)
+        job_id = job_queue.add_job(songs, output_dir, priority=priority, options=options,
+                                   name=playlist_name)
+        print(f"✅ Задание {job_id}: {len(songs)} треков, приоритет {priority}, папка {output_dir}")
+
+    elif command == 'list':
+        for job in job_queue.list_jobs():
+            tasks = ', '.join(f"{state}: {count}" for state, count in sorted(job['tasks'].items()))
+            print(f"#{job['id']} [{job['state']}] prio {job['priority']} {job['name'] or ''} - {tasks}")
+
+    elif command == 'cancel':
+        job_queue.cancel_job(int(args[1]))
+        print(f"⏹️  Задание {args[1]} отменено")
+
+    elif command == 'run':
+        rate = download_music.get_option(sys.argv, 'rate')
+        if rate:
+            throttle.configure_request_limiter(float(rate))
+        bandwidth = download_music.get_option(sys.argv, 'bandwidth')
+        if bandwidth:
+            throttle.configure_bandwidth(bandwidth, persist='--bandwidth-persist' in sys.argv)
+        runner = QueueRunner(job_queue, workers=int(download_music.get_option(sys.argv, 'workers', 4)))
+        # Ctrl+C: прерываем текущие треки, они вернутся в очередь
+        signal.signal(signal.SIGINT, lambda signum, frame: runner.stop())
+        signal.signal(signal.SIGTERM, lambda signum, frame: runner.stop())
+        runner.run(until_empty='--until-empty' in sys.argv)
+        if runner.stopped:
+            print("\n⏹️  Исполнитель остановлен, незавершённые треки вернутся в очередь")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+Library Verify
+Проверка скачанной библиотеки: битые, обрезанные, тихие и ненормализованные
+файлы находятся параллельной проверкой через ffprobe/ffmpeg, результаты
+проверки кэшируются по размеру и времени изменения файла
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import download_music
+import ranking
+from album_gain import LOUDNESS_PATTERN
+from app_cache import get_cache_dir, load_json, locked_json
+from process_runner import OperationCancelled, run_command
+
+# Версия формата проверки: записи кэша со старой версией проверяются заново
+PROBE_VERSION = 2
+
+# Сколько файлов проверять одновременно (каждая проверка - отдельный ffmpeg)
+VERIFY_WORKERS = os.cpu_count() or 4
+
+# Таймауты проверки одного файла (секунды)
+PROBE_TIMEOUT = 60
+DECODE_TIMEOUT = 600
+DECODE_STALL_TIMEOUT = 120
+
+# Допустимое расхождение с длительностью видео из манифеста: секунды и доля от ожидаемой
+DURATION_TOLERANCE = 3.0
+DURATION_TOLERANCE_RATIO = 0.03
+
+# Допуск для длительности трека из CSV (без манифеста): видео законно отличается от
+# версии в Spotify, поэтому - как при выборе видео, до обнуления балла длительности
+TRACK_DURATION_TOLERANCE = ranking.DURATION_TOLERANCE + ranking.DURATION_FALLOFF
+
+# Целевая громкость loudnorm и допуск для файлов без метки нормализации (LUFS)
+TARGET_LOUDNESS = -16.0
+LOUDNESS_TOLERANCE = 2.0
+
+# Тише этого (LUFS) файл считается тишиной
+SILENCE_LOUDNESS = -60.0
+
+# Сколько сообщений об ошибках декодирования сохранять
+MAX_DECODE_ERRORS = 5
+
+# Сохранять кэш проверки каждые N новых проверок (прерванная проверка не теряется)
+CACHE_SAVE_EVERY = 200
+
+# Описания проблем для отчёта
+PROBLEMS = {
+    'missing': 'файла нет',
+    'unreadable': 'не читается',
+    'decode_errors': 'ошибки декодирования',
+    'truncated': 'обрезан',
+    'duration_mismatch': 'длительность не совпадает с видео',
+    'silent': 'тишина',
+    'not_normalized': 'не нормализован',
+}
+
+# Теги группового gain (album_gain в режиме tags): громкость задаёт плеер
+GAIN_TAGS = ('replaygain_album_gain', 'r128_album_gain')
+
+# Строки ffmpeg -loglevel level+... с ошибками
+DECODE_ERROR_PATTERN = re.compile(r'\[(error|fatal)\]')
+
+
+def probe_file(path, cancel_token=None):
+    """
+    Проверяет файл: длительность и теги из заголовка, затем полное декодирование
+
+    Декодирование (ffmpeg в null с ebur128) даёт настоящую длительность,
+    ошибки декодера и интегральную громкость за один проход.
+
+    Returns:
+        dict: header_duration, decoded_duration, decode_errors, loudness, marker, error
+
+    Raises:
+        OperationCancelled: проверка отменена
+    """
+    probe = {
+        'header_duration': None,
+        'decoded_duration': None,
+        'decode_errors': [],
+        'loudness': None,
+        'marker': False,
+        'error': None,
+    }
+    try:
+        result = run_command(
+            ['ffprobe', '-v', 'error', '-show_entries', 'format=duration:format_tags', '-of', 'json', str(path)],
+            timeout=PROBE_TIMEOUT, stall_timeout=PROBE_TIMEOUT, cancel_token=cancel_token
+        )
+        info = json.loads(result.stdout or '{}').get('format', {})
+        if info.get('duration') not in (None, 'N/A'):
+            probe['header_duration'] = float(info['duration'])
+        # Регистр ключей тегов зависит от контейнера (comment в ID3, COMMENT в Vorbis)
+        tags = {key.lower(): value for key, value in (info.get('tags') or {}).items()}
+        # Нормализован loudnorm, выровнен gain альбома/плейлиста или несёт теги ReplayGain/R128
+        probe['marker'] = ((tags.get('comment') or '').startswith(f"{download_music.MARKER_PREFIX} ")
+                           or any(key in tags for key in GAIN_TAGS))
+
+        position = [None]
+
+        def on_line(line):
+            key, _, value = line.partition('=')
+            if key == 'out_time_us' and value.isdigit():
+                position[0] = int(value) / 1_000_000
+
+        result = run_command(
+            ['ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'level+info',
+             '-i', str(path), '-map', '0:a:0', '-af', 'ebur128=framelog=verbose',
+             '-f', 'null', '-progress', 'pipe:1', '-nostats', '-'],
+            on_line=on_line, check=False, timeout=DECODE_TIMEOUT, stall_timeout=DECODE_STALL_TIMEOUT,
+            cancel_token=cancel_token
+        )
+        probe['decoded_duration'] = position[0]
+        stderr_lines = result.stderr.splitlines()
+        probe['decode_errors'] = [line.strip() for line in stderr_lines
+                                  if DECODE_ERROR_PATTERN.search(line)][:MAX_DECODE_ERRORS]
+        if result.returncode and not probe['decode_errors']:
+            probe['decode_errors'] = [f"ffmpeg завершился с кодом {result.returncode}"]
+        loudness = LOUDNESS_PATTERN.findall(result.stderr)
+        if loudness:
+            probe['loudness'] = float('-inf') if loudness[-1] == '-inf' else float(loudness[-1])
+    except OperationCancelled:
+        raise
+    except Exception as e:
+        probe['error'] = download_music.short_error(e)
+    return probe
+
+
+def find_problems(probe, video_duration=None, normalize=True, track_duration=None):
+    """
+    Проблемы файла по результату probe_file
+
+    Args:
+        probe: dict из probe_file
+        video_duration: длительность выбранного видео из манифеста (секунды, опционально)
+        normalize: файл должен быть нормализован
+        track_duration: длительность трека из CSV, если видео неизвестно
+            (секунды, опционально; сравнивается с допуском TRACK_DURATION_TOLERANCE)
+
+    Returns:
+        Список ключей PROBLEMS (пустой - файл в порядке)
+    """
+    if probe['error'] or (probe['decoded_duration'] is None and probe['header_duration'] is None):
+        return ['unreadable']
+
+    def tolerance(duration):
+        return max(DURATION_TOLERANCE, duration * DURATION_TOLERANCE_RATIO)
+
+    problems = []
+    if probe['decode_errors']:
+        problems.append('decode_errors')
+
+    duration = probe['decoded_duration'] if probe['decoded_duration'] is not None else probe['header_duration']
+    header = probe['header_duration']
+    if header and probe['decoded_duration'] is not None and header - duration > tolerance(header):
+        problems.append('truncated')
+    if video_duration:
+        if abs(duration - video_duration) > tolerance(video_duration):
+            problems.append('duration_mismatch')
+    elif track_duration and abs(duration - track_duration) > TRACK_DURATION_TOLERANCE:
+        problems.append('duration_mismatch')
+
+    loudness = probe['loudness']
+    if loudness is not None and loudness <= SILENCE_LOUDNESS:
+        problems.append('silent')
+    elif normalize and not probe['marker']:
+        # Файлы без метки (скачанные до её появления) проверяем по измеренной громкости
+        if loudness is None or abs(loudness - TARGET_LOUDNESS) > LOUDNESS_TOLERANCE:
+            problems.append('not_normalized')
+    return problems
+
+
+class ProbeCache:
+    """
+    Кэш результатов probe_file, общий для всех процессов
+
+    probes.json: {абсолютный путь: {size, mtime_ns, version, probe}}.
+    Запись действительна, пока у файла не изменились размер и время изменения,
+    поэтому повторная проверка неизменной библиотеки не запускает ffmpeg.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = Path(cache_dir) if cache_dir else get_cache_dir('verify')
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.path = self.cache_dir / 'probes.json'
+        self._entries = load_json(self.path, {})
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get(self, path, stat):
+        """Сохранённый результат проверки или None, если файл изменился"""
+        entry = self._entries.get(str(path))
+        if (entry and entry.get('version') == PROBE_VERSION
+                and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns):
+            return entry['probe']
+        return None
+
+    def put(self, path, stat, probe):
+        """Запоминает результат проверки (на диск - через save)"""
+        entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'version': PROBE_VERSION,
+                 'checked_at': time.time(), 'probe': probe}
+        with self._lock:
+            self._entries[str(path)] = entry
+            self._pending[str(path)] = entry
+            pending = len(self._pending)
+        if pending >= CACHE_SAVE_EVERY:
+            self.save()
+
+    def save(self):
+        """Записывает новые результаты под файловой блокировкой"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        with locked_json(self.path, {}) as entries:
+            # Записи удалённых файлов не копятся
+            for path in [path for path in entries if not Path(path).exists()]:
+                del entries[path]
+            entries.update(pending)
+
+
+def verify_library(csv_path, output_dir, output_format=download_music.DEFAULT_OUTPUT_FORMAT, normalize=True,
+                   manifest=None, workers=VERIFY_WORKERS, log_callback=None, cancel_token=None):
+    """
+    Проверяет файлы треков плейлиста в папке
+
+    Args:
+        csv_path: путь к CSV файлу
+        output_dir: папка с треками
+        output_format: формат или список форматов (какие папки и расширения проверять)
+        normalize: проверять нормализацию громкости
+        manifest: манифест resolve (длительности выбранных видео), опционально
+        workers: сколько файлов проверять одновременно
+        log_callback: функция для вывода логов (по умолчанию print)
+        cancel_token: CancelToken для прерывания
+
+    Returns:
+        dict: tracks (num, artist, title, format, path, problems) - по файлу на формат,
+        checked, cached, broken
+
+    Raises:
+        OperationCancelled: проверка отменена
+    """
+    log = log_callback or print
+    songs = download_music.read_songs(csv_path)
+    targets = download_music.output_targets(output_dir, output_format)
+    resolutions = download_music.manifest_resolutions(manifest) if manifest else {}
+    cache = ProbeCache()
+    counts = {'checked': 0, 'cached': 0}
+    counts_lock = threading.Lock()
+
+    def verify_track(song, target):
+        target_dir, extensions, spec = target
+        num = song.get('№', '').zfill(2)
+        artist, title = song['Артист'], song['Песня']
+        base_filename, _, _ = download_music.build_base_filename(num, artist, title)
+        track = {'num': num, 'artist': artist, 'title': title, 'path': None, 'problems': ['missing'],
+                 'format': spec['label'] if len(targets) > 1 else None}
+        path = download_music.find_output_file(target_dir, base_filename, extensions)
+        if path is None:
+            return track
+
+        path = path.resolve()
+        stat = path.stat()
+        probe = cache.get(path, stat)
+        with counts_lock:
+            counts['cached' if probe is not None else 'checked'] += 1
+        if probe is None:
+            probe = probe_file(path, cancel_token)
+            cache.put(path, stat, probe)
+
+        resolution = resolutions.get(f"{artist} {title}".lower()) or {}
+        track.update({
+            'path': str(path),
+            'duration': probe['decoded_duration'] if probe['decoded_duration'] is not None else probe['header_duration'],
+            'loudness': probe['loudness'],
+            'decode_errors': probe['decode_errors'],
+            'problems': find_problems(probe, resolution.get('duration'), normalize,
+                                      download_music.parse_track_duration(song.get('Длительность'))),
+        })
+        return track
+
+    log(f"🩺 Проверка {len(songs)} треков в {output_dir} ({workers} проверок параллельно)...")
+    started = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            # При нескольких форматах каждый файл трека проверяется отдельно
+            tracks = list(pool.map(lambda args: verify_track(*args),
+                                   [(song, target) for song in songs for target in targets]))
+    finally:
+        cache.save()
+
+    broken = [track for track in tracks if track['problems']]
+    log(f"✅ Проверено за {time.monotonic() - started:.1f}s: {counts['checked']} файлов, "
+        f"{counts['cached']} из кэша, проблем: {len(broken)}")
+    return {'tracks': tracks, 'checked': counts['checked'], 'cached': counts['cached'], 'broken': len(broken)}
+
+
+def format_report(report):
+    """Строки отчёта о проблемных треках"""
+    lines = []
+    for track in report['tracks']:
+        if not track['problems']:
+            continue
+        problems = ', '.join(PROBLEMS[problem] for problem in track['problems'])
+        output_format = f" ({track['format']})" if track.get('format') else ''
+        lines.append(f"   ❌ [{track['num']}] {track['artist']} - {track['title']}{output_format}: {problems}")
+        for error in track.get('decode_errors') or []:
+            lines.append(f"      {error}")
+    return lines
+
+
+def remove_broken(report):
+    """
+    Удаляет проблемные файлы, чтобы обычный прогон скачал только их заново
+
+    Returns:
+        Число удалённых файлов
+    """
+    removed = 0
+    for track in report['tracks']:
+        if track['problems'] and track['path']:
+            Path(track['path']).unlink(missing_ok=True)
+            removed += 1
+    return removed
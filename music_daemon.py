@@ -0,0 +1,662 @@
+#!/usr/bin/env python3
+"""
+Music Daemon
+Долгоживущий процесс с тёплым состоянием (запущенный Chromium, кэш поиска,
+общий лимит параллельности) и локальным HTTP/JSON API для заданий
+парсинга и скачивания. download_music.py и GUI работают как его клиенты.
+Задания скачивания идут через надёжную очередь (job_queue.py) и
+продолжаются после перезапуска демона.
+
+API (все ответы - JSON):
+    GET  /health                   - состояние демона
+    GET  /jobs                     - список заданий
+    POST /jobs                     - новое задание: {"type": "parse", "url": ...}
+                                     или {"type": "download", "csv_path" | "songs", "output_dir",
+                                          "priority": "interactive" | "normal" | "batch", ...}
+    GET  /jobs/<id>                - статус задания (прогресс, треки, результат)
+    GET  /jobs/<id>/events?since=N - поток событий (NDJSON) до завершения задания
+    POST /jobs/<id>/cancel         - отмена задания
+"""
+
+import itertools
+import json
+import queue
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import album_gain
+import download_music
+import job_queue
+import throttle
+from app_cache import get_cache_dir
+from process_runner import CancelToken, OperationCancelled
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_DAEMON_URL = f"http://{DEFAULT_HOST}:{DEFAULT_PORT}"
+
+# Сколько последних событий задания хранится для потоковой выдачи
+EVENT_BUFFER = 5000
+
+# Таймаут обычных запросов клиента (секунды)
+CLIENT_TIMEOUT = 30
+
+FINISHED_STATES = ('done', 'failed', 'cancelled')
+
+# Сколько хранить завершённые задания (секунды) и сколько последних из них держать максимум
+FINISHED_JOB_TTL = 3600
+MAX_FINISHED_JOBS = 200
+
+
+class Job:
+    """
+    Задание демона: состояние, прогресс, последние состояния треков и журнал событий
+
+    События нумеруются по порядку; клиент читает их с любого номера (since),
+    старые события за пределами EVENT_BUFFER отбрасываются.
+    """
+
+    def __init__(self, job_id, job_type, params):
+        self.id = job_id
+        self.type = job_type
+        self.params = params
+        self.state = 'queued'
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.progress = {'current': 0, 'total': 0}
+        self.tracks = {}
+        self.result = None
+        self.error = None
+        self.queue_id = None
+        self.cancel_token = CancelToken()
+        self._events = deque(maxlen=EVENT_BUFFER)
+        self._next_seq = 0
+        self._cond = threading.Condition()
+
+    @property
+    def finished(self):
+        """True если задание завершено"""
+        return self.state in FINISHED_STATES
+
+    def add_event(self, event_type, **data):
+        """Добавляет событие и будит ожидающих читателей"""
+        with self._cond:
+            event = {'seq': self._next_seq, 'type': event_type, 'time': round(time.time(), 3), **data}
+            self._next_seq += 1
+            self._events.append(event)
+            self._cond.notify_all()
+
+    def set_state(self, state, **data):
+        """Меняет состояние задания и публикует событие state"""
+        # Под той же блокировкой, что и события: читатель не увидит завершение без события state
+        with self._cond:
+            self.state = state
+            if state == 'running':
+                self.started_at = time.time()
+            elif state in FINISHED_STATES:
+                self.finished_at = time.time()
+            self.add_event('state', state=state, **data)
+
+    def events_since(self, since, timeout=None):
+        """
+        События с номера since
+
+        Ждёт до timeout секунд, если новых событий нет и задание не завершено.
+
+        Returns:
+            (events, next_since, done) - done: задание завершено и все события отданы
+        """
+        with self._cond:
+            if self._next_seq <= since and not self.finished:
+                self._cond.wait(timeout)
+            events = [event for event in self._events if event['seq'] >= since]
+            return events, self._next_seq, self.finished
+
+    def to_dict(self, include_tracks=False):
+        """Статус задания для API"""
+        data = {
+            'id': self.id,
+            'type': self.type,
+            'queue_id': self.queue_id,
+            'state': self.state,
+            'params': self.params,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'progress': self.progress,
+            'result': self.result,
+            'error': self.error,
+        }
+        if include_tracks:
+            data['tracks'] = self.tracks
+        return data
+
+
+class ParseWorker(threading.Thread):
+    """
+    Поток парсинга с тёплым Chromium
+
+    Playwright (sync API) привязан к потоку, который его запустил, поэтому
+    браузер живёт в одном потоке, а задания парсинга идут к нему через очередь.
+    """
+
+    def __init__(self):
+        super().__init__(name='parse-worker', daemon=True)
+        self.jobs = queue.Queue()
+        self.browser_ready = False
+
+    def run(self):
+        try:
+            from playwright.sync_api import sync_playwright
+            from parse_spotify_playlist import parse_spotify_playlist
+        except ImportError as e:
+            # Без playwright демон всё равно скачивает, а задания парсинга завершаются ошибкой
+            while True:
+                job = self.jobs.get()
+                if job is None:
+                    return
+                job.error = f"playwright не установлен: {e}"
+                job.set_state('failed', error=job.error)
+
+        with sync_playwright() as playwright:
+            browser = None
+            while True:
+                job = self.jobs.get()
+                if job is None:
+                    break
+                if job.cancel_token.cancelled:
+                    job.set_state('cancelled')
+                    continue
+
+                job.set_state('running')
+                try:
+                    # Браузер перезапускаем, только если он упал
+                    if browser is None or not browser.is_connected():
+                        job.add_event('log', message="🌐 Запускаю Chromium...")
+                        browser = playwright.chromium.launch(headless=True)
+                        self.browser_ready = True
+
+                    output_csv = get_cache_dir('daemon', 'playlists') / f"{job.id}.csv"
+                    # Токен проверяется между шагами Playwright: отмена закрывает страницу посреди парсинга
+                    csv_path = parse_spotify_playlist(job.params['url'], str(output_csv), browser=browser,
+                                                      cancel_token=job.cancel_token)
+                    if not csv_path:
+                        job.error = "Не удалось извлечь треки"
+                        job.set_state('failed', error=job.error)
+                        continue
+
+                    songs = download_music.read_songs(csv_path)
+                    job.result = {
+                        'csv_path': csv_path,
+                        'playlist_name': download_music.extract_playlist_name(csv_path),
+                        'songs': songs,
+                    }
+                    job.add_event('log', message=f"✅ Найдено треков: {len(songs)}")
+                    job.set_state('done', result=job.result)
+                except OperationCancelled:
+                    job.add_event('log', message="⏹️ Парсинг отменён")
+                    job.set_state('cancelled')
+                except Exception as e:
+                    job.error = str(e)
+                    job.set_state('failed', error=job.error)
+
+            if browser is not None:
+                browser.close()
+
+
+class MusicDaemon:
+    """
+    Задания парсинга и скачивания в одном процессе
+
+    Задания скачивания ставятся в очередь job_queue с приоритетом и выполняются
+    одним QueueRunner: треки всех заданий делят один AIMD-лимит параллельности
+    (и общий на хост лимит запросов), кэш поиска в памяти и кэш обложек.
+    Демон - наблюдатель QueueRunner и переводит его события в события заданий.
+    """
+
+    def __init__(self, workers=4, queue_path=None):
+        self.workers = workers
+        self.concurrency = throttle.AIMDConcurrency(initial=min(2, workers), maximum=workers)
+        self.jobs = {}
+        self._queue_jobs = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.parse_worker = ParseWorker()
+        self.job_queue = job_queue.JobQueue(queue_path)
+        self.runner = job_queue.QueueRunner(self.job_queue, workers=workers, concurrency=self.concurrency,
+                                            observer=self)
+        download_music.enable_search_cache()
+
+    def start(self):
+        """Запускает поток парсинга и исполнитель очереди"""
+        self.parse_worker.start()
+        threading.Thread(target=self.runner.run, name='queue-runner', daemon=True).start()
+
+    def stop(self):
+        """Останавливает исполнитель (недокачанные треки остаются в очереди) и поток парсинга"""
+        self.runner.stop()
+        for job in self.list_jobs():
+            if job.type == 'parse':
+                job.cancel_token.cancel()
+        self.parse_worker.jobs.put(None)
+
+    def list_jobs(self):
+        """Все задания в порядке создания"""
+        with self._lock:
+            self._evict_finished()
+            return list(self.jobs.values())
+
+    def get_job(self, job_id):
+        """Задание по id или None"""
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def submit(self, params):
+        """
+        Создаёт задание
+
+        Raises:
+            ValueError: неизвестный тип задания или не хватает параметров
+        """
+        job_type = params.get('type')
+        if job_type == 'parse':
+            if not params.get('url'):
+                raise ValueError("Для parse нужен url")
+        elif job_type == 'download':
+            if not params.get('csv_path') and not params.get('songs'):
+                raise ValueError("Для download нужен csv_path или songs")
+            if not params.get('output_dir'):
+                raise ValueError("Для download нужен output_dir")
+            output_format = params.get('output_format', download_music.DEFAULT_OUTPUT_FORMAT)
+            download_music.parse_output_formats(output_format)
+            if params.get('loudness', 'track') not in album_gain.LOUDNESS_MODES:
+                raise ValueError(f"Неизвестный режим громкости: {params['loudness']}")
+            if params.get('gain_mode', 'tags') not in album_gain.GAIN_MODES:
+                raise ValueError(f"Неизвестный режим gain: {params['gain_mode']}")
+            priority = params.get('priority', 'interactive')
+            if priority not in job_queue.PRIORITIES and not isinstance(priority, int):
+                raise ValueError(f"Неизвестный приоритет: {priority}")
+        else:
+            raise ValueError(f"Неизвестный тип задания: {job_type}")
+
+        with self._lock:
+            self._evict_finished()
+            job = Job(str(next(self._ids)), job_type, params)
+            self.jobs[job.id] = job
+        job.add_event('state', state='queued')
+
+        if job_type == 'parse':
+            self.parse_worker.jobs.put(job)
+        else:
+            try:
+                self._enqueue_download(job)
+            except Exception as e:
+                job.error = str(e)
+                job.set_state('failed', error=job.error)
+        return job
+
+    def _enqueue_download(self, job):
+        """Ставит задание скачивания в очередь (CSV читается сразу, треки становятся задачами)"""
+        params = job.params
+        if params.get('songs'):
+            songs = params['songs']
+            playlist_name = params.get('playlist_name')
+        else:
+            songs = download_music.read_songs(params['csv_path'])
+            playlist_name = download_music.extract_playlist_name(params['csv_path'])
+
+        options = {
+            'normalize': params.get('normalize', True),
+            'output_format': params.get('output_format', download_music.DEFAULT_OUTPUT_FORMAT),
+            'report_dir': params.get('report_dir'),
+            'loudness': params.get('loudness', 'track'),
+            'gain_mode': params.get('gain_mode', 'tags'),
+        }
+        # Задание регистрируется до постановки: исполнитель может взять первый трек сразу
+        with self._lock:
+            job.progress = {'current': 0, 'total': len(songs)}
+            job.queue_id = self.job_queue.add_job(songs, params['output_dir'],
+                                                  priority=params.get('priority', 'interactive'),
+                                                  options=options, name=playlist_name)
+            self._queue_jobs[job.queue_id] = job
+
+    def _evict_finished(self):
+        """
+        Удаляет завершённые задания старше FINISHED_JOB_TTL и сверх MAX_FINISHED_JOBS
+
+        Вызывается под self._lock. Клиент, который уже читает события задания,
+        держит ссылку на Job и дочитывает их после удаления.
+        """
+        now = time.time()
+        finished = sorted((job for job in self.jobs.values() if job.finished and job.finished_at),
+                          key=lambda job: job.finished_at)
+        expired = [job for job in finished if now - job.finished_at > FINISHED_JOB_TTL]
+        kept = [job for job in finished if now - job.finished_at <= FINISHED_JOB_TTL]
+        expired.extend(kept[:max(0, len(kept) - MAX_FINISHED_JOBS)])
+        for job in expired:
+            del self.jobs[job.id]
+            if job.queue_id is not None:
+                self._queue_jobs.pop(job.queue_id, None)
+
+    def _queue_job(self, queue_id):
+        """Задание демона по id задания очереди (None для заданий, добавленных в обход демона)"""
+        with self._lock:
+            return self._queue_jobs.get(queue_id)
+
+    def cancel(self, job_id):
+        """Отменяет задание: запущенные yt-dlp/ffmpeg завершаются сразу"""
+        job = self.get_job(job_id)
+        if job and not job.finished:
+            if job.queue_id is not None:
+                self.runner.cancel_job(job.queue_id)
+            else:
+                job.cancel_token.cancel()
+        return job
+
+    # Наблюдатель QueueRunner
+
+    def on_log(self, queue_id, message):
+        """Лог трека -> событие log задания"""
+        job = self._queue_job(queue_id)
+        if job is None:
+            print(message)
+            return
+        if job.state == 'queued':
+            job.set_state('running')
+        job.add_event('log', message=message)
+
+    def on_track(self, queue_id, num, stage, percent, speed, eta):
+        """Состояние трека -> событие track задания"""
+        job = self._queue_job(queue_id)
+        if job is None:
+            return
+        if job.state == 'queued':
+            job.set_state('running')
+        job.tracks[num] = {'stage': stage, 'percent': percent, 'speed': speed, 'eta': eta}
+        job.add_event('track', num=num, stage=stage, percent=percent, speed=speed, eta=eta)
+
+    def on_task_done(self, queue_id, task, outcome):
+        """Трек завершён -> событие progress задания"""
+        job = self._queue_job(queue_id)
+        status = job and self.job_queue.job_status(queue_id)
+        if not status:
+            return
+        current = sum(count for state, count in status['tasks'].items() if state in job_queue.TASK_FINISHED_STATES)
+        job.progress = {'current': current, 'total': status['total']}
+        job.add_event('progress', current=current, total=status['total'])
+
+    def on_job_finished(self, queue_id, state, summary):
+        """Задание очереди завершено или отменено"""
+        job = self._queue_job(queue_id)
+        if job is None:
+            print(f"🏁 Задание очереди {queue_id}: {state}")
+            return
+        job.result = summary
+        job.set_state(state, result=summary)
+
+    def health(self):
+        """Состояние демона"""
+        jobs = self.list_jobs()
+        return {
+            'status': 'ok',
+            'uptime': round(time.time() - self.started_at, 1),
+            'browser_ready': self.parse_worker.browser_ready,
+            'concurrency_limit': self.concurrency.current_limit,
+            'in_flight': self.concurrency.in_flight,
+            'jobs': {state: sum(1 for job in jobs if job.state == state)
+                     for state in ('queued', 'running', 'done', 'failed', 'cancelled')},
+            'queued_tracks': sum(job['tasks'].get('pending', 0)
+                                 for job in self.job_queue.list_jobs(include_finished=False)),
+        }
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    """Обработчик HTTP/JSON API демона"""
+
+    server_version = 'MusicDaemon/1.0'
+
+    @property
+    def music_daemon(self):
+        return self.server.music_daemon
+
+    def log_message(self, format, *args):
+        # Запросы не логируем: события заданий клиенты получают через /events
+        pass
+
+    def _send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def _route(self):
+        """(путь по частям, query)"""
+        parsed = urlparse(self.path)
+        return [part for part in parsed.path.split('/') if part], parse_qs(parsed.query)
+
+    def do_GET(self):
+        parts, query = self._route()
+
+        if parts == ['health']:
+            self._send_json(200, self.music_daemon.health())
+        elif parts == ['jobs']:
+            self._send_json(200, [job.to_dict() for job in self.music_daemon.list_jobs()])
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            job = self.music_daemon.get_job(parts[1])
+            if job:
+                self._send_json(200, job.to_dict(include_tracks=True))
+            else:
+                self._send_json(404, {'error': 'job not found'})
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'events':
+            job = self.music_daemon.get_job(parts[1])
+            if job:
+                self._stream_events(job, int(query.get('since', ['0'])[0]))
+            else:
+                self._send_json(404, {'error': 'job not found'})
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        parts, _ = self._route()
+
+        if parts == ['jobs']:
+            try:
+                job = self.music_daemon.submit(self._read_json())
+            except ValueError as e:
+                self._send_json(400, {'error': str(e)})
+                return
+            self._send_json(201, job.to_dict())
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'cancel':
+            job = self.music_daemon.cancel(parts[1])
+            if job:
+                self._send_json(200, job.to_dict())
+            else:
+                self._send_json(404, {'error': 'job not found'})
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def _stream_events(self, job, since):
+        """Отдаёт события задания построчно (NDJSON), пока задание не завершится"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+        try:
+            while True:
+                events, since, done = job.events_since(since, timeout=15.0)
+                for event in events:
+                    self.wfile.write((json.dumps(event, ensure_ascii=False) + '\n').encode('utf-8'))
+                if not events:
+                    # Пустая строка держит соединение живым
+                    self.wfile.write(b'\n')
+                self.wfile.flush()
+                if done:
+                    return
+        except (BrokenPipeError, ConnectionResetError):
+            # Клиент отключился - задание продолжает работать
+            return
+
+
+class DaemonClient:
+    """Клиент API демона (для download_music.py и GUI)"""
+
+    def __init__(self, url=DEFAULT_DAEMON_URL):
+        self.url = url.rstrip('/')
+
+    def _request(self, method, path, data=None, timeout=CLIENT_TIMEOUT):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8') if data is not None else None
+        request = urllib.request.Request(
+            self.url + path, data=body, method=method,
+            headers={'Content-Type': 'application/json'} if body else {}
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.loads(e.read().decode('utf-8')).get('error', str(e))
+            except ValueError:
+                message = str(e)
+            raise RuntimeError(f"Демон: {message}") from e
+
+    def is_running(self):
+        """True если демон отвечает"""
+        try:
+            self.health()
+            return True
+        except (OSError, RuntimeError):
+            return False
+
+    def health(self):
+        return self._request('GET', '/health', timeout=3)
+
+    def submit_parse(self, url):
+        """Задание парсинга плейлиста; результат: csv_path, playlist_name, songs"""
+        return self._request('POST', '/jobs', {'type': 'parse', 'url': url})
+
+    def submit_download(self, output_dir, csv_path=None, songs=None, playlist_name=None, normalize=True,
+                        output_format=download_music.DEFAULT_OUTPUT_FORMAT, report_dir=None, priority='interactive',
+                        loudness='track', gain_mode='tags'):
+        """Задание скачивания по CSV на стороне демона или по списку треков"""
+        params = {
+            'type': 'download',
+            'output_dir': str(Path(output_dir).resolve()),
+            'normalize': normalize,
+            'output_format': output_format,
+            'priority': priority,
+            'loudness': loudness,
+            'gain_mode': gain_mode,
+        }
+        if csv_path:
+            params['csv_path'] = str(Path(csv_path).resolve())
+        if songs is not None:
+            params['songs'] = songs
+            params['playlist_name'] = playlist_name
+        if report_dir:
+            params['report_dir'] = str(Path(report_dir).resolve())
+        return self._request('POST', '/jobs', params)
+
+    def status(self, job_id):
+        return self._request('GET', f'/jobs/{job_id}')
+
+    def cancel(self, job_id):
+        return self._request('POST', f'/jobs/{job_id}/cancel')
+
+    def follow(self, job_id, on_event):
+        """
+        Передаёт события задания в on_event до его завершения
+
+        Returns:
+            Итоговый статус задания
+        """
+        for event in self.events(job_id):
+            on_event(event)
+        return self.status(job_id)
+
+    def events(self, job_id, since=0):
+        """
+        Поток событий задания до его завершения
+
+        Yields:
+            dict события (type: state, log, progress, track)
+        """
+        with urllib.request.urlopen(f"{self.url}/jobs/{job_id}/events?since={since}") as response:
+            for line in response:
+                line = line.strip()
+                if line:
+                    yield json.loads(line.decode('utf-8'))
+
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, workers=4, queue_path=None):
+    """Запускает демон и обслуживает API до Ctrl+C"""
+    music_daemon = MusicDaemon(workers=workers, queue_path=queue_path)
+    music_daemon.start()
+
+    server = ThreadingHTTPServer((host, port), DaemonRequestHandler)
+    server.daemon_threads = True
+    server.music_daemon = music_daemon
+
+    print(f"🛰️  Демон слушает http://{host}:{port} (до {workers} треков параллельно)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n⏹️  Останавливаю демон...")
+    finally:
+        music_daemon.stop()
+        server.server_close()
+
+
+def main():
+    """Главная функция"""
+    if '--help' in sys.argv:
+        print("Использование:")
+        print(f"  python3 {sys.argv[0]} [--host=HOST] [--port=PORT] [--workers=N] [--db=FILE] [--rate=R] [--bandwidth=S [--bandwidth-persist]]")
+        print("\nОпции:")
+        print(f"  --host=HOST   Адрес (по умолчанию {DEFAULT_HOST}, только локальные клиенты)")
+        print(f"  --port=PORT   Порт (по умолчанию {DEFAULT_PORT})")
+        print("  --workers=N   Треков одновременно на все задания (по умолчанию 4)")
+        print("  --db=FILE     Файл очереди заданий (по умолчанию общий с job_queue.py)")
+        print(f"  --rate=R      Общий лимит запросов к YouTube в секунду (по умолчанию {throttle.DEFAULT_REQUEST_RATE})")
+        print("  --bandwidth=S Общий бюджет полосы скачиваний: 2M или 08:00-19:00=2M,19:00-08:00=20M")
+        print("                (пока работает демон; с --bandwidth-persist - и после него)")
+        print("\nКлиенты:")
+        print("  python3 download_music.py songs.csv --daemon")
+        print("  python3 music_downloader_gui.py --daemon")
+        sys.exit(0)
+
+    host = download_music.get_option(sys.argv, 'host', DEFAULT_HOST)
+    port = int(download_music.get_option(sys.argv, 'port', DEFAULT_PORT))
+    workers = int(download_music.get_option(sys.argv, 'workers', 4))
+    queue_path = download_music.get_option(sys.argv, 'db')
+    rate = download_music.get_option(sys.argv, 'rate')
+    if rate:
+        throttle.configure_request_limiter(float(rate))
+    bandwidth = download_music.get_option(sys.argv, 'bandwidth')
+    if bandwidth:
+        throttle.configure_bandwidth(bandwidth, persist='--bandwidth-persist' in sys.argv)
+
+    serve(host, port, workers, queue_path)
+
+
+if __name__ == "__main__":
+    main()
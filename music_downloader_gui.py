@@ -10,18 +10,31 @@ Music Downloader GUI - Final Version
 
 import sys
 import re
+import threading
+from collections import deque
 from pathlib import Path
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-    QPushButton, QLabel, QProgressBar, QTextEdit, QFileDialog,
-    QCheckBox, QLineEdit, QGroupBox, QMessageBox, QComboBox, QScrollArea
+    QPushButton, QLabel, QProgressBar, QPlainTextEdit, QFileDialog,
+    QCheckBox, QLineEdit, QGroupBox, QMessageBox, QComboBox, QScrollArea,
+    QTableView, QHeaderView, QAbstractItemView
 )
-from PyQt5.QtCore import Qt, QThread, pyqtSignal
-from PyQt5.QtGui import QFont
+from PyQt5.QtCore import Qt, QThread, QTimer, pyqtSignal, QAbstractTableModel, QModelIndex
+from PyQt5.QtGui import QFont, QColor
 
+import profiling
 from translations import Translator
-from parse_spotify_playlist import parse_spotify_playlist
-from download_music import download_from_csv
+from parse_spotify_playlist import (
+    CSV_FIELDS, TRACK_COUNT_SCRIPT, load_snapshot, match_snapshot, merge_snapshot, parse_spotify_playlist,
+    row_duration, save_snapshot
+)
+from download_music import DEFAULT_OUTPUT_FORMAT, OUTPUT_FORMATS, download_from_csv, get_daemon_url
+from music_daemon import DaemonClient
+from process_runner import CancelToken
+
+# Сколько ждать завершения рабочего потока после отмены (мс):
+# SIGTERM процессам + KILL_GRACE_PERIOD до SIGKILL
+CANCEL_WAIT_MS = 8000
 
 
 def clean_spotify_url(url):
@@ -43,34 +56,225 @@ def clean_spotify_url(url):
     return url
 
 
+# Как часто GUI забирает накопленные строки лога (мс)
+LOG_FLUSH_INTERVAL_MS = 100
+
+# Сколько последних строк хранит окно лога (и буфер между сбросами)
+LOG_MAX_LINES = 2000
+
+
+def cancel_daemon_job(daemon_client, job_id):
+    """Отменяет задание демона (если работаем через демон и задание уже создано)"""
+    if daemon_client and job_id:
+        try:
+            daemon_client.cancel(job_id)
+        except (OSError, RuntimeError):
+            pass
+
+
+class LogBuffer:
+    """
+    Буфер строк лога между рабочими потоками и GUI
+
+    Потоки пишут сюда вместо сигнала на каждую строку, а GUI по таймеру
+    забирает всё накопленное и добавляет одним блоком. Буфер ограничен:
+    если GUI не успевает, самые старые строки отбрасываются.
+    """
+
+    def __init__(self, max_lines=LOG_MAX_LINES):
+        self._lines = deque(maxlen=max_lines)
+        self._lock = threading.Lock()
+
+    def write(self, message):
+        """Добавляет сообщение (из любого потока)"""
+        with self._lock:
+            self._lines.append(message)
+
+    def drain(self):
+        """Забирает все накопленные сообщения"""
+        with self._lock:
+            lines = list(self._lines)
+            self._lines.clear()
+        return lines
+
+
+class TrackTableModel(QAbstractTableModel):
+    """
+    Per-track progress table: stage, percent, speed and ETA
+
+    Worker threads call queue_update(); updates are coalesced per track and
+    applied from the GUI timer via apply_pending(), which emits dataChanged
+    only for the rows that actually changed.
+    """
+
+    COLUMNS = ['col_number', 'col_track', 'col_stage', 'col_percent', 'col_speed', 'col_eta']
+    STAGE_COLUMN = 2
+
+    STAGE_COLORS = {
+        'downloading': '#1DB954',
+        'normalizing': '#1DB954',
+        'converting': '#1DB954',
+        'searching': '#FFD700',
+        'retrying': '#FFA500',
+        'failed': '#ff4444',
+        'done': '#B3B3B3',
+        'skipped': '#B3B3B3',
+        'cancelled': '#B3B3B3',
+    }
+
+    def __init__(self, translator, parent=None):
+        super().__init__(parent)
+        self.tr = translator
+        self._rows = []
+        self._row_by_num = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def set_tracks(self, songs):
+        """Fill the table with playlist tracks in the 'waiting' stage"""
+        self.beginResetModel()
+        self._rows = []
+        self._row_by_num = {}
+        for song in songs:
+            num = song.get('№', '').zfill(2)
+            self._row_by_num[num] = len(self._rows)
+            self._rows.append({
+                'num': num,
+                'title': f"{song.get('Артист', '')} - {song.get('Песня', '')}",
+                'stage': 'waiting',
+                'percent': None,
+                'speed': None,
+                'eta': None,
+            })
+        with self._lock:
+            self._pending.clear()
+        self.endResetModel()
+
+    def queue_update(self, num, stage, percent=None, speed=None, eta=None):
+        """Record a track update (safe to call from any thread)"""
+        with self._lock:
+            self._pending[num] = (stage, percent, speed, eta)
+
+    def apply_pending(self):
+        """Apply coalesced updates and repaint only the changed rows (GUI thread)"""
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+
+        changed = []
+        for num, (stage, percent, speed, eta) in pending.items():
+            row = self._row_by_num.get(num)
+            if row is None:
+                continue
+            values = {'stage': stage, 'percent': percent, 'speed': speed, 'eta': eta}
+            if any(self._rows[row][key] != value for key, value in values.items()):
+                self._rows[row].update(values)
+                changed.append(row)
+
+        # Соседние строки объединяем в один диапазон dataChanged
+        changed.sort()
+        start = None
+        for i, row in enumerate(changed):
+            if start is None:
+                start = row
+            if i + 1 == len(changed) or changed[i + 1] != row + 1:
+                self.dataChanged.emit(
+                    self.index(start, self.STAGE_COLUMN),
+                    self.index(row, len(self.COLUMNS) - 1)
+                )
+                start = None
+
+    def retranslate(self):
+        """Refresh headers and stage names after a language change"""
+        self.headerDataChanged.emit(Qt.Horizontal, 0, len(self.COLUMNS) - 1)
+        if self._rows:
+            self.dataChanged.emit(
+                self.index(0, self.STAGE_COLUMN),
+                self.index(len(self._rows) - 1, self.STAGE_COLUMN)
+            )
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self._rows[index.row()]
+        column = index.column()
+
+        if role == Qt.DisplayRole:
+            if column == 0:
+                return row['num']
+            if column == 1:
+                return row['title']
+            if column == 2:
+                return self.tr.tr(f"stage_{row['stage']}")
+            if column == 3:
+                return f"{row['percent']:.0f}%" if row['percent'] is not None else ""
+            if column == 4:
+                return row['speed'] or ""
+            if column == 5:
+                return row['eta'] or ""
+        elif role == Qt.ForegroundRole and column == self.STAGE_COLUMN:
+            color = self.STAGE_COLORS.get(row['stage'])
+            return QColor(color) if color else None
+        elif role == Qt.TextAlignmentRole and column in (0, 3, 4, 5):
+            return int(Qt.AlignRight | Qt.AlignVCenter)
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.tr.tr(self.COLUMNS[section])
+        return None
+
+
 class ParseThread(QThread):
     """Thread for parsing Spotify playlist"""
 
-    log = pyqtSignal(str)
     finished = pyqtSignal(bool, str, list)
 
-    def __init__(self, playlist_url, translator):
+    def __init__(self, playlist_url, translator, log_buffer, daemon_client=None):
         super().__init__()
         self.playlist_url = playlist_url
         self.tr = translator
+        self.log_buffer = log_buffer
+        self.daemon_client = daemon_client
+        self.job_id = None
         self._is_running = True
+        # Playwright не остановить из другого потока: токен проверяется между его шагами,
+        # а паузы прокрутки прерываются сразу
+        self.cancel_token = CancelToken()
 
     def run(self):
+        with profiling.thread_profile():
+            self._run()
+
+    def _run(self):
+        if self.daemon_client:
+            self._run_remote()
+            return
+
         try:
-            self.log.emit(f"🔍 {self.tr.tr('log_opening_playlist', url=self.playlist_url)}")
+            self.log_buffer.write(f"🔍 {self.tr.tr('log_opening_playlist', url=self.playlist_url)}")
 
             from playwright.sync_api import sync_playwright
-            import time
+
+            # Снимок прошлого парсинга: если новые треки только в начале, прокрутка не нужна
+            snapshot = load_snapshot(self.playlist_url)
 
             with sync_playwright() as p:
                 browser = p.chromium.launch(headless=True)
                 page = browser.new_page()
                 page.set_viewport_size({"width": 1920, "height": 5000})
 
-                self.log.emit(f"📡 {self.tr.tr('log_loading_page')}")
+                self.log_buffer.write(f"📡 {self.tr.tr('log_loading_page')}")
                 page.goto(self.playlist_url, wait_until='domcontentloaded')
-                page.wait_for_selector('[data-testid="tracklist-row"]', timeout=10000)
-                time.sleep(3)
+                if not self.cancel_token.cancelled:
+                    page.wait_for_selector('[data-testid="tracklist-row"]', timeout=10000)
+                    self.cancel_token.wait(3)
 
                 playlist_name = "playlist"
                 try:
@@ -80,49 +284,67 @@ class ParseThread(QThread):
                         if text and text != "Your Library" and len(text) > 0:
                             playlist_name = text
                             break
-                    self.log.emit(f"📀 {self.tr.tr('log_playlist_name', name=playlist_name)}")
+                    self.log_buffer.write(f"📀 {self.tr.tr('log_playlist_name', name=playlist_name)}")
                 except:
                     pass
 
-                self.log.emit(f"📜 {self.tr.tr('log_loading_tracks')}")
+                self.log_buffer.write(f"📜 {self.tr.tr('log_loading_tracks')}")
                 previous_count = 0
                 no_change_count = 0
+                new_count = None
+                total_count = page.evaluate(TRACK_COUNT_SCRIPT) if snapshot else None
+                if total_count is None:
+                    snapshot = None
 
                 for scroll_attempt in range(100):
-                    if not self._is_running:
+                    if self.cancel_token.cancelled:
                         browser.close()
                         self.finished.emit(False, "", [])
                         return
 
+                    if snapshot:
+                        status, new_count = match_snapshot(page, snapshot, total_count)
+                        if status == 'confirmed':
+                            self.log_buffer.write(f"⚡ {self.tr.tr('log_snapshot_confirmed', new=new_count, known=len(snapshot['songs']))}")
+                            break
+                        if status == 'mismatch':
+                            self.log_buffer.write(f"📜 {self.tr.tr('log_snapshot_changed')}")
+                            snapshot = None
+
                     current_tracks = page.locator('[data-testid="tracklist-row"]').count()
 
                     if scroll_attempt % 10 == 0:
-                        self.log.emit(f"   {self.tr.tr('log_tracks_loaded', count=current_tracks)}")
+                        self.log_buffer.write(f"   {self.tr.tr('log_tracks_loaded', count=current_tracks)}")
 
                     has_recommended = page.locator('h2:has-text("Recommended")').count() > 0
                     if has_recommended:
-                        self.log.emit(f"📌 {self.tr.tr('log_recommended_found')}")
+                        self.log_buffer.write(f"📌 {self.tr.tr('log_recommended_found')}")
                         break
 
                     if current_tracks == previous_count:
                         no_change_count += 1
                         if no_change_count >= 10:
-                            self.log.emit(f"✓ {self.tr.tr('log_all_tracks_loaded', count=current_tracks)}")
+                            self.log_buffer.write(f"✓ {self.tr.tr('log_all_tracks_loaded', count=current_tracks)}")
                             break
                     else:
                         no_change_count = 0
 
                     previous_count = current_tracks
                     page.evaluate("window.scrollBy(0, 1000)")
-                    time.sleep(0.5)
+                    self.cancel_token.wait(0.5)
+
+                if new_count is None:
+                    snapshot = None
 
                 songs = []
                 all_track_rows = page.locator('[data-testid="tracklist-row"]').all()
-                self.log.emit(f"🎵 {self.tr.tr('log_parsing_tracks', count=len(all_track_rows))}")
+                if snapshot:
+                    all_track_rows = all_track_rows[:new_count]
+                self.log_buffer.write(f"🎵 {self.tr.tr('log_parsing_tracks', count=len(all_track_rows))}")
 
                 last_track_number = 0
                 for idx, row in enumerate(all_track_rows):
-                    if not self._is_running:
+                    if self.cancel_token.cancelled:
                         break
 
                     try:
@@ -161,11 +383,12 @@ class ParseThread(QThread):
                                 '№': str(len(songs) + 1),
                                 'Песня': track_name,
                                 'Артист': artist_name,
-                                'Альбом': album_name
+                                'Альбом': album_name,
+                                'Длительность': row_duration(row)
                             })
 
                             if len(songs) % 10 == 0:
-                                self.log.emit(f"   {self.tr.tr('log_processed_tracks', count=len(songs))}")
+                                self.log_buffer.write(f"   {self.tr.tr('log_processed_tracks', count=len(songs))}")
 
                     except:
                         if len(songs) > 0:
@@ -174,50 +397,104 @@ class ParseThread(QThread):
 
                 browser.close()
 
+            # Отменённый парсинг не отдаёт неполный список треков на скачивание
+            if self.cancel_token.cancelled:
+                self.finished.emit(False, "", [])
+                return
+            if snapshot:
+                songs = merge_snapshot(songs, snapshot)
             if not songs:
                 self.finished.emit(False, "", [])
                 return
+            if self._is_running:
+                save_snapshot(self.playlist_url, playlist_name, songs, snapshot)
 
-            self.log.emit(f"✅ {self.tr.tr('log_tracks_found', count=len(songs))}")
+            self.log_buffer.write(f"✅ {self.tr.tr('log_tracks_found', count=len(songs))}")
             self.finished.emit(True, playlist_name, songs)
 
         except Exception as e:
-            self.log.emit(f"❌ {self.tr.tr('log_parse_error', error=str(e))}")
+            self.log_buffer.write(f"❌ {self.tr.tr('log_parse_error', error=str(e))}")
+            self.finished.emit(False, "", [])
+
+    def _run_remote(self):
+        """Parse through the daemon, which keeps Chromium warm between playlists"""
+        try:
+            self.log_buffer.write(f"🔍 {self.tr.tr('log_opening_playlist', url=self.playlist_url)}")
+            job = self.daemon_client.submit_parse(self.playlist_url)
+            self.job_id = job['id']
+            self.log_buffer.write(f"🛰️ {self.tr.tr('log_daemon_job', id=job['id'])}")
+
+            def on_event(event):
+                if event['type'] == 'log':
+                    self.log_buffer.write(event['message'])
+
+            status = self.daemon_client.follow(job['id'], on_event)
+            result = status.get('result') or {}
+            if not self._is_running or status['state'] != 'done' or not result.get('songs'):
+                if status.get('error'):
+                    self.log_buffer.write(f"❌ {self.tr.tr('log_parse_error', error=status['error'])}")
+                self.finished.emit(False, "", [])
+                return
+
+            songs = result['songs']
+            self.log_buffer.write(f"✅ {self.tr.tr('log_tracks_found', count=len(songs))}")
+            self.finished.emit(True, result.get('playlist_name') or "playlist", songs)
+
+        except Exception as e:
+            self.log_buffer.write(f"❌ {self.tr.tr('log_parse_error', error=str(e))}")
             self.finished.emit(False, "", [])
 
     def stop(self):
         self._is_running = False
+        self.cancel_token.cancel()
+        cancel_daemon_job(self.daemon_client, self.job_id)
 
 
 class DownloadThread(QThread):
     """Thread for downloading music"""
 
     progress = pyqtSignal(int, int)
-    log = pyqtSignal(str)
     finished = pyqtSignal(bool, str)
 
-    def __init__(self, songs, output_dir, normalize, translator):
+    def __init__(self, songs, output_dir, normalize, translator, log_buffer, track_callback=None,
+                 output_format=DEFAULT_OUTPUT_FORMAT, daemon_client=None):
         super().__init__()
+        self.daemon_client = daemon_client
+        self.job_id = None
         self.songs = songs
         self.output_dir = output_dir
         self.normalize = normalize
+        self.output_format = output_format
         self.tr = translator
+        self.log_buffer = log_buffer
+        self.track_callback = track_callback
+        self.cancel_token = CancelToken()
         self._is_running = True
 
     def run(self):
+        with profiling.thread_profile():
+            self._run()
+
+    def _run(self):
+        if self.daemon_client:
+            self._run_remote()
+            return
+
+        tmp_path = None
         try:
             import csv
             import tempfile
 
             with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.csv', encoding='utf-8') as tmp:
                 tmp.write(f"# Playlist: Spotify Playlist\n")
-                writer = csv.DictWriter(tmp, fieldnames=['№', 'Песня', 'Артист', 'Альбом'])
+                # Треки из старых CSV без длительности пишутся с пустым столбцом
+                writer = csv.DictWriter(tmp, fieldnames=CSV_FIELDS, extrasaction='ignore')
                 writer.writeheader()
                 writer.writerows(self.songs)
                 tmp_path = tmp.name
 
-            self.log.emit(f"📂 {self.tr.tr('log_starting_download', count=len(self.songs))}")
-            self.log.emit(f"📁 {self.tr.tr('log_saving_to', folder=self.output_dir)}\n")
+            self.log_buffer.write(f"📂 {self.tr.tr('log_starting_download', count=len(self.songs))}")
+            self.log_buffer.write(f"📁 {self.tr.tr('log_saving_to', folder=self.output_dir)}\n")
 
             # Колбэки для прогресса и лога
             def on_progress(current, total):
@@ -226,7 +503,11 @@ class DownloadThread(QThread):
 
             def on_log(message):
                 if self._is_running:
-                    self.log.emit(message)
+                    self.log_buffer.write(message)
+
+            def on_track(num, stage, percent, speed, eta):
+                if self._is_running and self.track_callback:
+                    self.track_callback(num, stage, percent, speed, eta)
 
             download_from_csv(
                 tmp_path,
@@ -234,20 +515,63 @@ class DownloadThread(QThread):
                 normalize=self.normalize,
                 progress_callback=on_progress,
                 log_callback=on_log,
-                stop_check=lambda: not self._is_running
+                track_callback=on_track,
+                stop_check=lambda: not self._is_running,
+                cancel_token=self.cancel_token,
+                output_format=self.output_format
             )
-            Path(tmp_path).unlink()
 
             if self._is_running:
                 success_msg = f"✅ Downloaded {len(self.songs)} tracks successfully!"
                 self.finished.emit(True, success_msg)
 
         except Exception as e:
-            self.log.emit(f"❌ {self.tr.tr('log_download_error', error=str(e))}")
+            self.log_buffer.write(f"❌ {self.tr.tr('log_download_error', error=str(e))}")
+            self.finished.emit(False, f"Error: {str(e)}")
+        finally:
+            if tmp_path:
+                Path(tmp_path).unlink(missing_ok=True)
+
+    def _run_remote(self):
+        """Download through the daemon: the job shares its concurrency limit and caches"""
+        try:
+            self.log_buffer.write(f"📂 {self.tr.tr('log_starting_download', count=len(self.songs))}")
+            self.log_buffer.write(f"📁 {self.tr.tr('log_saving_to', folder=self.output_dir)}\n")
+            job = self.daemon_client.submit_download(
+                self.output_dir, songs=self.songs, normalize=self.normalize, output_format=self.output_format
+            )
+            self.job_id = job['id']
+            self.log_buffer.write(f"🛰️ {self.tr.tr('log_daemon_job', id=job['id'])}")
+
+            def on_event(event):
+                if not self._is_running:
+                    return
+                if event['type'] == 'log':
+                    self.log_buffer.write(event['message'])
+                elif event['type'] == 'progress':
+                    self.progress.emit(event['current'], event['total'])
+                elif event['type'] == 'track' and self.track_callback:
+                    self.track_callback(event['num'], event['stage'], event['percent'], event['speed'], event['eta'])
+
+            status = self.daemon_client.follow(job['id'], on_event)
+
+            if self._is_running:
+                if status['state'] == 'done':
+                    self.finished.emit(True, f"✅ Downloaded {len(self.songs)} tracks successfully!")
+                else:
+                    error = status.get('error') or status['state']
+                    self.log_buffer.write(f"❌ {self.tr.tr('log_download_error', error=error)}")
+                    self.finished.emit(False, f"Error: {error}")
+
+        except Exception as e:
+            self.log_buffer.write(f"❌ {self.tr.tr('log_download_error', error=str(e))}")
             self.finished.emit(False, f"Error: {str(e)}")
 
     def stop(self):
+        """Stop downloading and kill running yt-dlp/ffmpeg processes"""
         self._is_running = False
+        self.cancel_token.cancel()
+        cancel_daemon_job(self.daemon_client, self.job_id)
 
 
 class MusicDownloaderGUI(QMainWindow):
@@ -260,21 +584,30 @@ class MusicDownloaderGUI(QMainWindow):
     SPOTIFY_LIGHT_GRAY = "#B3B3B3"
     SPOTIFY_WHITE = "#FFFFFF"
 
-    def __init__(self):
+    def __init__(self, daemon_url=None):
         super().__init__()
         self.tr = Translator('en')
+        # С --daemon парсинг и скачивание выполняет music_daemon.py, окно - только клиент
+        self.daemon_client = DaemonClient(daemon_url) if daemon_url else None
         self.playlist_url = None
         self.songs = []
         self.playlist_name = ""
         self.parse_thread = None
         self.download_thread = None
+        self.log_buffer = LogBuffer()
+        self.track_model = TrackTableModel(self.tr, self)
         self.init_ui()
 
+        # Лог и таблица треков обновляются пачками по таймеру, а не по сигналу на каждое событие
+        self.update_timer = QTimer(self)
+        self.update_timer.timeout.connect(self.flush_updates)
+        self.update_timer.start(LOG_FLUSH_INTERVAL_MS)
+
     def init_ui(self):
         """Initialize UI"""
         self.setWindowTitle(self.tr.tr('window_title'))
-        self.setGeometry(100, 100, 900, 650)
-        self.setMinimumSize(850, 600)
+        self.setGeometry(100, 100, 900, 860)
+        self.setMinimumSize(850, 800)
 
         # Main widget
         central_widget = QWidget()
@@ -459,6 +792,37 @@ class MusicDownloaderGUI(QMainWindow):
         """)
         settings_layout.addWidget(self.normalize_checkbox)
 
+        format_layout = QHBoxLayout()
+        self.format_label = QLabel(self.tr.tr('format_label'))
+        self.format_label.setStyleSheet(f"color: {self.SPOTIFY_WHITE};")
+        format_layout.addWidget(self.format_label)
+
+        self.format_combo = QComboBox()
+        for output_format in OUTPUT_FORMATS:
+            self.format_combo.addItem(self.tr.tr(f'format_{output_format}'), output_format)
+        # Оба формата из одного скачивания (каждый в свою подпапку)
+        self.format_combo.addItem(self.tr.tr('format_mp3_opus'), 'mp3,opus')
+        self.format_combo.setStyleSheet(f"""
+            QComboBox {{
+                background-color: {self.SPOTIFY_DARK_GRAY};
+                color: {self.SPOTIFY_WHITE};
+                border: 1px solid {self.SPOTIFY_GREEN};
+                padding: 5px;
+                border-radius: 4px;
+            }}
+            QComboBox::drop-down {{
+                border: none;
+            }}
+            QComboBox QAbstractItemView {{
+                background-color: {self.SPOTIFY_DARK_GRAY};
+                color: {self.SPOTIFY_WHITE};
+                selection-background-color: {self.SPOTIFY_GREEN};
+            }}
+        """)
+        format_layout.addWidget(self.format_combo)
+        format_layout.addStretch()
+        settings_layout.addLayout(format_layout)
+
         self.settings_group.setLayout(settings_layout)
         main_layout.addWidget(self.settings_group)
 
@@ -489,6 +853,40 @@ class MusicDownloaderGUI(QMainWindow):
         self.progress_label.setStyleSheet(f"font-weight: bold; margin-top: 5px; color: {self.SPOTIFY_WHITE};")
         progress_layout.addWidget(self.progress_label)
 
+        self.track_table = QTableView()
+        self.track_table.setModel(self.track_model)
+        self.track_table.setMinimumHeight(170)
+        self.track_table.setSelectionMode(QAbstractItemView.NoSelection)
+        self.track_table.setShowGrid(False)
+        self.track_table.verticalHeader().setVisible(False)
+        # Фиксированная высота строк: Qt не измеряет содержимое тысяч строк
+        self.track_table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.track_table.verticalHeader().setDefaultSectionSize(22)
+        header = self.track_table.horizontalHeader()
+        header.setSectionResizeMode(QHeaderView.Fixed)
+        header.setSectionResizeMode(1, QHeaderView.Stretch)
+        header.resizeSection(0, 44)
+        header.resizeSection(2, 120)
+        header.resizeSection(3, 56)
+        header.resizeSection(4, 96)
+        header.resizeSection(5, 64)
+        self.track_table.setStyleSheet(f"""
+            QTableView {{
+                background-color: {self.SPOTIFY_BLACK};
+                color: {self.SPOTIFY_WHITE};
+                border: 1px solid {self.SPOTIFY_DARK_GRAY};
+                border-radius: 4px;
+                font-size: 11px;
+            }}
+            QHeaderView::section {{
+                background-color: {self.SPOTIFY_DARK_GRAY};
+                color: {self.SPOTIFY_LIGHT_GRAY};
+                border: none;
+                padding: 4px;
+            }}
+        """)
+        progress_layout.addWidget(self.track_table)
+
         self.progress_group.setLayout(progress_layout)
         main_layout.addWidget(self.progress_group)
 
@@ -496,12 +894,14 @@ class MusicDownloaderGUI(QMainWindow):
         self.log_group = QGroupBox(self.tr.tr('log_group_title'))
         log_layout = QVBoxLayout()
 
-        self.log_text = QTextEdit()
+        self.log_text = QPlainTextEdit()
         self.log_text.setReadOnly(True)
+        # Кольцевой буфер: старые строки удаляются, память не растёт на длинных прогонах
+        self.log_text.setMaximumBlockCount(LOG_MAX_LINES)
         self.log_text.setMinimumHeight(80)
         self.log_text.setMaximumHeight(80)
         self.log_text.setStyleSheet(f"""
-            QTextEdit {{
+            QPlainTextEdit {{
                 background-color: {self.SPOTIFY_BLACK};
                 color: #FFD700;
                 font-family: 'Courier New', monospace;
@@ -612,8 +1012,13 @@ class MusicDownloaderGUI(QMainWindow):
         self.output_label.setText(self.tr.tr('output_folder_label'))
         self.path_browse.setText(self.tr.tr('btn_browse'))
         self.normalize_checkbox.setText(self.tr.tr('normalize_checkbox'))
+        self.format_label.setText(self.tr.tr('format_label'))
+        for index in range(self.format_combo.count()):
+            key = self.format_combo.itemData(index).replace(',', '_')
+            self.format_combo.setItemText(index, self.tr.tr(f'format_{key}'))
         self.progress_group.setTitle(self.tr.tr('progress_group_title'))
         self.log_group.setTitle(self.tr.tr('log_group_title'))
+        self.track_model.retranslate()
         self.download_btn.setText(self.tr.tr('btn_download'))
         self.cancel_btn.setText(self.tr.tr('btn_cancel'))
 
@@ -678,8 +1083,19 @@ class MusicDownloaderGUI(QMainWindow):
             self.output_path.setText(dir_path)
 
     def log_message(self, message):
-        """Add message to log"""
-        self.log_text.append(message)
+        """Add message to log (shown on the next flush)"""
+        self.log_buffer.write(message)
+
+    def flush_updates(self):
+        """Timer tick: flush buffered log lines and coalesced track updates"""
+        self.flush_log()
+        self.track_model.apply_pending()
+
+    def flush_log(self):
+        """Append all buffered log messages in one operation"""
+        lines = self.log_buffer.drain()
+        if lines:
+            self.log_text.appendPlainText('\n'.join(lines))
 
     def start_download(self):
         """Start process: parse -> download"""
@@ -691,12 +1107,13 @@ class MusicDownloaderGUI(QMainWindow):
         self.cancel_btn.setEnabled(True)
         self.url_input.setEnabled(False)
 
+        self.log_buffer.drain()
         self.log_text.clear()
         self.progress_bar.setValue(0)
         self.progress_label.setText(self.tr.tr('status_parsing'))
 
-        self.parse_thread = ParseThread(self.playlist_url, self.tr)
-        self.parse_thread.log.connect(self.log_message)
+        self.parse_thread = ParseThread(self.playlist_url, self.tr, self.log_buffer,
+                                        daemon_client=self.daemon_client)
         self.parse_thread.finished.connect(self.on_parse_finished)
         self.parse_thread.start()
 
@@ -706,6 +1123,7 @@ class MusicDownloaderGUI(QMainWindow):
         """Parsing finished, start download"""
         if not success or not songs:
             self.log_message(f"❌ {self.tr.tr('log_parse_failed')}")
+            self.flush_log()
             QMessageBox.warning(self, self.tr.tr('error_title'), self.tr.tr('error_parse_failed'))
             self.reset_ui()
             return
@@ -722,8 +1140,13 @@ class MusicDownloaderGUI(QMainWindow):
         if not output_dir:
             output_dir = str(Path.home() / "Music" / "Spotify Downloads")
 
-        self.download_thread = DownloadThread(self.songs, output_dir, self.normalize_checkbox.isChecked(), self.tr)
-        self.download_thread.log.connect(self.log_message)
+        self.track_model.set_tracks(self.songs)
+        self.download_thread = DownloadThread(
+            self.songs, output_dir, self.normalize_checkbox.isChecked(), self.tr, self.log_buffer,
+            track_callback=self.track_model.queue_update,
+            output_format=self.format_combo.currentData(),
+            daemon_client=self.daemon_client
+        )
         self.download_thread.progress.connect(self.update_progress)
         self.download_thread.finished.connect(self.on_download_finished)
         self.download_thread.start()
@@ -737,6 +1160,7 @@ class MusicDownloaderGUI(QMainWindow):
     def on_download_finished(self, success, message):
         """Download finished"""
         self.log_message(f"\n{message}")
+        self.flush_log()
 
         if success:
             self.progress_bar.setValue(100)
@@ -755,15 +1179,15 @@ class MusicDownloaderGUI(QMainWindow):
         """Cancel operation"""
         if self.parse_thread and self.parse_thread.isRunning():
             self.log_message(f"⏸️ {self.tr.tr('log_stopping_parse')}")
+            # stop() отменяет токен: поток закрывает браузер на ближайшем шаге Playwright.
+            # Не ждем синхронно, чтобы не зависнуть на загрузке страницы
             self.parse_thread.stop()
-            # Не ждем синхронно, чтобы не зависнуть
-            self.parse_thread.quit()
 
         if self.download_thread and self.download_thread.isRunning():
             self.log_message(f"⏸️ {self.tr.tr('log_stopping_download')}")
+            # stop() убивает yt-dlp/ffmpeg, поэтому поток завершается за секунды
             self.download_thread.stop()
-            # Не ждем синхронно
-            self.download_thread.quit()
+            self.download_thread.wait(CANCEL_WAIT_MS)
 
         self.reset_ui()
         QApplication.processEvents()  # Обработать события GUI
@@ -774,15 +1198,33 @@ class MusicDownloaderGUI(QMainWindow):
         self.cancel_btn.setEnabled(False)
         self.url_input.setEnabled(True)
 
+    def closeEvent(self, event):
+        """Kill running downloads before the window closes so no yt-dlp/ffmpeg is left behind"""
+        if self.parse_thread and self.parse_thread.isRunning():
+            self.parse_thread.stop()
+            self.parse_thread.wait(CANCEL_WAIT_MS)
+        if self.download_thread and self.download_thread.isRunning():
+            self.download_thread.stop()
+            self.download_thread.wait(CANCEL_WAIT_MS)
+        super().closeEvent(event)
+
 
 def main():
     """Launch application"""
     app = QApplication(sys.argv)
     app.setStyle('Fusion')
 
-    window = MusicDownloaderGUI()
+    # --daemon[=URL]: окно работает как клиент демона
+    window = MusicDownloaderGUI(daemon_url=get_daemon_url(sys.argv))
     window.show()
 
+    # --profile[=DIR] / --profile-memory: профилируем всю сессию вместе с рабочими потоками
+    profile_dir, profile_memory = profiling.get_profile_options(sys.argv)
+    if profile_dir:
+        with profiling.profiled(profile_dir, memory=profile_memory):
+            exit_code = app.exec_()
+        sys.exit(exit_code)
+
     sys.exit(app.exec_())
 
 
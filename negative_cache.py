@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Negative Cache
+Треки, которые не удалось найти или скачать: причина и время следующей
+проверки, которое растёт экспоненциально с каждой новой неудачей
+"""
+
+import threading
+import time
+from pathlib import Path
+
+from app_cache import get_cache_dir, load_json, locked_json
+
+# Через сколько перепроверить трек после первой неудачи (секунды)
+NEGATIVE_BASE_TTL = 24 * 3600
+
+# Максимальный интервал перепроверки (секунды)
+NEGATIVE_MAX_TTL = 30 * 24 * 3600
+
+# Причины неудач, которые запоминаются: трек не найден или видео недоступно навсегда.
+# Сеть, троттлинг, ошибки окружения и отмена - не проблема трека
+CACHED_CAUSES = ('not_found', 'permanent')
+
+
+def track_key(artist, title):
+    """Ключ трека: артист и название в нижнем регистре"""
+    return f"{(artist or '').strip().lower()}|{(title or '').strip().lower()}"
+
+
+def negative_ttl(failures):
+    """Интервал перепроверки после failures неудач подряд: 1, 2, 4... дней, не больше NEGATIVE_MAX_TTL"""
+    return min(NEGATIVE_BASE_TTL * 2 ** max(0, failures - 1), NEGATIVE_MAX_TTL)
+
+
+class NegativeCache:
+    """
+    Кэш неудач, общий для всех процессов
+
+    negative.json: {ключ трека: {cause, error, failures, first_failed_at,
+    last_failed_at, retry_after}}. Пока retry_after не наступил, трек
+    пропускается без поиска и скачивания; успешное скачивание удаляет запись.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = Path(cache_dir) if cache_dir else get_cache_dir('search')
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.path = self.cache_dir / 'negative.json'
+        self._memory = None
+        self._lock = threading.Lock()
+
+    def _entries(self):
+        """Записи (читаются с диска один раз на процесс, дальше - из памяти)"""
+        with self._lock:
+            if self._memory is None:
+                self._memory = load_json(self.path, {})
+            return self._memory
+
+    def check(self, artist, title):
+        """
+        Действующая запись о неудаче
+
+        Returns:
+            dict записи, если трек пока не нужно перепроверять, иначе None
+        """
+        entry = self._entries().get(track_key(artist, title))
+        if entry and entry['retry_after'] > time.time():
+            return entry
+        return None
+
+    def record(self, artist, title, cause, error=None):
+        """
+        Запоминает неудачу и назначает следующую проверку
+
+        Returns:
+            dict записи или None, если причина не запоминается
+        """
+        if cause not in CACHED_CAUSES:
+            return None
+        now = time.time()
+
+        def update(entry):
+            failures = (entry or {}).get('failures', 0) + 1
+            return {
+                'cause': cause,
+                'error': error,
+                'failures': failures,
+                'first_failed_at': (entry or {}).get('first_failed_at', now),
+                'last_failed_at': now,
+                'retry_after': now + negative_ttl(failures),
+            }
+
+        return self._update(track_key(artist, title), update)
+
+    def clear(self, artist, title):
+        """Удаляет запись после успешного скачивания"""
+        key = track_key(artist, title)
+        if key in self._entries():
+            self._update(key, lambda entry: None)
+
+    def _update(self, key, update):
+        """Изменяет запись под файловой блокировкой (None - удалить)"""
+        with locked_json(self.path, {}) as entries:
+            entry = update(entries.get(key))
+            if entry is None:
+                entries.pop(key, None)
+            else:
+                entries[key] = entry
+            snapshot = dict(entries)
+        with self._lock:
+            self._memory = snapshot
+        return entry
+
+
+_negative_cache = None
+_negative_cache_lock = threading.Lock()
+
+
+def get_negative_cache():
+    """Общий кэш неудач в папке кэша приложения"""
+    global _negative_cache
+    with _negative_cache_lock:
+        if _negative_cache is None:
+            _negative_cache = NegativeCache()
+        return _negative_cache
@@ -5,37 +5,179 @@ Spotify Playlist Parser
 """
 
 import csv
+import hashlib
 import sys
 import re
 from pathlib import Path
 from playwright.sync_api import sync_playwright
 import time
 
-def parse_spotify_playlist(playlist_url, output_csv=None):
+import profiling
+from app_cache import get_cache_dir, load_json, save_json
+from negative_cache import track_key
+from process_runner import CancelToken
+
+# Столбцы CSV ("Длительность" - как в Spotify, "3:45"; в старых CSV её нет)
+CSV_FIELDS = ['№', 'Песня', 'Артист', 'Альбом', 'Длительность']
+
+# Длительность трека в последней колонке строки плейлиста
+DURATION_PATTERN = re.compile(r'^\d{1,2}(?::\d{2}){1,2}$')
+
+# Снимок плейлиста после полного прохода годится для быстрых проходов столько секунд,
+# дальше плейлист снова прокручивается целиком (страховка от незамеченных изменений)
+FULL_RESCRAPE_INTERVAL = 7 * 24 * 3600
+
+# Сколько известных треков подряд подтверждают, что дальше список не изменился
+SNAPSHOT_CONFIRM_TRACKS = 5
+
+# Число треков из заголовка плейлиста ("3,005 songs"): заголовок - первое совпадение на странице
+TRACK_COUNT_SCRIPT = """() => {
+    const match = document.body.innerText.match(/(\\d{1,3}(?:[,.\\s]\\d{3})+|\\d+)\\s+(?:songs?|canciones|canción|titres?|треков|трека|трек)/i);
+    return match ? parseInt(match[1].replace(/[^\\d]/g, ''), 10) : null;
+}"""
+
+# Название и артисты всех загруженных строк за один запрос к странице
+ROW_KEYS_SCRIPT = """() => Array.from(document.querySelectorAll('[data-testid="tracklist-row"]')).map(row => {
+    const title = row.querySelector('[data-testid="internal-track-link"]');
+    const artists = Array.from(row.querySelectorAll('a[href*="/artist/"]')).map(link => link.innerText);
+    return [title ? title.innerText : '', [...new Set(artists)].join(', ')];
+})"""
+
+def snapshot_path(playlist_url):
+    """Файл снимка плейлиста в папке кэша (по id плейлиста из URL)"""
+    match = re.search(r'/playlist/(\w+)', playlist_url)
+    playlist_id = match.group(1) if match else hashlib.sha1(playlist_url.encode()).hexdigest()[:16]
+    return get_cache_dir('spotify') / f"{playlist_id}.json"
+
+def load_snapshot(playlist_url, full=False):
     """
-    Парсит Spotify плейлист через HTML и сохраняет в CSV
+    Снимок предыдущего парсинга, если по нему можно сделать быстрый проход
 
     Args:
         playlist_url: URL плейлиста Spotify
-        output_csv: Путь для сохранения CSV (опционально)
+        full: нужен полный проход (снимок не используется)
+
+    Returns:
+        dict снимка (playlist_name, songs, keys, full_at, updated_at) или None
     """
+    if full:
+        return None
+    snapshot = load_json(snapshot_path(playlist_url))
+    if not snapshot or not snapshot.get('songs'):
+        return None
+    if time.time() - snapshot.get('full_at', 0) > FULL_RESCRAPE_INTERVAL:
+        # Плановый полный проход
+        return None
+    snapshot['keys'] = [track_key(song['Артист'], song['Песня']) for song in snapshot['songs']]
+    return snapshot
 
-    print(f"🔍 Открываю плейлист: {playlist_url}")
+def save_snapshot(playlist_url, playlist_name, songs, snapshot=None):
+    """
+    Сохраняет треки плейлиста как снимок для следующего парсинга
+
+    Args:
+        snapshot: снимок, по которому был сделан быстрый проход (None - проход был полным)
+    """
+    now = time.time()
+    save_json(snapshot_path(playlist_url), {
+        'url': playlist_url,
+        'playlist_name': playlist_name,
+        'songs': songs,
+        'full_at': snapshot['full_at'] if snapshot else now,
+        'updated_at': now,
+    })
+
+def match_snapshot(page, snapshot, total_count):
+    """
+    Проверяет, подтверждена ли известная последовательность треков
+
+    Быстрый проход возможен, когда новые треки добавлены в начало списка
+    (например, сортировка по дате добавления, новые сверху): число новых -
+    разница между числом треков в заголовке и в снимке, а сразу за ними
+    должны идти первые SNAPSHOT_CONFIRM_TRACKS треков снимка. Если треки
+    добавлены в другое место или удалены, последовательность не совпадёт.
+
+    Args:
+        page: страница плейлиста
+        snapshot: снимок из load_snapshot
+        total_count: число треков из заголовка плейлиста
 
-    with sync_playwright() as p:
-        # Запускаем браузер (headless для скорости)
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page()
+    Returns:
+        ('confirmed', число новых треков), ('pending', None) - загружено
+        мало строк, или ('mismatch', None) - нужен полный проход
+    """
+    new_count = total_count - len(snapshot['keys'])
+    if new_count < 0:
+        return 'mismatch', None
+    confirm = min(SNAPSHOT_CONFIRM_TRACKS, len(snapshot['keys']))
+    rows = page.evaluate(ROW_KEYS_SCRIPT)
+    if len(rows) < new_count + confirm:
+        return 'pending', None
+    keys = [track_key(artist, title) for title, artist in rows[new_count:new_count + confirm]]
+    if keys != snapshot['keys'][:confirm]:
+        return 'mismatch', None
+    return 'confirmed', new_count
+
+def merge_snapshot(new_songs, snapshot):
+    """Новые треки и треки снимка после них, с новой нумерацией"""
+    songs = list(new_songs)
+    for song in snapshot['songs']:
+        songs.append({**song, '№': str(len(songs) + 1)})
+    return songs
+
+def row_duration(row):
+    """
+    Длительность трека из строки плейлиста
+
+    Args:
+        row: строка [data-testid="tracklist-row"] (Playwright Locator)
+
+    Returns:
+        Строка длительности ("3:45") или "", если её нет
+    """
+    # Длительность - последняя колонка, поэтому обычно хватает одного запроса к странице
+    for cell in reversed(row.locator('[aria-colindex]').all()):
+        text = cell.inner_text().strip()
+        if DURATION_PATTERN.match(text):
+            return text
+    return ""
+
+def scrape_playlist(browser, playlist_url, snapshot=None, cancel_token=None):
+    """
+    Открывает плейлист в уже запущенном браузере и извлекает треки
 
+    Args:
+        browser: браузер Playwright (Chromium)
+        playlist_url: URL плейлиста Spotify
+        snapshot: снимок предыдущего парсинга (load_snapshot); если известная
+            последовательность подтвердилась, прокрутка останавливается, а
+            извлекаются только новые треки
+        cancel_token: CancelToken; проверяется между шагами Playwright,
+            паузы прокрутки прерываются сразу при отмене
+
+    Returns:
+        (playlist_name, songs, incremental) - songs: список dict со столбцами CSV,
+        incremental: True если использован снимок
+
+    Raises:
+        OperationCancelled: отмена через cancel_token (страница закрывается)
+    """
+    cancel_token = cancel_token or CancelToken()
+    cancel_token.raise_if_cancelled()
+    page = browser.new_page()
+    try:
         # Устанавливаем viewport побольше чтобы влезло больше треков
         page.set_viewport_size({"width": 1920, "height": 5000})
 
         # Открываем страницу плейлиста
-        page.goto(playlist_url, wait_until='domcontentloaded')
+        with profiling.stage('load'):
+            page.goto(playlist_url, wait_until='domcontentloaded')
 
-        # Ждём загрузки первых треков
-        page.wait_for_selector('[data-testid="tracklist-row"]', timeout=10000)
-        time.sleep(3)
+            # Ждём загрузки первых треков
+            cancel_token.raise_if_cancelled()
+            page.wait_for_selector('[data-testid="tracklist-row"]', timeout=10000)
+            cancel_token.wait(3)
+            cancel_token.raise_if_cancelled()
 
         # Получаем название плейлиста (пробуем разные селекторы)
         playlist_name = "playlist"
@@ -58,134 +200,197 @@ def parse_spotify_playlist(playlist_url, output_csv=None):
         previous_count = 0
         no_change_count = 0
         max_scrolls = 100  # Максимум скроллов для защиты от бесконечного цикла
+        new_count = None
+        total_count = page.evaluate(TRACK_COUNT_SCRIPT) if snapshot else None
+        if snapshot and total_count is None:
+            print("⚠️  Не удалось получить число треков, полный проход")
+            snapshot = None
+
+        with profiling.stage('scroll'):
+            for scroll_attempt in range(max_scrolls):
+                cancel_token.raise_if_cancelled()
+
+                # Известные треки на своём месте: остальное берём из снимка
+                if snapshot:
+                    status, new_count = match_snapshot(page, snapshot, total_count)
+                    if status == 'confirmed':
+                        print(f"⚡ Известные треки на месте, новых: {new_count} (остальные {len(snapshot['songs'])} из снимка)")
+                        break
+                    if status == 'mismatch':
+                        print("📜 Плейлист изменился не только в начале, полный проход")
+                        snapshot = None
 
-        for scroll_attempt in range(max_scrolls):
-            # Получаем текущее количество треков
-            current_tracks = page.locator('[data-testid="tracklist-row"]').count()
-
-            if scroll_attempt % 10 == 0:
-                print(f"  Загружено треков: {current_tracks}...")
+                # Получаем текущее количество треков
+                current_tracks = page.locator('[data-testid="tracklist-row"]').count()
 
-            # Проверяем появилась ли секция Recommended
-            has_recommended = page.locator('h2:has-text("Recommended")').count() > 0
+                if scroll_attempt % 10 == 0:
+                    print(f"  Загружено треков: {current_tracks}...")
 
-            if has_recommended:
-                print(f"📌 Обнаружена секция 'Recommended', остановка загрузки")
-                break
+                # Проверяем появилась ли секция Recommended
+                has_recommended = page.locator('h2:has-text("Recommended")').count() > 0
 
-            # Если треков не прибавилось несколько раз подряд, значит всё загружено
-            if current_tracks == previous_count:
-                no_change_count += 1
-                if no_change_count >= 10:  # 10 попыток без изменений
-                    print(f"✓ Загружено всех треков: {current_tracks}")
+                if has_recommended:
+                    print(f"📌 Обнаружена секция 'Recommended', остановка загрузки")
                     break
-            else:
-                no_change_count = 0
 
-            previous_count = current_tracks
+                # Если треков не прибавилось несколько раз подряд, значит всё загружено
+                if current_tracks == previous_count:
+                    no_change_count += 1
+                    if no_change_count >= 10:  # 10 попыток без изменений
+                        print(f"✓ Загружено всех треков: {current_tracks}")
+                        break
+                else:
+                    no_change_count = 0
 
-            # Скроллим вниз агрессивнее
-            page.evaluate("window.scrollBy(0, 1000)")
-            time.sleep(0.5)
+                previous_count = current_tracks
 
-        # Парсим треки
-        songs = []
+                # Скроллим вниз агрессивнее
+                page.evaluate("window.scrollBy(0, 1000)")
+                cancel_token.wait(0.5)
 
-        # Находим позицию заголовка "Recommended" если он есть
-        recommended_y = None
-        try:
-            recommended_elem = page.locator('h2:has-text("Recommended")').first
-            if recommended_elem.count() > 0:
-                bbox = recommended_elem.bounding_box()
-                if bbox:
-                    recommended_y = bbox['y']
-                    print(f"📌 Секция 'Recommended' на позиции Y={recommended_y}")
-        except:
-            pass
-
-        # Получаем все треки
-        all_track_rows = page.locator('[data-testid="tracklist-row"]').all()
-
-        print(f"🎵 Парсинг {len(all_track_rows)} треков...")
-
-        # Парсим треки
-        last_track_number = 0
-        for idx, row in enumerate(all_track_rows):
-            try:
-                # Если есть секция Recommended, проверяем позицию трека
-                if recommended_y is not None:
-                    bbox = row.bounding_box()
-                    if bbox and bbox['y'] >= recommended_y:
-                        # Трек находится ниже заголовка Recommended - пропускаем
-                        print(f"  ⏭️  Остановка: достигнута секция Recommended")
-                        break
+        # Прокрутка закончилась раньше, чем снимок подтвердился: треки - из полного прохода
+        if new_count is None:
+            snapshot = None
+
+        with profiling.stage('extract'):
+            # Парсим треки
+            songs = []
 
-                # Проверяем номер трека в плейлисте
-                # В основном плейлисте треки идут с номерами 1, 2, 3...
-                # В рекомендациях номеров нет или они не последовательные
+            # Находим позицию заголовка "Recommended" если он есть
+            recommended_y = None
+            try:
+                recommended_elem = page.locator('h2:has-text("Recommended")').first
+                if recommended_elem.count() > 0:
+                    bbox = recommended_elem.bounding_box()
+                    if bbox:
+                        recommended_y = bbox['y']
+                        print(f"📌 Секция 'Recommended' на позиции Y={recommended_y}")
+            except:
+                pass
+
+            # Получаем все треки (при подтверждённом снимке - только новые)
+            all_track_rows = page.locator('[data-testid="tracklist-row"]').all()
+            if snapshot:
+                all_track_rows = all_track_rows[:new_count]
+
+            print(f"🎵 Парсинг {len(all_track_rows)} треков...")
+
+            # Парсим треки
+            last_track_number = 0
+            for idx, row in enumerate(all_track_rows):
+                cancel_token.raise_if_cancelled()
                 try:
-                    # Ищем номер трека в первой колонке
-                    track_number_elem = row.locator('[aria-colindex="1"]').first
-                    track_number_text = track_number_elem.inner_text().strip()
-
-                    # Пробуем преобразовать в число
-                    if track_number_text.isdigit():
-                        current_number = int(track_number_text)
-                        # Если номер не последовательный (разрыв больше 1), останавливаемся
-                        if last_track_number > 0 and current_number != last_track_number + 1:
-                            print(f"  ⏭️  Остановка: обнаружен разрыв нумерации ({last_track_number} -> {current_number})")
+                    # Если есть секция Recommended, проверяем позицию трека
+                    if recommended_y is not None:
+                        bbox = row.bounding_box()
+                        if bbox and bbox['y'] >= recommended_y:
+                            # Трек находится ниже заголовка Recommended - пропускаем
+                            print(f"  ⏭️  Остановка: достигнута секция Recommended")
                             break
-                        last_track_number = current_number
-                    else:
-                        # Нет номера - вероятно рекомендации
-                        if len(songs) > 0:  # Если уже что-то нашли, останавливаемся
-                            print(f"  ⏭️  Остановка: трек без номера (рекомендации)")
+
+                    # Проверяем номер трека в плейлисте
+                    # В основном плейлисте треки идут с номерами 1, 2, 3...
+                    # В рекомендациях номеров нет или они не последовательные
+                    try:
+                        # Ищем номер трека в первой колонке
+                        track_number_elem = row.locator('[aria-colindex="1"]').first
+                        track_number_text = track_number_elem.inner_text().strip()
+
+                        # Пробуем преобразовать в число
+                        if track_number_text.isdigit():
+                            current_number = int(track_number_text)
+                            # Если номер не последовательный (разрыв больше 1), останавливаемся
+                            if last_track_number > 0 and current_number != last_track_number + 1:
+                                print(f"  ⏭️  Остановка: обнаружен разрыв нумерации ({last_track_number} -> {current_number})")
+                                break
+                            last_track_number = current_number
+                        else:
+                            # Нет номера - вероятно рекомендации
+                            if len(songs) > 0:  # Если уже что-то нашли, останавливаемся
+                                print(f"  ⏭️  Остановка: трек без номера (рекомендации)")
+                                break
+                    except:
+                        # Если не удалось получить номер и уже есть треки, останавливаемся
+                        if len(songs) > 0:
+                            print(f"  ⏭️  Остановка: не удалось получить номер трека")
                             break
-                except:
-                    # Если не удалось получить номер и уже есть треки, останавливаемся
-                    if len(songs) > 0:
-                        print(f"  ⏭️  Остановка: не удалось получить номер трека")
+
+                    # Название трека
+                    track_name_elem = row.locator('[data-testid="internal-track-link"]').first
+                    track_name = track_name_elem.inner_text() if track_name_elem.count() > 0 else ""
+
+                    # Артист (может быть несколько)
+                    artist_links = row.locator('a[href*="/artist/"]').all()
+                    artists = []
+                    for artist_link in artist_links:
+                        artist_text = artist_link.inner_text()
+                        if artist_text and artist_text not in artists:
+                            artists.append(artist_text)
+
+                    artist_name = ', '.join(artists) if artists else ""
+
+                    # Альбом
+                    album_elem = row.locator('a[href*="/album/"]').first
+                    album_name = album_elem.inner_text() if album_elem.count() > 0 else ""
+
+                    if track_name:
+                        songs.append({
+                            '№': str(len(songs) + 1),
+                            'Песня': track_name,
+                            'Артист': artist_name,
+                            'Альбом': album_name,
+                            'Длительность': row_duration(row)
+                        })
+                        print(f"  {len(songs)}. {artist_name} - {track_name}")
+
+                except Exception as e:
+                    print(f"  ⚠️  Ошибка: {e}")
+                    if len(songs) > 0:  # Если уже есть треки, останавливаемся при ошибке
                         break
+                    continue
+        if snapshot:
+            songs = merge_snapshot(songs, snapshot)
+    finally:
+        page.close()
 
-                # Название трека
-                track_name_elem = row.locator('[data-testid="internal-track-link"]').first
-                track_name = track_name_elem.inner_text() if track_name_elem.count() > 0 else ""
-
-                # Артист (может быть несколько)
-                artist_links = row.locator('a[href*="/artist/"]').all()
-                artists = []
-                for artist_link in artist_links:
-                    artist_text = artist_link.inner_text()
-                    if artist_text and artist_text not in artists:
-                        artists.append(artist_text)
-
-                artist_name = ', '.join(artists) if artists else ""
-
-                # Альбом
-                album_elem = row.locator('a[href*="/album/"]').first
-                album_name = album_elem.inner_text() if album_elem.count() > 0 else ""
-
-                if track_name:
-                    songs.append({
-                        '№': str(len(songs) + 1),
-                        'Песня': track_name,
-                        'Артист': artist_name,
-                        'Альбом': album_name
-                    })
-                    print(f"  {len(songs)}. {artist_name} - {track_name}")
-
-            except Exception as e:
-                print(f"  ⚠️  Ошибка: {e}")
-                if len(songs) > 0:  # Если уже есть треки, останавливаемся при ошибке
-                    break
-                continue
+    return playlist_name, songs, snapshot is not None
+
+def parse_spotify_playlist(playlist_url, output_csv=None, browser=None, full=False, cancel_token=None):
+    """
+    Парсит Spotify плейлист через HTML и сохраняет в CSV
+
+    Args:
+        playlist_url: URL плейлиста Spotify
+        output_csv: Путь для сохранения CSV (опционально)
+        browser: уже запущенный браузер Playwright (демон держит его тёплым);
+            без него Chromium запускается и закрывается на каждый вызов
+        full: прокрутить плейлист целиком, не используя снимок прошлого парсинга
+        cancel_token: CancelToken для отмены посреди парсинга
 
-        browser.close()
+    Raises:
+        OperationCancelled: отмена через cancel_token
+    """
+
+    print(f"🔍 Открываю плейлист: {playlist_url}")
+    snapshot = load_snapshot(playlist_url, full)
+
+    if browser is None:
+        with sync_playwright() as p:
+            # Запускаем браузер (headless для скорости)
+            browser = p.chromium.launch(headless=True)
+            try:
+                playlist_name, songs, incremental = scrape_playlist(browser, playlist_url, snapshot, cancel_token)
+            finally:
+                browser.close()
+    else:
+        playlist_name, songs, incremental = scrape_playlist(browser, playlist_url, snapshot, cancel_token)
 
     if not songs:
         print("❌ Не удалось извлечь треки")
         return None
 
+    save_snapshot(playlist_url, playlist_name, songs, snapshot if incremental else None)
+
     # Определяем путь для сохранения
     if output_csv is None:
         safe_name = re.sub(r'[^\w\s-]', '', playlist_name).strip().replace(' ', '_')
@@ -197,7 +402,7 @@ def parse_spotify_playlist(playlist_url, output_csv=None):
         f.write(f"# Playlist: {playlist_name}\n")
 
         # Записываем треки
-        writer = csv.DictWriter(f, fieldnames=['№', 'Песня', 'Артист', 'Альбом'])
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
         writer.writeheader()
         writer.writerows(songs)
 
@@ -210,19 +415,30 @@ def parse_spotify_playlist(playlist_url, output_csv=None):
 def main():
     """Главная функция"""
 
-    if len(sys.argv) < 2:
+    # Флаги убираем из позиционных аргументов
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+
+    if len(args) < 1:
         print("Использование:")
-        print(f"  python3 {sys.argv[0]} <spotify_playlist_url> [output.csv]")
+        print(f"  python3 {sys.argv[0]} <spotify_playlist_url> [output.csv] [--full] [--profile[=DIR]] [--profile-memory]")
+        print("\nОпции:")
+        print("  --full   Прокрутить плейлист целиком, не используя снимок прошлого парсинга")
         print("\nПример:")
         print(f"  python3 {sys.argv[0]} https://open.spotify.com/playlist/7EFhwhbPhOhKjuwIJseVwT")
         print(f"  python3 {sys.argv[0]} https://open.spotify.com/playlist/ABC123 my_playlist.csv")
         sys.exit(1)
 
-    playlist_url = sys.argv[1]
-    output_csv = sys.argv[2] if len(sys.argv) > 2 else None
+    playlist_url = args[0]
+    output_csv = args[1] if len(args) > 1 else None
+    profile_dir, profile_memory = profiling.get_profile_options(sys.argv)
+    full = '--full' in sys.argv
 
     # Парсим плейлист
-    result = parse_spotify_playlist(playlist_url, output_csv)
+    if profile_dir:
+        with profiling.profiled(profile_dir, memory=profile_memory):
+            result = parse_spotify_playlist(playlist_url, output_csv, full=full)
+    else:
+        result = parse_spotify_playlist(playlist_url, output_csv, full=full)
 
     if result:
         print(f"\n🎵 Готово! Теперь можно скачать треки:")
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Process Runner
+Запуск внешних утилит (yt-dlp, ffmpeg) с построчным чтением вывода,
+общим таймаутом и сторожем, который убивает зависшие процессы
+"""
+
+import os
+import signal
+import subprocess
+import threading
+import time
+import weakref
+from collections import deque
+
+# Сколько ждать после SIGTERM перед SIGKILL (секунды)
+KILL_GRACE_PERIOD = 5.0
+
+# Наблюдатели за временем ожидания подпроцессов (например, профилировщик)
+_observers = []
+
+
+def add_observer(observer):
+    """Подключает наблюдателя с методами on_subprocess_start(cmd) и on_subprocess_end(cmd, elapsed)"""
+    _observers.append(observer)
+
+
+def remove_observer(observer):
+    """Отключает наблюдателя"""
+    if observer in _observers:
+        _observers.remove(observer)
+
+
+class CommandTimeoutError(subprocess.TimeoutExpired):
+    """
+    Процесс убит сторожем
+
+    reason: 'timeout' - превышено общее время, 'stalled' - вывод перестал обновляться
+    """
+
+    def __init__(self, cmd, timeout, reason, output=None, stderr=None):
+        super().__init__(cmd, timeout, output=output, stderr=stderr)
+        self.reason = reason
+
+    def __str__(self):
+        if self.reason == 'stalled':
+            return f"Command '{self.cmd[0]}' stalled: no output for {self.timeout:.0f}s"
+        return f"Command '{self.cmd[0]}' timed out after {self.timeout:.0f}s"
+
+
+class OperationCancelled(Exception):
+    """Операция отменена через CancelToken"""
+
+
+def short_error(error, max_length=120):
+    """Последняя строка сообщения об ошибке (для компактного лога)"""
+    text = (getattr(error, 'stderr', None) or str(error)).strip()
+    last_line = text.splitlines()[-1] if text else type(error).__name__
+    return last_line[:max_length]
+
+
+class CancelToken:
+    """
+    Токен отмены, который передаётся в поиск, скачивание и нормализацию
+
+    cancel() сразу завершает группы всех зарегистрированных процессов
+    (в фоновых потоках, чтобы не блокировать GUI), а новые процессы
+    после отмены не запускаются.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._processes = set()
+        self._children = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        """True если отмена запрошена"""
+        return self._event.is_set()
+
+    def cancel(self):
+        """Запрашивает отмену и убивает запущенные процессы"""
+        self._event.set()
+        with self._lock:
+            processes = list(self._processes)
+            children = list(self._children)
+        for child in children:
+            child.cancel()
+        for process in processes:
+            threading.Thread(target=kill_process_group, args=(process,), daemon=True).start()
+
+    def child(self):
+        """Дочерний токен: отменяется вместе с этим, но его можно отменить и отдельно"""
+        token = CancelToken()
+        with self._lock:
+            self._children.add(token)
+        if self.cancelled:
+            token.cancel()
+        return token
+
+    def raise_if_cancelled(self):
+        """Бросает OperationCancelled если отмена запрошена"""
+        if self.cancelled:
+            raise OperationCancelled()
+
+    def wait(self, timeout):
+        """Спит до timeout секунд; возвращает True если за это время пришла отмена"""
+        return self._event.wait(timeout)
+
+    def register(self, process):
+        """Привязывает процесс к токену (если отмена уже запрошена - сразу убивает)"""
+        with self._lock:
+            self._processes.add(process)
+        if self.cancelled:
+            kill_process_group(process)
+
+    def unregister(self, process):
+        """Отвязывает завершившийся процесс"""
+        with self._lock:
+            self._processes.discard(process)
+
+
+def kill_process_group(process):
+    """Завершает процесс вместе с дочерними (yt-dlp запускает ffmpeg): SIGTERM, затем SIGKILL"""
+    if process.poll() is not None:
+        return
+
+    if os.name == 'posix':
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            return
+    else:
+        process.terminate()
+
+    try:
+        process.wait(timeout=KILL_GRACE_PERIOD)
+    except subprocess.TimeoutExpired:
+        if os.name == 'posix':
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        else:
+            process.kill()
+        process.wait()
+
+
+def run_command(cmd, on_line=None, check=True, timeout=None, stall_timeout=None, on_stderr_line=None,
+                cancel_token=None, stderr_limit=None):
+    """
+    Запускает команду и построчно передаёт её stdout в on_line
+
+    Args:
+        cmd: команда (список аргументов)
+        on_line: функция, вызываемая для каждой строки stdout (опционально)
+        check: бросать CalledProcessError при ненулевом коде выхода
+        timeout: максимальное время работы в секундах (None - без ограничения)
+        stall_timeout: сколько секунд процесс может ничего не выводить
+            в stdout/stderr, прежде чем сторож посчитает его зависшим
+        on_stderr_line: функция для каждой строки stderr (вызывается из потока чтения stderr)
+        cancel_token: CancelToken, при отмене процесс убивается вместе с дочерними
+        stderr_limit: сколько последних строк stderr хранить (None - все); для
+            многословных команд, чей stderr разбирается построчно в on_stderr_line
+
+    Returns:
+        subprocess.CompletedProcess со stdout и stderr в виде строк
+
+    Raises:
+        OperationCancelled: отмена через cancel_token
+        CommandTimeoutError: процесс превысил timeout или завис
+        subprocess.CalledProcessError: ненулевой код выхода (при check=True)
+    """
+    if cancel_token:
+        cancel_token.raise_if_cancelled()
+
+    for observer in list(_observers):
+        observer.on_subprocess_start(cmd)
+
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        encoding='utf-8',
+        errors='replace',
+        bufsize=1,
+        # Отдельная группа процессов, чтобы при зависании убить и дочерние процессы
+        start_new_session=(os.name == 'posix')
+    )
+    if cancel_token:
+        cancel_token.register(process)
+
+    last_activity = [time.monotonic()]
+    killed_reason = [None]
+    finished = threading.Event()
+
+    # stderr читаем в отдельном потоке, чтобы процесс не заблокировался на полном буфере
+    stderr_lines = deque(maxlen=stderr_limit)
+
+    def read_stderr():
+        for line in process.stderr:
+            last_activity[0] = time.monotonic()
+            stderr_lines.append(line)
+            if on_stderr_line:
+                on_stderr_line(line.rstrip('\n'))
+
+    stderr_reader = threading.Thread(target=read_stderr, daemon=True)
+    stderr_reader.start()
+
+    def watchdog():
+        """Убивает процесс при превышении timeout или отсутствии вывода дольше stall_timeout"""
+        start = time.monotonic()
+        while not finished.wait(1.0):
+            now = time.monotonic()
+            if timeout is not None and now - start > timeout:
+                killed_reason[0] = 'timeout'
+            elif stall_timeout is not None and now - last_activity[0] > stall_timeout:
+                killed_reason[0] = 'stalled'
+            if killed_reason[0]:
+                kill_process_group(process)
+                return
+
+    watchdog_thread = None
+    if timeout is not None or stall_timeout is not None:
+        watchdog_thread = threading.Thread(target=watchdog, daemon=True)
+        watchdog_thread.start()
+
+    stdout_lines = []
+    try:
+        for line in process.stdout:
+            last_activity[0] = time.monotonic()
+            line = line.rstrip('\n')
+            stdout_lines.append(line)
+            if on_line:
+                on_line(line)
+    except BaseException:
+        # Ошибка в on_line или KeyboardInterrupt: не оставляем процесс сиротой
+        kill_process_group(process)
+        raise
+    finally:
+        returncode = process.wait()
+        if cancel_token:
+            cancel_token.unregister(process)
+        finished.set()
+        stderr_reader.join()
+        if watchdog_thread:
+            watchdog_thread.join()
+
+        elapsed = time.perf_counter() - started
+        for observer in list(_observers):
+            observer.on_subprocess_end(cmd, elapsed)
+
+    stdout = '\n'.join(stdout_lines)
+    stderr = ''.join(stderr_lines)
+
+    if cancel_token and cancel_token.cancelled and returncode != 0:
+        raise OperationCancelled()
+
+    if killed_reason[0]:
+        limit = timeout if killed_reason[0] == 'timeout' else stall_timeout
+        raise CommandTimeoutError(cmd, limit, killed_reason[0], output=stdout, stderr=stderr)
+
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, output=stdout, stderr=stderr)
+
+    return subprocess.CompletedProcess(cmd, returncode, stdout=stdout, stderr=stderr)
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Profiling
+Режим профилирования (--profile): cProfile, сэмплирование стеков по этапам,
+время ожидания подпроцессов отдельно от CPU Python и снимки tracemalloc
+"""
+
+import cProfile
+import json
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+import process_runner
+import run_metrics
+
+# Профилировщик текущего процесса (None если профилирование выключено)
+_active = None
+
+
+class Profiler:
+    """
+    Профилировщик прогона
+
+    - cProfile в главном потоке и в рабочих потоках (через thread_profile;
+      в Python 3.12+ одновременно может работать только один cProfile, и
+      рабочие потоки остаются только в сэмплах стеков)
+    - фоновый сэмплер стеков всех потоков, стеки помечаются текущим этапом
+    - по каждому этапу: wall time, CPU Python и время ожидания подпроцессов
+    - снимки tracemalloc на границах этапов (если memory=True)
+    """
+
+    def __init__(self, output_dir, sample_interval=0.005, memory=False, snapshot_interval=30.0):
+        self.output_dir = Path(output_dir)
+        self.sample_interval = sample_interval
+        self.memory = memory
+        self.snapshot_interval = snapshot_interval
+
+        self._main_profile = cProfile.Profile()
+        self._thread_profiles = []
+        self._thread_profiles_unavailable = False
+        self._samples = Counter()
+        self._stage_totals = {}
+        self._subprocess_totals = {'count': 0, 'wait': 0.0}
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._sampler = None
+
+        self._memory_timeline = []
+        self._first_snapshot = None
+        self._last_snapshot_time = 0.0
+
+    # --- жизненный цикл ---
+
+    def start(self):
+        """Запускает профилирование"""
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        if self.memory:
+            tracemalloc.start(25)
+            self._first_snapshot = tracemalloc.take_snapshot()
+            self._last_snapshot_time = time.perf_counter()
+
+        run_metrics.add_observer(self)
+        process_runner.add_observer(self)
+
+        self._sampler = threading.Thread(target=self._sample_loop, name='profiler-sampler', daemon=True)
+        self._sampler.start()
+        self._main_profile.enable()
+
+    def stop(self):
+        """Останавливает профилирование и сохраняет результаты"""
+        self._main_profile.disable()
+        self._stop_event.set()
+        if self._sampler:
+            self._sampler.join()
+
+        run_metrics.remove_observer(self)
+        process_runner.remove_observer(self)
+
+        self._write_pstats()
+        if self._thread_profiles_unavailable:
+            print("ℹ️  cProfile рабочих потоков недоступен в этой версии Python: "
+                  "они есть только в profile.collapsed")
+        self._write_collapsed()
+        self._write_stages()
+        if self.memory:
+            self._write_memory()
+            tracemalloc.stop()
+
+    @contextmanager
+    def thread_profile(self):
+        """cProfile для текущего (рабочего) потока"""
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ (sys.monitoring): второй cProfile рядом с главным не включить
+            self._thread_profiles_unavailable = True
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self._lock:
+                self._thread_profiles.append(profile)
+
+    # --- наблюдатель этапов (run_metrics) и подпроцессов (process_runner) ---
+
+    def on_stage_start(self, track, name):
+        """Начало этапа в текущем потоке"""
+        with self._lock:
+            thread_state = self._thread_state()
+            thread_state['stage'] = {
+                'name': name,
+                'wall': time.perf_counter(),
+                'cpu': time.thread_time(),
+                'subprocess': 0.0
+            }
+        self._memory_checkpoint(f"{name}:start")
+
+    def on_stage_end(self, track, name, duration):
+        """Конец этапа в текущем потоке"""
+        now = time.perf_counter()
+        with self._lock:
+            thread_state = self._thread_state()
+            stage = thread_state['stage']
+            thread_state['stage'] = None
+            if not stage or stage['name'] != name:
+                return
+            # Этап мог закончиться, пока подпроцесс ещё работает (этапы yt-dlp)
+            if thread_state['subprocess_since'] is not None:
+                stage['subprocess'] += now - max(thread_state['subprocess_since'], stage['wall'])
+            totals = self._stage_totals.setdefault(name, {
+                'count': 0, 'wall': 0.0, 'python_cpu': 0.0, 'subprocess_wait': 0.0
+            })
+            totals['count'] += 1
+            totals['wall'] += now - stage['wall']
+            totals['python_cpu'] += time.thread_time() - stage['cpu']
+            totals['subprocess_wait'] += stage['subprocess']
+        self._memory_checkpoint(f"{name}:end")
+
+    def on_subprocess_start(self, cmd):
+        """Текущий поток начал ждать подпроцесс"""
+        with self._lock:
+            self._thread_state()['subprocess_since'] = time.perf_counter()
+
+    def on_subprocess_end(self, cmd, elapsed):
+        """Текущий поток дождался подпроцесса"""
+        now = time.perf_counter()
+        with self._lock:
+            thread_state = self._thread_state()
+            stage = thread_state['stage']
+            since = thread_state['subprocess_since']
+            if stage and since is not None:
+                stage['subprocess'] += now - max(since, stage['wall'])
+            thread_state['subprocess_since'] = None
+            self._subprocess_totals['count'] += 1
+            self._subprocess_totals['wait'] += elapsed
+
+    def _thread_state(self):
+        """Состояние текущего потока (вызывать под self._lock)"""
+        return self._threads.setdefault(threading.get_ident(), {'stage': None, 'subprocess_since': None})
+
+    # --- сэмплирование ---
+
+    def _sample_loop(self):
+        """Периодически снимает стеки всех потоков"""
+        own_ident = threading.get_ident()
+        while not self._stop_event.wait(self.sample_interval):
+            frames = sys._current_frames()
+            with self._lock:
+                stages = {ident: state['stage']['name'] for ident, state in self._threads.items() if state['stage']}
+            for ident, frame in frames.items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{Path(code.co_filename).stem}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(stages.get(ident, 'idle'))
+                self._samples[';'.join(reversed(stack))] += 1
+
+    # --- память ---
+
+    def _memory_checkpoint(self, label):
+        """Замер памяти на границе этапа и (не чаще snapshot_interval) полный снимок"""
+        if not self.memory:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        self._memory_timeline.append({
+            'time': round(time.time(), 3),
+            'label': label,
+            'current': current,
+            'peak': peak
+        })
+        now = time.perf_counter()
+        if now - self._last_snapshot_time >= self.snapshot_interval:
+            self._last_snapshot_time = now
+            snapshot = tracemalloc.take_snapshot()
+            snapshot.dump(str(self.output_dir / f"memory_{len(self._memory_timeline):06d}.snapshot"))
+
+    # --- вывод ---
+
+    def _write_pstats(self):
+        """Сохраняет объединённую статистику cProfile"""
+        stats = pstats.Stats(self._main_profile)
+        for profile in self._thread_profiles:
+            stats.add(profile)
+        stats.dump_stats(str(self.output_dir / 'profile.pstats'))
+
+    def _write_collapsed(self):
+        """Сохраняет стеки в collapsed-формате (flamegraph.pl, speedscope, inferno)"""
+        with open(self.output_dir / 'profile.collapsed', 'w', encoding='utf-8') as f:
+            for stack, count in self._samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def _write_stages(self):
+        """Сохраняет разбивку времени по этапам"""
+        stages = {}
+        for name, totals in self._stage_totals.items():
+            stages[name] = {key: round(value, 3) if isinstance(value, float) else value
+                            for key, value in totals.items()}
+        report = {
+            'stages': stages,
+            'subprocesses': {
+                'count': self._subprocess_totals['count'],
+                'wait': round(self._subprocess_totals['wait'], 3)
+            }
+        }
+        with open(self.output_dir / 'profile_stages.json', 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    def _write_memory(self):
+        """Сохраняет динамику памяти и топ роста относительно начала прогона"""
+        with open(self.output_dir / 'memory_timeline.jsonl', 'w', encoding='utf-8') as f:
+            for point in self._memory_timeline:
+                f.write(json.dumps(point) + '\n')
+
+        growth = tracemalloc.take_snapshot().compare_to(self._first_snapshot, 'lineno')
+        with open(self.output_dir / 'memory_growth.txt', 'w', encoding='utf-8') as f:
+            for stat in growth[:30]:
+                f.write(f"{stat}\n")
+
+
+def get_profiler():
+    """Активный профилировщик или None"""
+    return _active
+
+
+@contextmanager
+def profiled(output_dir, memory=False):
+    """
+    Профилирует блок кода и сохраняет результаты в output_dir
+
+    Args:
+        output_dir: папка для profile.pstats, profile.collapsed, profile_stages.json
+        memory: дополнительно снимать tracemalloc на границах этапов
+    """
+    global _active
+    profiler = Profiler(output_dir, memory=memory)
+    _active = profiler
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        _active = None
+        print(f"🔬 Профиль сохранён в: {output_dir}")
+
+
+@contextmanager
+def thread_profile():
+    """cProfile для рабочего потока, если профилирование включено (иначе ничего не делает)"""
+    if _active is None:
+        yield
+        return
+    with _active.thread_profile():
+        yield
+
+
+@contextmanager
+def stage(name):
+    """Отмечает этап вне download_from_csv (например, в парсере) для профилировщика"""
+    if _active is None:
+        yield
+        return
+    _active.on_stage_start(None, name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _active.on_stage_end(None, name, time.perf_counter() - start)
+
+
+def get_profile_options(argv):
+    """
+    Разбирает опции --profile[=DIR] и --profile-memory
+
+    Returns:
+        (output_dir, memory) или (None, False) если профилирование выключено
+    """
+    output_dir = None
+    for arg in argv:
+        if arg == '--profile':
+            output_dir = 'profile_output'
+        elif arg.startswith('--profile='):
+            output_dir = arg[len('--profile='):]
+    memory = '--profile-memory' in argv
+    if memory and output_dir is None:
+        output_dir = 'profile_output'
+    return output_dir, memory
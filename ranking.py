@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Ranking
+Выбор видео среди результатов поиска: общий взвешенный балл кандидата за один
+проход (уровень, слова запроса, длительность, штраф за live/cover и т.п.) и
+офлайн-корпус результатов yt-dlp для проверки точности и скорости выбора
+"""
+
+import json
+import re
+import sys
+import time
+from pathlib import Path
+
+# Транслитерация латиницы в кириллицу (совпадение артиста с названием канала),
+# таблица для str.translate строится один раз
+TRANSLIT_TABLE = str.maketrans({
+    'a': 'а', 'b': 'б', 'c': 'с', 'd': 'д', 'e': 'е', 'f': 'ф', 'g': 'г',
+    'h': 'х', 'i': 'и', 'j': 'й', 'k': 'к', 'l': 'л', 'm': 'м', 'n': 'н',
+    'o': 'о', 'p': 'п', 'r': 'р', 's': 'с', 't': 'т', 'u': 'у', 'v': 'в',
+    'w': 'в', 'x': 'кс', 'y': 'й', 'z': 'з'
+})
+
+# Уровни кандидатов поиска от лучшего к худшему и их баллы
+# ('other' - подходит по длительности, но без признаков; 'too_long' - отброшен,
+# 'other_track' - при поиске в канале артиста: видео другого трека)
+TIER_SCORES = {
+    'official_channel': 5,
+    'official_audio': 4,
+    'audio': 3,
+    'official_video': 2,
+    'official': 1,
+    'other': 0,
+}
+
+# Признаки уровня в названии видео: "official audio" / "audio" приоритетнее,
+# чем "official video" / "official"
+TIER_KEYWORDS = ('official audio', 'audio', 'official video', 'official')
+
+# Допуск длительности: видео, отличающиеся от длительности трека из CSV не больше чем
+# на DURATION_TOLERANCE секунд, получают полный балл длительности, дальше балл
+# линейно падает до нуля за DURATION_FALLOFF секунд
+DURATION_TOLERANCE = 15
+DURATION_FALLOFF = 60
+
+# Веса признаков в общем балле: уровень (0-5) важнее всего, длительность и слова
+# запроса решают между соседними уровнями, другая версия трека почти всегда проигрывает
+TIER_WEIGHT = 10.0
+TITLE_WEIGHT = 4.0
+DURATION_WEIGHT = 6.0
+PENALTY_WEIGHT = 8.0
+
+# Признаки другой версии трека в названии видео (не штрафуются, если есть в запросе)
+PENALTY_PATTERN = re.compile(r'\b(?:live|cover|karaoke|remix|instrumental|nightcore|sped up|slowed|8d audio)\b')
+
+# Слова запроса
+WORD_PATTERN = re.compile(r'\w+')
+
+# Корпус по умолчанию
+DEFAULT_CORPUS = Path(__file__).parent / 'ranking_corpus.sample.jsonl'
+
+# Сколько раз ранжировать корпус при замере скорости
+BENCH_ROUNDS = 200
+
+
+def transliterate(text):
+    """Простая транслитерация латиницы в кириллицу"""
+    return text.lower().translate(TRANSLIT_TABLE)
+
+
+class RankQuery:
+    """
+    Поисковый запрос, подготовленный для ранжирования
+
+    Слова запроса, ключевые слова артиста с транслитерацией и разрешённые
+    признаки версий (например, "live" в названии самого трека) считаются
+    один раз на запрос, а не для каждого кандидата.
+    """
+
+    def __init__(self, search_query, expected_duration=None, in_artist_channel=False):
+        """
+        Args:
+            search_query: поисковый запрос ("артист название") или название трека при поиске в канале
+            expected_duration: длительность трека из CSV (секунды, опционально)
+            in_artist_channel: кандидаты из поиска внутри известного канала артиста
+        """
+        text = search_query.lower()
+        # Простая эвристика: первые 3 слова запроса - имя артиста
+        self.artist_keywords = [(keyword, transliterate(keyword)) for keyword in text.split()[:3] if len(keyword) > 3]
+        self.words = [word for word in WORD_PATTERN.findall(text) if len(word) > 1]
+        self.allowed_penalties = set(PENALTY_PATTERN.findall(text))
+        self.expected_duration = expected_duration
+        self.in_artist_channel = in_artist_channel
+
+
+def candidate_tier(title_lower, uploader_lower, query):
+    """Уровень (tier) кандидата из TIER_SCORES по названию видео и каналу (в нижнем регистре)"""
+    is_live = 'live' in title_lower
+    if query.in_artist_channel and (not is_live or 'official' in title_lower):
+        return 'official_channel'
+
+    # Официальный канал артиста (с учётом транслитерации), кроме live версий
+    for keyword, translit in query.artist_keywords:
+        if keyword in uploader_lower or translit in uploader_lower:
+            if not is_live or 'official' in title_lower:
+                return 'official_channel'
+            break
+
+    if not is_live:
+        for keyword in TIER_KEYWORDS:
+            if keyword in title_lower:
+                return keyword.replace(' ', '_')
+    return 'other'
+
+
+def score_candidate(video, query):
+    """
+    Уровень и общий балл кандидата
+
+    Returns:
+        (tier, score)
+    """
+    title_lower = video['title'].lower()
+    uploader_lower = video['uploader']
+    tier = candidate_tier(title_lower, uploader_lower, query)
+    score = TIER_WEIGHT * TIER_SCORES[tier]
+
+    if query.words:
+        text = f"{title_lower} {uploader_lower}"
+        score += TITLE_WEIGHT * sum(word in text for word in query.words) / len(query.words)
+
+    if query.expected_duration:
+        excess = abs(video['duration'] - query.expected_duration) - DURATION_TOLERANCE
+        score += DURATION_WEIGHT * max(0.0, 1.0 - max(0, excess) / DURATION_FALLOFF)
+
+    if any(word not in query.allowed_penalties for word in PENALTY_PATTERN.findall(title_lower)):
+        score -= PENALTY_WEIGHT
+    return tier, round(score, 2)
+
+
+def rank_key(video, query, position, max_duration):
+    """
+    Проставляет кандидату tier и score
+
+    Returns:
+        Ключ сортировки (score, близость по длительности, -позиция) или None,
+        если кандидат отброшен ('too_long')
+    """
+    if not video['duration'] or video['duration'] > max_duration:
+        video['tier'] = 'too_long'
+        video['score'] = 0
+        return None
+    video['tier'], video['score'] = score_candidate(video, query)
+    if query.expected_duration:
+        closeness = -abs(video['duration'] - query.expected_duration)
+    else:
+        closeness = -video['duration'] if video['tier'] == 'official_channel' else 0
+    return video['score'], closeness, -position
+
+
+def rank_candidates(query, candidates, max_duration):
+    """
+    Ранжирует кандидатов одного запроса
+
+    Каждому кандидату проставляются tier и score (видео длиннее max_duration
+    или без длительности - 'too_long' с нулевым баллом). При равном балле
+    выше стоит кандидат ближе к длительности трека (если она неизвестна -
+    кандидат официального канала покороче, обычно студийная версия), затем -
+    раньше в поиске.
+
+    Args:
+        query: RankQuery
+        candidates: dict кандидатов (title, uploader в нижнем регистре, duration)
+        max_duration: максимальная длительность видео (секунды)
+
+    Returns:
+        Подходящие кандидаты от лучшего к худшему
+    """
+    ranked = []
+    for position, video in enumerate(candidates):
+        key = rank_key(video, query, position, max_duration)
+        if key is not None:
+            ranked.append((key, video))
+    ranked.sort(key=lambda item: item[0], reverse=True)
+    return [video for _, video in ranked]
+
+
+def rank_batch(items):
+    """
+    Лучшие кандидаты сразу для многих запросов (корпус, замеры скорости)
+
+    Кандидаты всех запросов оцениваются одним проходом без сортировки:
+    для каждого запроса хранится только текущий лучший ключ.
+
+    Args:
+        items: список (RankQuery, кандидаты, max_duration)
+
+    Returns:
+        Список лучших кандидатов (None, если подходящих нет) в порядке items
+    """
+    best = [None] * len(items)
+    best_keys = [None] * len(items)
+    flat = ((index, query, max_duration, position, video)
+            for index, (query, candidates, max_duration) in enumerate(items)
+            for position, video in enumerate(candidates))
+    for index, query, max_duration, position, video in flat:
+        key = rank_key(video, query, position, max_duration)
+        if key is not None and (best_keys[index] is None or key > best_keys[index]):
+            best_keys[index] = key
+            best[index] = video
+    return best
+
+
+def load_corpus(path):
+    """
+    Записи корпуса (JSONL): query, expected_duration, max_duration, candidates
+    (кандидаты поиска, как их видит rank_candidates), label (id правильного видео)
+    и reviewed (метка проверена человеком, а не взята из выбора при записи).
+    Корпус записывает download_music.py --record-corpus
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def corpus_items(entries):
+    """Задания для rank_batch из записей корпуса (кандидаты копируются заново на каждый вызов)"""
+    return [
+        (RankQuery(entry['query'], entry.get('expected_duration')),
+         [dict(candidate) for candidate in entry['candidates']],
+         entry['max_duration'])
+        for entry in entries
+    ]
+
+
+def evaluate_corpus(entries, rounds=BENCH_ROUNDS):
+    """
+    Точность и скорость ранжирования на корпусе
+
+    Точность считается только по проверенным записям (reviewed); для
+    непроверенных - лишь совпадение с меткой, записанной при --record-corpus.
+
+    Returns:
+        dict: entries, reviewed, correct (совпало с проверенной меткой),
+        agreed (совпало с меткой, включая непроверенные), mismatches
+        (только проверенные записи), disagreements (непроверенные),
+        candidates_per_second, queries_per_second
+    """
+    picks = rank_batch(corpus_items(entries))
+    stats = {'entries': len(entries), 'reviewed': 0, 'correct': 0, 'agreed': 0,
+             'mismatches': [], 'disagreements': []}
+    for entry, pick in zip(entries, picks):
+        picked_id = pick['video_id'] if pick else None
+        matched = picked_id == entry.get('label')
+        stats['agreed'] += matched
+        if entry.get('reviewed'):
+            stats['reviewed'] += 1
+            stats['correct'] += matched
+        if not matched:
+            stats['mismatches' if entry.get('reviewed') else 'disagreements'].append(
+                (entry['query'], entry.get('label'), picked_id))
+
+    # Скорость: только ранжирование, подготовка кандидатов не входит в замер
+    batches = [corpus_items(entries) for _ in range(rounds)]
+    candidates = sum(len(item[1]) for item in batches[0]) * rounds
+    started = time.perf_counter()
+    for items in batches:
+        rank_batch(items)
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    stats['candidates_per_second'] = candidates / elapsed
+    stats['queries_per_second'] = len(entries) * rounds / elapsed
+    return stats
+
+
+def main():
+    """Главная функция"""
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if '--bench' not in sys.argv:
+        print("Использование:")
+        print(f"  python3 {sys.argv[0]} --bench [corpus.jsonl]    Точность и скорость выбора на корпусе")
+        print("Записать корпус по трекам CSV: python3 download_music.py <csv> --record-corpus=corpus.jsonl")
+        sys.exit(1)
+
+    corpus_path = args[0] if args else DEFAULT_CORPUS
+    stats = evaluate_corpus(load_corpus(corpus_path))
+    print(f"📚 Корпус: {corpus_path} ({stats['entries']} запросов, проверено {stats['reviewed']})")
+    if stats['reviewed']:
+        print(f"🎯 Точность: {stats['correct']}/{stats['reviewed']} ({stats['correct'] / stats['reviewed']:.0%})")
+    else:
+        print("🎯 Точность: нет проверенных записей (reviewed: true)")
+    for query, label, picked in stats['mismatches']:
+        print(f"   ❌ {query}: ожидалось {label}, выбрано {picked}")
+    print(f"🔁 Совпадение с метками (включая непроверенные): {stats['agreed']}/{stats['entries']}")
+    for query, label, picked in stats['disagreements']:
+        print(f"   ⚠️  {query}: метка {label}, выбрано {picked}")
+    print(f"⚡ Скорость: {stats['candidates_per_second']:,.0f} кандидатов/с, "
+          f"{stats['queries_per_second']:,.0f} запросов/с")
+    if stats['mismatches']:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
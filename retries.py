@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Retries
+Классификация ошибок yt-dlp/ffmpeg и повторы с экспоненциальной задержкой и джиттером
+"""
+
+import random
+import re
+import subprocess
+import time
+import urllib.error
+
+from process_runner import CommandTimeoutError
+from throttle import ThrottledError
+
+# Ошибки, которые не исправятся повтором (видео удалено, приватное, с ограничениями)
+PERMANENT_PATTERN = re.compile(
+    r"Video unavailable|Private video|This video is not available|has been removed|"
+    r"copyright|members.only|confirm your age|not available in your country|"
+    r"Unsupported URL|is not a valid URL|No video formats found|HTTP Error (?:404|410)\b",
+    re.IGNORECASE
+)
+
+# Отказ сервера в доступе: у YouTube 403 и 429 - ограничение запросов, а не удалённое видео
+THROTTLED_PATTERN = re.compile(r"HTTP Error (?:403|429)\b", re.IGNORECASE)
+
+# Сетевые и серверные ошибки, которые обычно проходят сами: 5xx, таймауты, обрывы соединения
+TRANSIENT_PATTERN = re.compile(
+    r"HTTP Error 5\d\d\b|timed out|Connection (?:reset|refused|aborted)|"
+    r"Temporary failure in name resolution|Name or service not known|Network is unreachable|"
+    r"IncompleteRead|Remote end closed|Broken pipe|EOF occurred in violation of protocol",
+    re.IGNORECASE
+)
+
+# HTTP-коды urllib.error.HTTPError по классам
+PERMANENT_HTTP_CODES = (404, 410)
+THROTTLED_HTTP_CODES = (403, 429)
+
+# Классы ошибок, которые повторяются с задержкой
+RETRYABLE_FAILURES = ('throttled', 'transient', 'unknown')
+
+
+def classify_failure(error):
+    """
+    Классифицирует ошибку обработки трека
+
+    Returns:
+        'throttled' - YouTube ограничил запросы (в том числе HTTP 403/429)
+        'transient' - временная ошибка (сеть, таймаут, 5xx), стоит повторить
+        'permanent' - видео удалено, приватное и т.п.: повтор не поможет
+        'environment' - проблема окружения (нет yt-dlp/ffmpeg, нет места, нет прав):
+            не повторяется и не считается проблемой трека
+        'unknown' - нераспознанная ошибка yt-dlp/ffmpeg: повторяется, но трек
+            не запоминается как неудачный
+    """
+    if isinstance(error, ThrottledError):
+        return 'throttled'
+    if isinstance(error, CommandTimeoutError):
+        return 'transient'
+    if isinstance(error, subprocess.CalledProcessError):
+        stderr = error.stderr or ''
+        if PERMANENT_PATTERN.search(stderr):
+            return 'permanent'
+        if THROTTLED_PATTERN.search(stderr):
+            return 'throttled'
+        if TRANSIENT_PATTERN.search(stderr):
+            return 'transient'
+        return 'unknown'
+    # HTTPError - подкласс URLError, а URLError, ConnectionError и TimeoutError -
+    # подклассы OSError, поэтому все они проверяются раньше OSError
+    if isinstance(error, urllib.error.HTTPError):
+        if error.code in PERMANENT_HTTP_CODES:
+            return 'permanent'
+        if error.code in THROTTLED_HTTP_CODES:
+            return 'throttled'
+        if 500 <= error.code < 600:
+            return 'transient'
+        return 'unknown'
+    if isinstance(error, (urllib.error.URLError, ConnectionError, TimeoutError)):
+        return 'transient'
+    if isinstance(error, OSError):
+        return 'environment'
+    return 'unknown'
+
+
+def is_retryable(failure):
+    """True если ошибку класса failure стоит повторить"""
+    return failure in RETRYABLE_FAILURES
+
+
+def backoff_delay(attempt, base_delay=2.0, max_delay=60.0):
+    """
+    Задержка перед повтором: экспоненциальная с полным джиттером
+
+    Args:
+        attempt: номер повтора, начиная с 1
+
+    Returns:
+        Случайная задержка от 0 до min(max_delay, base_delay * 2^(attempt-1))
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+def sleep_unless_stopped(seconds, should_stop=None):
+    """
+    Спит seconds, просыпаясь раньше если should_stop() вернул True
+
+    Returns:
+        False если ожидание прервано
+    """
+    deadline = time.monotonic() + seconds
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return True
+        if should_stop and should_stop():
+            return False
+        time.sleep(min(remaining, 0.5))
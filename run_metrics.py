@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+Run Metrics
+Замеры времени по этапам обработки треков и отчёт о прогоне
+(JSON Lines трасса, сводка p50/p95, textfile для Prometheus)
+"""
+
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# Этапы обработки трека в порядке выполнения
+STAGES = ['search', 'extraction', 'download', 'transcode', 'normalize', 'encode', 'tag']
+
+# Наблюдатели, подключаемые ко всем прогонам (например, профилировщик)
+_observers = []
+
+
+def add_observer(observer):
+    """Подключает наблюдателя событий этапов (on_stage_start / on_stage_end)"""
+    _observers.append(observer)
+
+
+def remove_observer(observer):
+    """Отключает наблюдателя"""
+    if observer in _observers:
+        _observers.remove(observer)
+
+
+def percentile(values, p):
+    """
+    Перцентиль с линейной интерполяцией
+
+    Args:
+        values: список чисел
+        p: перцентиль от 0 до 100
+
+    Returns:
+        Значение перцентиля или None для пустого списка
+    """
+    if not values:
+        return None
+
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100
+    lower = math.floor(k)
+    upper = math.ceil(k)
+    if lower == upper:
+        return ordered[int(k)]
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
+
+
+class TrackMetrics:
+    """Метрики одного трека: время этапов, байты, код выхода yt-dlp, повторы, id видео"""
+
+    def __init__(self, run, num, artist, title):
+        self.run = run
+        self.num = num
+        self.artist = artist
+        self.title = title
+        self.stages = {}
+        self.bytes = 0
+        self.exit_status = None
+        self.retries = 0
+        self.failure = None
+        self.video_id = None
+        self.status = None
+        self.started_at = time.time()
+
+    @contextmanager
+    def stage(self, name):
+        """Контекстный менеджер для замера этапа"""
+        started_at = time.time()
+        start = time.perf_counter()
+        self.run.notify('on_stage_start', self.num, name)
+        try:
+            yield
+        finally:
+            self.add_stage(name, started_at, time.perf_counter() - start)
+
+    def add_stage(self, name, started_at, duration):
+        """Добавляет замер этапа (повторные замеры одного этапа суммируются)"""
+        self.stages[name] = self.stages.get(name, 0.0) + duration
+        self.run.emit({
+            'type': 'stage',
+            'track': self.num,
+            'stage': name,
+            'start': round(started_at, 3),
+            'duration': round(duration, 3)
+        })
+        self.run.notify('on_stage_end', self.num, name, duration)
+
+    def finish(self, status):
+        """Завершает трек со статусом ok / failed / skipped / known_failed / cancelled"""
+        self.status = status
+        if status not in ('failed', 'known_failed'):
+            self.failure = None
+        self.run.emit({
+            'type': 'track',
+            'track': self.num,
+            'artist': self.artist,
+            'title': self.title,
+            'video_id': self.video_id,
+            'status': status,
+            'stages': {name: round(value, 3) for name, value in self.stages.items()},
+            'bytes': self.bytes,
+            'exit_status': self.exit_status,
+            'retries': self.retries,
+            'failure': self.failure,
+            'elapsed': round(time.time() - self.started_at, 3)
+        })
+
+
+class StageTracker:
+    """
+    Разбивает один длинный процесс на этапы по строкам его вывода
+
+    classify(line) возвращает имя этапа, к которому относится строка,
+    или None если строка этап не меняет.
+    """
+
+    def __init__(self, track_metrics, classify):
+        self.track_metrics = track_metrics
+        self.classify = classify
+        self.current = None
+        self.current_started_at = None
+        self.current_start = None
+
+    def feed(self, line):
+        """Обрабатывает строку вывода"""
+        name = self.classify(line)
+        if name and name != self.current:
+            self.close()
+            self.current = name
+            self.track_metrics.run.notify('on_stage_start', self.track_metrics.num, name)
+            self.current_started_at = time.time()
+            self.current_start = time.perf_counter()
+
+    def close(self):
+        """Закрывает текущий этап"""
+        if self.current:
+            self.track_metrics.add_stage(
+                self.current,
+                self.current_started_at,
+                time.perf_counter() - self.current_start
+            )
+        self.current = None
+
+
+class RunMetrics:
+    """Метрики всего прогона download_from_csv"""
+
+    def __init__(self, trace_path=None):
+        self.tracks = []
+        self.started_at = time.time()
+        self.finished_at = None
+        self.observers = list(_observers)
+        self._lock = threading.Lock()
+        self._trace = None
+        if trace_path:
+            Path(trace_path).parent.mkdir(parents=True, exist_ok=True)
+            self._trace = open(trace_path, 'w', encoding='utf-8', buffering=1)
+
+    def start_track(self, num, artist, title):
+        """Регистрирует новый трек и возвращает его TrackMetrics"""
+        track = TrackMetrics(self, num, artist, title)
+        with self._lock:
+            self.tracks.append(track)
+        return track
+
+    def emit(self, event):
+        """Пишет событие в JSON Lines трассу"""
+        if self._trace:
+            with self._lock:
+                self._trace.write(json.dumps(event, ensure_ascii=False) + '\n')
+
+    def notify(self, method, *args):
+        """Передаёт событие наблюдателям (например, профилировщику)"""
+        for observer in self.observers:
+            handler = getattr(observer, method, None)
+            if handler:
+                handler(*args)
+
+    def finish(self):
+        """Завершает прогон, пишет сводку в трассу и закрывает файл"""
+        self.finished_at = time.time()
+        self.emit({'type': 'summary', **self.summary()})
+        if self._trace:
+            self._trace.close()
+            self._trace = None
+
+    def summary(self):
+        """
+        Сводка по прогону
+
+        Returns:
+            dict с количеством треков по статусам, p50/p95 по этапам,
+            суммарными байтами/повторами и скоростью в треках в минуту
+        """
+        finished_at = self.finished_at or time.time()
+        elapsed = finished_at - self.started_at
+
+        with self._lock:
+            tracks = list(self.tracks)
+
+        counts = {'ok': 0, 'failed': 0, 'skipped': 0, 'known_failed': 0, 'cancelled': 0}
+        failures = {}
+        known_failed = []
+        for track in tracks:
+            if track.status in counts:
+                counts[track.status] += 1
+            if track.status == 'failed' and track.failure:
+                failures[track.failure] = failures.get(track.failure, 0) + 1
+            if track.status == 'known_failed':
+                known_failed.append({'track': track.num, 'artist': track.artist, 'title': track.title,
+                                     'cause': track.failure})
+
+        stages = {}
+        for name in STAGES:
+            values = [track.stages[name] for track in tracks if name in track.stages]
+            if values:
+                stages[name] = {
+                    'count': len(values),
+                    'p50': round(percentile(values, 50), 3),
+                    'p95': round(percentile(values, 95), 3),
+                    'total': round(sum(values), 3)
+                }
+
+        processed = counts['ok'] + counts['failed']
+        return {
+            'tracks_total': len(tracks),
+            'tracks_ok': counts['ok'],
+            'tracks_failed': counts['failed'],
+            'tracks_skipped': counts['skipped'],
+            'tracks_known_failed': counts['known_failed'],
+            'tracks_cancelled': counts['cancelled'],
+            'elapsed_seconds': round(elapsed, 3),
+            'tracks_per_minute': round(processed / elapsed * 60, 2) if elapsed > 0 else 0.0,
+            'bytes_total': sum(track.bytes for track in tracks),
+            'retries_total': sum(track.retries for track in tracks),
+            'failures': failures,
+            'known_failed': known_failed,
+            'stages': stages
+        }
+
+    def format_summary(self):
+        """Сводка в виде строк для лога"""
+        summary = self.summary()
+        lines = [
+            f"📊 Статистика: {summary['tracks_total']} треков "
+            f"(✅ {summary['tracks_ok']}, ⏭️ {summary['tracks_skipped']}, ❌ {summary['tracks_failed']}), "
+            f"{summary['tracks_per_minute']} треков/мин, "
+            f"{summary['bytes_total'] / 1024 / 1024:.1f} MiB"
+        ]
+        if summary['tracks_cancelled']:
+            lines.append(f"   ⏹️ Отменено: {summary['tracks_cancelled']}")
+        if summary['known_failed']:
+            lines.append(f"   🚫 Пропущено как известные неудачи: {summary['tracks_known_failed']}")
+            for track in summary['known_failed']:
+                lines.append(f"      [{track['track']}] {track['artist']} - {track['title']} ({track['cause']})")
+        for name, stats in summary['stages'].items():
+            lines.append(f"   {name}: p50 {stats['p50']:.2f}s, p95 {stats['p95']:.2f}s, всего {stats['total']:.1f}s")
+        return lines
+
+    def write_summary(self, path):
+        """Сохраняет сводку в JSON"""
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, ensure_ascii=False, indent=2)
+
+    def write_prometheus(self, path):
+        """
+        Сохраняет метрики в формате textfile для node_exporter
+
+        Файл пишется атомарно (через временный файл и rename),
+        чтобы коллектор не прочитал его наполовину записанным.
+        """
+        summary = self.summary()
+        lines = [
+            '# HELP music_downloader_stage_seconds Time spent per track in each stage.',
+            '# TYPE music_downloader_stage_seconds summary'
+        ]
+        for name, stats in summary['stages'].items():
+            lines.append(f'music_downloader_stage_seconds{{stage="{name}",quantile="0.5"}} {stats["p50"]}')
+            lines.append(f'music_downloader_stage_seconds{{stage="{name}",quantile="0.95"}} {stats["p95"]}')
+            lines.append(f'music_downloader_stage_seconds_sum{{stage="{name}"}} {stats["total"]}')
+            lines.append(f'music_downloader_stage_seconds_count{{stage="{name}"}} {stats["count"]}')
+
+        lines += [
+            '# HELP music_downloader_tracks Tracks processed in the last run by status.',
+            '# TYPE music_downloader_tracks gauge',
+            f'music_downloader_tracks{{status="ok"}} {summary["tracks_ok"]}',
+            f'music_downloader_tracks{{status="failed"}} {summary["tracks_failed"]}',
+            f'music_downloader_tracks{{status="skipped"}} {summary["tracks_skipped"]}',
+            f'music_downloader_tracks{{status="known_failed"}} {summary["tracks_known_failed"]}',
+            f'music_downloader_tracks{{status="cancelled"}} {summary["tracks_cancelled"]}',
+            '# HELP music_downloader_bytes Bytes downloaded in the last run.',
+            '# TYPE music_downloader_bytes gauge',
+            f'music_downloader_bytes {summary["bytes_total"]}',
+            '# HELP music_downloader_retries Retries in the last run.',
+            '# TYPE music_downloader_retries gauge',
+            f'music_downloader_retries {summary["retries_total"]}',
+            '# HELP music_downloader_tracks_per_minute Throughput of the last run.',
+            '# TYPE music_downloader_tracks_per_minute gauge',
+            f'music_downloader_tracks_per_minute {summary["tracks_per_minute"]}',
+            '# HELP music_downloader_run_seconds Wall time of the last run.',
+            '# TYPE music_downloader_run_seconds gauge',
+            f'music_downloader_run_seconds {summary["elapsed_seconds"]}',
+        ]
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Tagging
+Теги и обложка из записи плейлиста (артист, название, альбом, номер трека),
+записываемые в процессе через mutagen одним проходом
+"""
+
+import base64
+from pathlib import Path
+
+try:
+    from mutagen.flac import Picture
+    from mutagen.id3 import APIC, ID3, ID3NoHeaderError, TALB, TIT2, TPE1, TRCK, TXXX
+    from mutagen.mp4 import MP4, MP4Cover
+    from mutagen.oggopus import OggOpus
+    from mutagen.oggvorbis import OggVorbis
+except ImportError:  # без mutagen теги пишет ffmpeg (см. download_music.tag_with_ffmpeg)
+    MP4 = None
+
+# Префикс метки обработки в теге comment (по нему проверка библиотеки узнаёт
+# нормализованные и выровненные по группе файлы)
+MARKER_PREFIX = 'music-downloader'
+
+# Форматы, которые умеет write_tags
+TAG_EXTENSIONS = ('.mp3', '.m4a', '.opus', '.ogg')
+
+# Опорная громкость ReplayGain 2.0 и R128 (Opus) в LUFS
+REPLAYGAIN_REFERENCE = -18.0
+R128_REFERENCE = -23.0
+
+
+def is_available():
+    """True если установлен mutagen"""
+    return MP4 is not None
+
+
+def build_tags(song, total=None):
+    """
+    Теги из строки CSV
+
+    Args:
+        song: dict со столбцами №, Песня, Артист, Альбом
+        total: число треков в плейлисте (опционально)
+
+    Returns:
+        dict: artist, title, album, track, total (пустые значения не включаются)
+    """
+    tags = {
+        'artist': (song.get('Артист') or '').strip(),
+        'title': (song.get('Песня') or '').strip(),
+        'album': (song.get('Альбом') or '').strip(),
+    }
+    number = (song.get('№') or '').strip()
+    if number.isdigit():
+        tags['track'] = int(number)
+        if total:
+            tags['total'] = total
+    return {key: value for key, value in tags.items() if value}
+
+
+def _write_id3(path, tags, cover):
+    """MP3: ID3v2.3 (читается и в Windows); при достаточном padding переписывается только заголовок"""
+    try:
+        id3 = ID3(path)
+    except ID3NoHeaderError:
+        id3 = ID3()
+
+    for frame_class, key in ((TPE1, 'artist'), (TIT2, 'title'), (TALB, 'album')):
+        if key in tags:
+            id3.setall(frame_class.__name__, [frame_class(encoding=3, text=tags[key])])
+    if 'track' in tags:
+        track = f"{tags['track']}/{tags['total']}" if 'total' in tags else str(tags['track'])
+        id3.setall('TRCK', [TRCK(encoding=3, text=track)])
+    if cover:
+        id3.delall('APIC')
+        id3.add(APIC(encoding=3, mime='image/jpeg', type=3, desc='Cover', data=cover))
+
+    id3.save(path, v2_version=3)
+
+
+def _write_mp4(path, tags, cover):
+    """M4A: атомы iTunes"""
+    audio = MP4(path)
+    for atom, key in (('\xa9ART', 'artist'), ('\xa9nam', 'title'), ('\xa9alb', 'album')):
+        if key in tags:
+            audio[atom] = [tags[key]]
+    if 'track' in tags:
+        audio['trkn'] = [(tags['track'], tags.get('total', 0))]
+    if cover:
+        audio['covr'] = [MP4Cover(cover, imageformat=MP4Cover.FORMAT_JPEG)]
+    audio.save()
+
+
+def _write_vorbis(audio, tags, cover):
+    """Opus/Vorbis: Vorbis comments, обложка - METADATA_BLOCK_PICTURE"""
+    for key in ('artist', 'title', 'album'):
+        if key in tags:
+            audio[key] = [tags[key]]
+    if 'track' in tags:
+        audio['tracknumber'] = [str(tags['track'])]
+        if 'total' in tags:
+            audio['tracktotal'] = [str(tags['total'])]
+    if cover:
+        picture = Picture()
+        picture.type = 3  # обложка (front cover)
+        picture.mime = 'image/jpeg'
+        picture.desc = 'Cover'
+        picture.data = cover
+        audio['metadata_block_picture'] = [base64.b64encode(picture.write()).decode('ascii')]
+    audio.save()
+
+
+def write_tags(path, tags, cover_path=None):
+    """
+    Записывает теги и обложку в файл одним проходом
+
+    Args:
+        path: путь к треку (.mp3, .m4a, .opus, .ogg)
+        tags: dict из build_tags
+        cover_path: путь к JPEG-обложке (опционально)
+
+    Raises:
+        RuntimeError: mutagen не установлен
+        ValueError: формат не поддерживается
+        mutagen.MutagenError: файл повреждён
+    """
+    if not is_available():
+        raise RuntimeError("mutagen не установлен")
+
+    path = Path(path)
+    cover = Path(cover_path).read_bytes() if cover_path else None
+    suffix = path.suffix.lower()
+
+    if suffix == '.mp3':
+        _write_id3(path, tags, cover)
+    elif suffix == '.m4a':
+        _write_mp4(path, tags, cover)
+    elif suffix == '.opus':
+        _write_vorbis(OggOpus(path), tags, cover)
+    elif suffix == '.ogg':
+        _write_vorbis(OggVorbis(path), tags, cover)
+    else:
+        raise ValueError(f"Теги для {suffix} не поддерживаются")
+
+
+def build_gain_tags(track_loudness, track_peak, group_loudness, group_peak):
+    """
+    Теги ReplayGain 2.0 по измерениям EBU R128
+
+    Args:
+        track_loudness, group_loudness: интегральная громкость трека и альбома/плейлиста (LUFS)
+        track_peak, group_peak: true peak (dBTP) или None
+
+    Returns:
+        dict тег -> строка (ключи в нижнем регистре, как в Vorbis comments)
+    """
+    tags = {
+        'replaygain_track_gain': f"{REPLAYGAIN_REFERENCE - track_loudness:.2f} dB",
+        'replaygain_album_gain': f"{REPLAYGAIN_REFERENCE - group_loudness:.2f} dB",
+    }
+    if track_peak is not None:
+        tags['replaygain_track_peak'] = f"{10 ** (track_peak / 20):.6f}"
+    if group_peak is not None:
+        tags['replaygain_album_peak'] = f"{10 ** (group_peak / 20):.6f}"
+    return tags
+
+
+def write_gain_tags(path, track_loudness, track_peak, group_loudness, group_peak):
+    """
+    Записывает трековый и групповой gain (звук не перекодируется)
+
+    MP3 - TXXX:REPLAYGAIN_*, M4A - атомы iTunes, Ogg Vorbis - REPLAYGAIN_*,
+    Opus - R128_TRACK_GAIN/R128_ALBUM_GAIN (Q7.8 относительно -23 LUFS, RFC 7845).
+
+    Raises:
+        RuntimeError: mutagen не установлен
+        ValueError: формат не поддерживается
+        mutagen.MutagenError: файл повреждён
+    """
+    if not is_available():
+        raise RuntimeError("mutagen не установлен")
+
+    path = Path(path)
+    suffix = path.suffix.lower()
+    tags = build_gain_tags(track_loudness, track_peak, group_loudness, group_peak)
+
+    if suffix == '.mp3':
+        try:
+            id3 = ID3(path)
+        except ID3NoHeaderError:
+            id3 = ID3()
+        for key, value in tags.items():
+            id3.setall(f"TXXX:{key.upper()}", [TXXX(encoding=3, desc=key.upper(), text=value)])
+        id3.save(path, v2_version=3)
+    elif suffix == '.m4a':
+        audio = MP4(path)
+        for key, value in tags.items():
+            audio[f"----:com.apple.iTunes:{key}"] = [value.encode('utf-8')]
+        audio.save()
+    elif suffix == '.opus':
+        audio = OggOpus(path)
+        audio['r128_track_gain'] = [str(round((R128_REFERENCE - track_loudness) * 256))]
+        audio['r128_album_gain'] = [str(round((R128_REFERENCE - group_loudness) * 256))]
+        audio.save()
+    elif suffix == '.ogg':
+        audio = OggVorbis(path)
+        for key, value in tags.items():
+            audio[key] = [value]
+        audio.save()
+    else:
+        raise ValueError(f"Gain для {suffix} не поддерживается")
@@ -0,0 +1,19 @@
+"""
+Общие настройки тестов: модули берутся из корня репозитория,
+кэш приложения - во временной папке, а не в ~/.cache
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture(autouse=True)
+def app_cache_dir(tmp_path, monkeypatch):
+    """Отдельная папка кэша на каждый тест"""
+    cache_dir = tmp_path / 'cache'
+    monkeypatch.setenv('MUSIC_DOWNLOADER_CACHE', str(cache_dir))
+    return cache_dir
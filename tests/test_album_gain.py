@@ -0,0 +1,76 @@
+"""
+Громкость альбома/плейлиста: среднее по группе, gain с пределом пика и разбор сводки ebur128
+"""
+
+import math
+import os
+import sys
+
+import pytest
+
+import album_gain
+
+
+def measurement(loudness, duration, peak=None):
+    return {'loudness': loudness, 'peak': peak, 'duration': duration}
+
+
+def test_group_loudness_of_equal_tracks():
+    assert album_gain.group_loudness([measurement(-14.0, 200), measurement(-14.0, 100)]) == pytest.approx(-14.0)
+
+
+def test_group_loudness_is_energy_mean_weighted_by_duration():
+    loudness = album_gain.group_loudness([measurement(-10.0, 300), measurement(-20.0, 100)])
+    expected = 10 * math.log10((300 * 10 ** -1.0 + 100 * 10 ** -2.0) / 400)
+    assert loudness == pytest.approx(expected)
+    # Громкий трек весит больше арифметического среднего
+    assert loudness > -12.5
+
+
+def test_group_loudness_ignores_silence_and_empty_tracks():
+    tracks = [measurement(float('-inf'), 300), measurement(-12.0, 0), measurement(-18.0, 120)]
+    assert album_gain.group_loudness(tracks) == pytest.approx(-18.0)
+    assert album_gain.group_loudness([measurement(float('-inf'), 300)]) is None
+    assert album_gain.group_loudness([]) is None
+
+
+def test_group_gain_is_limited_by_true_peak():
+    quiet = [measurement(-26.0, 200, peak=-12.0)]
+    assert album_gain.group_gain(quiet) == pytest.approx(album_gain.GROUP_TARGET_LOUDNESS + 26.0)
+
+    peaky = [measurement(-26.0, 200, peak=-3.0), measurement(-26.0, 200, peak=-9.0)]
+    assert album_gain.group_gain(peaky) == pytest.approx(album_gain.MAX_TRUE_PEAK + 3.0)
+
+
+FAKE_FFMPEG = '''#!{python}
+import sys
+for frame in range(5000):
+    sys.stderr.write("[Parsed_ebur128_0 @ 0x1] [info] t: %d M: -20.0 S: -20.0 I: -30.0 LUFS LRA: 0.0 LU\\n" % frame)
+sys.stderr.write("[Parsed_ebur128_0 @ 0x1] [info] Summary:\\n")
+sys.stderr.write("  Integrated loudness:\\n    I:         -17.3 LUFS\\n")
+sys.stderr.write("  True peak:\\n    Peak:       -0.8 dBFS\\n")
+print("out_time_us=183500000")
+print("progress=end")
+'''
+
+
+def test_analyze_file_parses_summary_and_keeps_stderr_tail(tmp_path, monkeypatch):
+    ffmpeg = tmp_path / 'bin' / 'ffmpeg'
+    ffmpeg.parent.mkdir()
+    ffmpeg.write_text(FAKE_FFMPEG.format(python=sys.executable))
+    ffmpeg.chmod(0o755)
+    monkeypatch.setenv('PATH', f"{ffmpeg.parent}{os.pathsep}{os.environ.get('PATH', '')}")
+
+    stderr_sizes = []
+    real_run_command = album_gain.run_command
+
+    def run_command(*args, **kwargs):
+        result = real_run_command(*args, **kwargs)
+        stderr_sizes.append(len(result.stderr.splitlines()))
+        return result
+
+    monkeypatch.setattr(album_gain, 'run_command', run_command)
+    result = album_gain.analyze_file(tmp_path / 'track.mp3')
+
+    assert result == {'loudness': -17.3, 'peak': -0.8, 'duration': 183.5}
+    assert stderr_sizes == [album_gain.ANALYSIS_STDERR_LINES]
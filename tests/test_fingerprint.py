@@ -0,0 +1,57 @@
+"""
+Акустические отпечатки: полосы спектра и доля несовпавших бит
+"""
+
+import numpy as np
+
+import fingerprint
+
+
+def tone_mix(seconds, frequencies, seed=0):
+    """Смесь синусоид, меняющих громкость, с частотой SAMPLE_RATE"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * fingerprint.SAMPLE_RATE)) / fingerprint.SAMPLE_RATE
+    samples = np.zeros_like(t)
+    for frequency in frequencies:
+        envelope = 1 + np.sin(2 * np.pi * rng.uniform(0.2, 2.0) * t + rng.uniform(0, np.pi))
+        samples += envelope * np.sin(2 * np.pi * frequency * t)
+    return (samples / len(frequencies)).astype(np.float32)
+
+
+def test_energy_above_band_range_does_not_change_fingerprint():
+    music = tone_mix(10, [350, 520, 800, 1200, 1700])
+    t = np.arange(len(music)) / fingerprint.SAMPLE_RATE
+    # Шум выше BAND_RANGE (например, хай-хэт) не должен попадать в последнюю полосу
+    hiss = (0.5 * np.sin(2 * np.pi * 4000 * t) * (1 + np.sin(2 * np.pi * 3 * t))).astype(np.float32)
+
+    clean = fingerprint.compute_fingerprint(music)
+    noisy = fingerprint.compute_fingerprint(music + hiss)
+    assert len(clean) > fingerprint.MIN_SHARED_FRAMES
+    assert fingerprint.bit_error_rate(clean, noisy, max_offset=0) < 0.01
+
+
+def test_short_track_has_empty_fingerprint():
+    samples = np.zeros(fingerprint.FRAME_SIZE, dtype=np.float32)
+    assert len(fingerprint.compute_fingerprint(samples)) == 0
+
+
+def test_bit_error_rate_identical_and_shifted():
+    rng = np.random.default_rng(1)
+    first = rng.integers(0, 2 ** 32, size=500, dtype=np.uint32)
+    assert fingerprint.bit_error_rate(first, first) == 0.0
+    # Второй отпечаток начинается на 30 кадров позже
+    assert fingerprint.bit_error_rate(first, first[30:]) == 0.0
+    assert fingerprint.bit_error_rate(first[30:], first) == 0.0
+
+
+def test_bit_error_rate_unrelated_is_about_half():
+    rng = np.random.default_rng(2)
+    first = rng.integers(0, 2 ** 32, size=500, dtype=np.uint32)
+    second = rng.integers(0, 2 ** 32, size=500, dtype=np.uint32)
+    rate = fingerprint.bit_error_rate(first, second, max_offset=10)
+    assert fingerprint.MATCH_BIT_ERROR_RATE < 0.4 < rate < 0.5
+
+
+def test_bit_error_rate_without_overlap():
+    first = np.zeros(fingerprint.MIN_SHARED_FRAMES - 1, dtype=np.uint32)
+    assert fingerprint.bit_error_rate(first, first) == 1.0
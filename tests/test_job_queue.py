@@ -0,0 +1,142 @@
+"""
+Очередь заданий: порядок выдачи, аренда и несколько исполнителей на одной базе
+"""
+
+import multiprocessing
+import time
+
+import job_queue
+from process_runner import CancelToken
+from run_metrics import RunMetrics
+
+
+def songs(count, start=1):
+    return [{'№': str(num), 'Песня': f"Song {num}", 'Артист': 'Artist', 'Альбом': ''}
+            for num in range(start, start + count)]
+
+
+def test_claim_order_priority_then_round_robin(tmp_path):
+    queue = job_queue.JobQueue(tmp_path / 'jobs.db')
+    batch = queue.add_job(songs(2), tmp_path / 'out', priority='batch')
+    first = queue.add_job(songs(3), tmp_path / 'out', priority='normal')
+    second = queue.add_job(songs(3), tmp_path / 'out', priority='normal')
+    interactive = queue.add_job(songs(1), tmp_path / 'out', priority='interactive')
+
+    claimed = []
+    for _ in range(9):
+        task = queue.claim_task('w')
+        claimed.append((task['job_id'], task['num']))
+        # Отметки last_served_at у заданий должны различаться
+        time.sleep(0.01)
+
+    assert claimed[0] == (interactive, '01')
+    # Задания одного приоритета чередуются, внутри задания - по номеру трека
+    assert claimed[1:7] == [(first, '01'), (second, '01'), (first, '02'),
+                            (second, '02'), (first, '03'), (second, '03')]
+    assert claimed[7:] == [(batch, '01'), (batch, '02')]
+    assert queue.claim_task('w') is None
+
+
+def test_add_job_renumbers_missing_and_duplicate_numbers(tmp_path):
+    queue = job_queue.JobQueue(tmp_path / 'jobs.db')
+    rows = [{'№': '1', 'Песня': 'a'}, {'№': '', 'Песня': 'b'}, {'№': '1', 'Песня': 'c'}, {'№': '3', 'Песня': 'd'}]
+    job_id = queue.add_job(rows, tmp_path / 'out')
+
+    status = queue.job_status(job_id)
+    assert status['total'] == 4
+    assert status['tasks'] == {'pending': 4}
+    assert [song['№'] for song in queue.job_songs(job_id)] == ['1', '2', '4', '3']
+
+
+def test_expired_lease_is_reclaimed_with_attempt(tmp_path):
+    queue = job_queue.JobQueue(tmp_path / 'jobs.db', lease_duration=0.2)
+    queue.add_job(songs(1), tmp_path / 'out')
+
+    task = queue.claim_task('crashed-node:1')
+    assert queue.claim_task('other-node:1') is None
+
+    time.sleep(0.3)
+    reclaimed = queue.claim_task('other-node:1')
+    assert reclaimed['id'] == task['id']
+    assert reclaimed['attempts'] == 1
+
+    # Упавший узел проснулся: аренда уже не его, результат не записывается
+    assert queue.complete_task(task['id'], 'ok', worker='crashed-node:1') is None
+    assert queue.complete_task(task['id'], 'ok', worker='other-node:1') == task['job_id']
+
+
+def test_renew_keeps_lease(tmp_path):
+    queue = job_queue.JobQueue(tmp_path / 'jobs.db', lease_duration=0.3)
+    queue.add_job(songs(1), tmp_path / 'out')
+    queue.claim_task('node:1')
+
+    for _ in range(3):
+        time.sleep(0.15)
+        assert queue.renew_leases('node:1') == 1
+    assert queue.claim_task('node:2') is None
+
+
+def _worker(db_path, worker, lease_duration, crash, results):
+    """Процесс-исполнитель: берёт задачи, пока в очереди есть незавершённые"""
+    queue = job_queue.JobQueue(db_path, lease_duration=lease_duration)
+    claimed = []
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        task = queue.claim_task(worker)
+        if task is None:
+            if not queue.has_unfinished_tasks():
+                break
+            time.sleep(0.05)
+            continue
+        claimed.append(task['id'])
+        if crash:
+            # Узел падает с задачей на руках, не продлевая аренду
+            break
+        time.sleep(0.01)
+        queue.complete_task(task['id'], 'ok', worker=worker)
+    results.put((worker, claimed))
+
+
+def test_local_workers_share_queue_without_double_claims(tmp_path):
+    db_path = tmp_path / 'jobs.db'
+    queue = job_queue.JobQueue(db_path, lease_duration=1.0)
+    job_ids = [queue.add_job(songs(15), tmp_path / 'out', priority=priority)
+               for priority in ('interactive', 'normal', 'batch')]
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    processes = [context.Process(target=_worker, args=(db_path, f"node:{i}", 1.0, i == 0, results))
+                 for i in range(4)]
+    for process in processes:
+        process.start()
+    claims = dict(results.get(timeout=60) for _ in processes)
+    for process in processes:
+        process.join(timeout=10)
+
+    crashed_task = claims['node:0'][0]
+    completed = [task_id for worker, claimed in claims.items() if worker != 'node:0' for task_id in claimed]
+    # Каждую задачу выполнил ровно один исполнитель, задача упавшего узла вернулась в очередь
+    assert len(completed) == len(set(completed)) == 45
+    assert crashed_task in completed
+    for job_id in job_ids:
+        status = queue.job_status(job_id)
+        assert status['state'] == 'done'
+        assert status['tasks'] == {'ok': 15}
+
+
+def test_runner_closes_context_of_job_finished_by_other_node(tmp_path):
+    queue = job_queue.JobQueue(tmp_path / 'jobs.db')
+    job_id = queue.add_job(songs(1), tmp_path / 'out')
+    runner = job_queue.QueueRunner(queue, workers=1)
+    metrics = RunMetrics(trace_path=tmp_path / 'report' / 'run_trace.jsonl')
+    runner._jobs[job_id] = (None, CancelToken(), metrics)
+
+    runner._close_finished_contexts()
+    assert job_id in runner._jobs
+
+    task = queue.claim_task('other-node:1')
+    assert queue.complete_task(task['id'], 'ok', worker='other-node:1') == job_id
+
+    runner._close_finished_contexts()
+    assert job_id not in runner._jobs
+    assert metrics._trace is None
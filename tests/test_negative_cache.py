@@ -0,0 +1,58 @@
+"""
+Кэш неудач: какие причины запоминаются и как растёт интервал перепроверки
+"""
+
+import time
+
+import pytest
+
+import negative_cache
+
+DAY = 24 * 3600
+
+
+def test_ttl_doubles_up_to_maximum():
+    assert [negative_cache.negative_ttl(failures) // DAY for failures in range(1, 8)] == [1, 2, 4, 8, 16, 30, 30]
+    assert negative_cache.negative_ttl(0) == negative_cache.NEGATIVE_BASE_TTL
+
+
+def test_track_key_ignores_case_and_spaces():
+    assert negative_cache.track_key(' Linkin Park ', 'Numb ') == negative_cache.track_key('linkin park', 'NUMB')
+
+
+def test_repeated_failures_double_retry_interval(tmp_path):
+    cache = negative_cache.NegativeCache(tmp_path)
+    first = cache.record('Artist', 'Song', 'not_found')
+    second = cache.record('artist', 'song', 'not_found', error='no results')
+
+    assert first['failures'] == 1
+    assert first['retry_after'] - first['last_failed_at'] == pytest.approx(DAY)
+    assert second['failures'] == 2
+    assert second['retry_after'] - second['last_failed_at'] == pytest.approx(2 * DAY)
+    assert second['first_failed_at'] == first['first_failed_at']
+    assert cache.check('Artist', 'Song')['error'] == 'no results'
+
+
+@pytest.mark.parametrize('cause', ['transient', 'throttled', 'environment', 'unknown', 'cancelled'])
+def test_only_track_problems_are_cached(tmp_path, cause):
+    cache = negative_cache.NegativeCache(tmp_path)
+    assert cache.record('Artist', 'Song', cause) is None
+    assert cache.check('Artist', 'Song') is None
+
+
+def test_expired_entry_is_rechecked_and_success_clears_it(tmp_path, monkeypatch):
+    cache = negative_cache.NegativeCache(tmp_path)
+    cache.record('Artist', 'Song', 'permanent')
+    assert cache.check('Artist', 'Song')
+
+    now = time.time()
+    monkeypatch.setattr(negative_cache.time, 'time', lambda: now + DAY + 1)
+    assert cache.check('Artist', 'Song') is None
+
+    cache.clear('Artist', 'Song')
+    assert negative_cache.NegativeCache(tmp_path)._entries() == {}
+
+
+def test_entries_are_shared_through_file(tmp_path):
+    negative_cache.NegativeCache(tmp_path).record('Artist', 'Song', 'not_found')
+    assert negative_cache.NegativeCache(tmp_path).check('Artist', 'Song')['cause'] == 'not_found'
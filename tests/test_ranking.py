@@ -0,0 +1,100 @@
+"""
+Ранжирование кандидатов поиска и проверенный корпус
+"""
+
+import ranking
+
+
+def video(video_id, title, uploader, duration):
+    return {'video_id': video_id, 'title': title, 'uploader': uploader, 'duration': duration}
+
+
+def ranked_ids(query, candidates, max_duration=600):
+    return [candidate['video_id'] for candidate in ranking.rank_candidates(query, candidates, max_duration)]
+
+
+def test_too_long_and_unknown_duration_are_dropped():
+    candidates = [
+        video('album', 'Artist - Full Album', 'artist', 2700),
+        video('stream', 'Artist - Song (Official Audio)', 'artist', None),
+        video('song', 'Artist - Song', 'some channel', 200),
+    ]
+    assert ranked_ids(ranking.RankQuery('Artist Song'), candidates) == ['song']
+    assert candidates[0]['tier'] == candidates[1]['tier'] == 'too_long'
+    assert candidates[0]['score'] == 0
+
+
+def test_official_channel_beats_reupload():
+    candidates = [
+        video('reupload', 'Disturbed - Stricken (Official Audio)', 'metal uploads', 247),
+        video('official', 'Disturbed - Stricken', 'disturbed', 247),
+    ]
+    assert ranked_ids(ranking.RankQuery('Disturbed Stricken', 247), candidates) == ['official', 'reupload']
+    assert candidates[1]['tier'] == 'official_channel'
+    assert candidates[0]['tier'] == 'official_audio'
+
+
+def test_other_versions_are_penalised_unless_requested():
+    candidates = [
+        video('live', 'Coldplay - Viva La Vida (Live In São Paulo)', 'coldplay', 242),
+        video('studio', 'Coldplay - Viva La Vida (Official Video)', 'coldplay', 244),
+    ]
+    assert ranked_ids(ranking.RankQuery('Coldplay Viva La Vida', 242), candidates)[0] == 'studio'
+
+    remixes = [
+        video('original', 'Artist - Song (Official Audio)', 'artist', 200),
+        video('remix', 'Artist - Song (Club Remix) (Official Audio)', 'artist', 200),
+    ]
+    assert ranked_ids(ranking.RankQuery('Artist Song'), remixes)[0] == 'original'
+    # "remix" в названии самого трека - это и есть нужная версия
+    assert ranked_ids(ranking.RankQuery('Artist Song Club Remix'), remixes)[0] == 'remix'
+
+
+def test_duration_decides_between_equal_tiers():
+    candidates = [
+        video('extended', 'The Killers - Mr. Brightside (Official Audio)', 'the killers', 290),
+        video('audio', 'The Killers - Mr. Brightside (Official Audio)', 'the killers', 222),
+    ]
+    assert ranked_ids(ranking.RankQuery('The Killers Mr. Brightside', 222), candidates) == ['audio', 'extended']
+    # Без длительности трека у официального канала выигрывает более короткая (студийная) версия
+    assert ranked_ids(ranking.RankQuery('The Killers Mr. Brightside'), candidates) == ['audio', 'extended']
+
+
+def test_equal_candidates_keep_search_order():
+    candidates = [
+        video('first', 'Some Song', 'uploader one', 200),
+        video('second', 'Some Song', 'uploader two', 200),
+    ]
+    assert ranked_ids(ranking.RankQuery('Artist Some Song'), candidates) == ['first', 'second']
+
+
+def test_transliterated_artist_matches_cyrillic_channel():
+    candidates = [
+        video('cover', 'Kino - Gruppa Krovi (cover)', 'rock covers', 290),
+        video('official', 'Кино - Группа крови', 'кино', 287),
+    ]
+    assert ranked_ids(ranking.RankQuery('Kino Gruppa Krovi', 287), candidates)[0] == 'official'
+    assert candidates[1]['tier'] == 'official_channel'
+
+
+def test_artist_channel_search_marks_candidates_official():
+    query = ranking.RankQuery('Numb', in_artist_channel=True)
+    candidates = [video('numb', 'Numb (Official Music Video)', 'lpvevo', 187)]
+    ranking.rank_candidates(query, candidates, 600)
+    assert candidates[0]['tier'] == 'official_channel'
+
+
+def test_rank_batch_matches_rank_candidates():
+    entries = ranking.load_corpus(ranking.DEFAULT_CORPUS)
+    picks = ranking.rank_batch(ranking.corpus_items(entries))
+    for (query, candidates, max_duration), pick in zip(ranking.corpus_items(entries), picks):
+        best = ranking.rank_candidates(query, candidates, max_duration)
+        assert (best[0]['video_id'] if best else None) == (pick['video_id'] if pick else None)
+
+
+def test_sample_corpus_is_reviewed_and_ranked_correctly():
+    entries = ranking.load_corpus(ranking.DEFAULT_CORPUS)
+    stats = ranking.evaluate_corpus(entries, rounds=1)
+    assert stats['reviewed'] == stats['entries'] > 0
+    assert stats['correct'] == stats['reviewed']
+    assert stats['mismatches'] == []
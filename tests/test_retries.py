@@ -0,0 +1,72 @@
+"""
+Классификация ошибок yt-dlp/ffmpeg и задержка повторов
+"""
+
+import subprocess
+import urllib.error
+
+import pytest
+
+import retries
+from process_runner import CommandTimeoutError
+from throttle import ThrottledError
+
+
+def yt_dlp_error(stderr):
+    return subprocess.CalledProcessError(1, ['yt-dlp'], stderr=stderr)
+
+
+@pytest.mark.parametrize('stderr, failure', [
+    ("ERROR: [youtube] abc: Video unavailable", 'permanent'),
+    ("ERROR: [youtube] abc: Private video. Sign in if you've been granted access", 'permanent'),
+    ("ERROR: Unable to download webpage: HTTP Error 404: Not Found", 'permanent'),
+    ("ERROR: unable to download video data: HTTP Error 410: Gone", 'permanent'),
+    ("ERROR: unable to download video data: HTTP Error 403: Forbidden", 'throttled'),
+    ("ERROR: Unable to download webpage: HTTP Error 429: Too Many Requests", 'throttled'),
+    ("ERROR: Unable to download webpage: HTTP Error 503: Service Unavailable", 'transient'),
+    ("ERROR: Unable to download webpage: <urlopen error timed out>", 'transient'),
+    ("ERROR: [Errno 104] Connection reset by peer", 'transient'),
+    ("ERROR: <urlopen error [Errno -3] Temporary failure in name resolution>", 'transient'),
+    ("ERROR: IncompleteRead(1024 bytes read, 2048 more expected)", 'transient'),
+    # Общие слова без конкретной причины - не повод считать ошибку временной
+    ("ERROR: Unable to download webpage: some new yt-dlp error", 'unknown'),
+    ("ERROR: fragment 3 not found, unable to continue", 'unknown'),
+    ("ERROR: [SSL: CERTIFICATE_VERIFY_FAILED] certificate verify failed", 'unknown'),
+])
+def test_classify_yt_dlp_stderr(stderr, failure):
+    assert retries.classify_failure(yt_dlp_error(stderr)) == failure
+
+
+@pytest.mark.parametrize('error, failure', [
+    (ThrottledError('429'), 'throttled'),
+    (CommandTimeoutError(['yt-dlp'], 60, 'stalled'), 'transient'),
+    (urllib.error.HTTPError('https://i.ytimg.com/vi/x/maxresdefault.jpg', 404, 'Not Found', {}, None), 'permanent'),
+    (urllib.error.HTTPError('https://i.ytimg.com/vi/x/maxresdefault.jpg', 429, 'Too Many', {}, None), 'throttled'),
+    (urllib.error.HTTPError('https://i.ytimg.com/vi/x/maxresdefault.jpg', 502, 'Bad Gateway', {}, None), 'transient'),
+    (urllib.error.URLError('timed out'), 'transient'),
+    (ConnectionResetError(), 'transient'),
+    (TimeoutError(), 'transient'),
+    (FileNotFoundError(2, 'No such file', 'yt-dlp'), 'environment'),
+    (PermissionError(13, 'Permission denied'), 'environment'),
+    (ValueError('bad csv'), 'unknown'),
+])
+def test_classify_exceptions(error, failure):
+    assert retries.classify_failure(error) == failure
+
+
+def test_retryable_failures():
+    assert [failure for failure in ('throttled', 'transient', 'permanent', 'environment', 'unknown')
+            if retries.is_retryable(failure)] == ['throttled', 'transient', 'unknown']
+
+
+def test_backoff_delay_is_capped_full_jitter():
+    for attempt in range(1, 10):
+        cap = min(60.0, 2.0 * 2 ** (attempt - 1))
+        delays = [retries.backoff_delay(attempt) for _ in range(200)]
+        assert all(0 <= delay <= cap for delay in delays)
+    assert max(retries.backoff_delay(10) for _ in range(200)) > 30
+
+
+def test_sleep_unless_stopped():
+    assert retries.sleep_unless_stopped(0.05) is True
+    assert retries.sleep_unless_stopped(10, should_stop=lambda: True) is False
@@ -0,0 +1,115 @@
+"""
+Лимит запросов (token bucket) и адаптивная параллельность (AIMD)
+"""
+
+import threading
+import time
+
+import pytest
+
+import throttle
+
+
+def test_token_bucket_allows_burst_then_waits_for_rate():
+    bucket = throttle.TokenBucket(rate=10, capacity=3)
+    assert [bucket._try_acquire(1) for _ in range(3)] == [0, 0, 0]
+    wait = bucket._try_acquire(1)
+    assert 0 < wait <= 0.1
+
+    started = time.monotonic()
+    assert bucket.acquire()
+    assert time.monotonic() - started == pytest.approx(0.1, abs=0.08)
+
+
+def test_token_bucket_refill_is_capped_by_capacity():
+    bucket = throttle.TokenBucket(rate=1000, capacity=2)
+    time.sleep(0.05)
+    assert bucket._try_acquire(2) == 0
+    assert bucket._try_acquire(1) > 0
+
+
+def test_token_bucket_acquire_can_be_stopped():
+    bucket = throttle.TokenBucket(rate=0.01, capacity=1)
+    assert bucket.acquire()
+    assert bucket.acquire(should_stop=lambda: True) is False
+
+
+def test_shared_state_spends_one_budget(tmp_path):
+    state_path = tmp_path / 'bucket.json'
+    first = throttle.TokenBucket(rate=0.01, capacity=2, state_path=state_path)
+    second = throttle.TokenBucket(rate=0.01, capacity=2, state_path=state_path)
+    assert first._try_acquire(1) == 0
+    assert second._try_acquire(1) == 0
+    assert first._try_acquire(1) > 0
+    assert second._try_acquire(1) > 0
+
+
+def test_cooldown_blocks_every_sharer(tmp_path):
+    state_path = tmp_path / 'bucket.json'
+    first = throttle.TokenBucket(rate=100, capacity=5, state_path=state_path)
+    second = throttle.TokenBucket(rate=100, capacity=5, state_path=state_path)
+    first.cooldown(30)
+    assert second._try_acquire(1) == pytest.approx(30, abs=1)
+
+
+def test_configured_rate_applies_while_owner_lives(tmp_path, monkeypatch):
+    state_path = tmp_path / 'bucket.json'
+    owner = throttle.TokenBucket(rate=100, capacity=5, state_path=state_path)
+    other = throttle.TokenBucket(rate=100, capacity=5, state_path=state_path)
+    owner.configure(0.5, 1)
+
+    assert other._try_acquire(1) == 0
+    assert other._try_acquire(1) == pytest.approx(2.0, abs=0.1)
+
+    # Задавший скорость процесс завершился: снова действуют собственные настройки
+    monkeypatch.setattr(throttle, '_is_owner_alive', lambda owner: False)
+    time.sleep(0.05)
+    assert [other._try_acquire(1) for _ in range(3)] == [0, 0, 0]
+
+
+def test_aimd_additive_increase_up_to_maximum():
+    concurrency = throttle.AIMDConcurrency(initial=1, maximum=3)
+    concurrency.on_success()
+    assert concurrency.current_limit == 2
+    # Лимит растёт примерно на 1 за «окно» из limit успешных запросов
+    successes = 0
+    while concurrency.current_limit < 3:
+        concurrency.on_success()
+        successes += 1
+    assert successes == 3
+    for _ in range(20):
+        concurrency.on_success()
+    assert concurrency.limit == 3
+
+
+def test_aimd_multiplicative_decrease_once_per_interval():
+    concurrency = throttle.AIMDConcurrency(initial=8, maximum=8, decrease_interval=0.2)
+    assert concurrency.on_throttle() is True
+    assert concurrency.current_limit == 4
+    # Волна ошибок от уже запущенных запросов не обваливает лимит
+    assert concurrency.on_throttle() is False
+    assert concurrency.current_limit == 4
+
+    time.sleep(0.25)
+    assert concurrency.on_throttle() is True
+    assert concurrency.current_limit == 2
+    time.sleep(0.25)
+    concurrency.on_throttle()
+    time.sleep(0.25)
+    concurrency.on_throttle()
+    assert concurrency.current_limit == concurrency.minimum == 1
+
+
+def test_aimd_acquire_waits_for_free_slot():
+    concurrency = throttle.AIMDConcurrency(initial=1, maximum=1)
+    assert concurrency.acquire()
+    assert concurrency.acquire(should_stop=lambda: True) is False
+
+    acquired = threading.Event()
+    waiter = threading.Thread(target=lambda: concurrency.acquire() and acquired.set())
+    waiter.start()
+    assert not acquired.wait(0.1)
+    concurrency.release()
+    assert acquired.wait(2)
+    waiter.join()
+    assert concurrency.in_flight == 1
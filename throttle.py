@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+"""
+Throttle
+Общий лимит запросов к YouTube (token bucket на все процессы хоста),
+адаптивная параллельность (AIMD) по сигналам троттлинга из stderr yt-dlp
+и общий на хост бюджет полосы для скачиваний (с расписанием по времени суток)
+"""
+
+import itertools
+import os
+import re
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from app_cache import get_cache_dir, load_json, locked_json
+
+# Запросов поиска/извлечения в секунду и размер «пачки» по умолчанию
+DEFAULT_REQUEST_RATE = 1.0
+DEFAULT_REQUEST_BURST = 5
+
+# Пауза для всех процессов после ответа 429 / проверки на бота (секунды)
+THROTTLE_COOLDOWN = 30.0
+
+# Признаки троттлинга в выводе yt-dlp
+THROTTLE_PATTERN = re.compile(
+    r"HTTP Error 429|Too Many Requests|Sign in to confirm you.re not a bot|"
+    r"confirm you.re not a robot|rate.?limit",
+    re.IGNORECASE
+)
+
+# Минимальная скорость одного скачивания при делении бюджета полосы (байт/с)
+MIN_DOWNLOAD_RATE = 64 * 1024
+
+# Через сколько секунд запись о скачивании считается брошенной (процесс упал)
+DOWNLOAD_SLOT_TTL = 1800
+
+# Как часто проверять, не освободилась ли полоса для ожидающего скачивания (секунды)
+SLOT_POLL_INTERVAL = 1.0
+
+# Множители суффиксов скорости (как у --limit-rate yt-dlp)
+RATE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+_request_limiter = None
+_request_limiter_lock = threading.Lock()
+_bandwidth_shaper = None
+_bandwidth_shaper_lock = threading.Lock()
+
+
+class ThrottledError(Exception):
+    """YouTube ограничил запросы (429 или проверка на бота)"""
+
+
+def is_throttled(text):
+    """True если в выводе yt-dlp есть признаки троттлинга"""
+    return bool(text) and bool(THROTTLE_PATTERN.search(text))
+
+
+class TokenBucket:
+    """
+    Token bucket: не больше rate запросов в секунду с пачкой до capacity
+
+    Если указан state_path, состояние хранится в файле под flock
+    и разделяется всеми процессами, использующими этот файл. Скорость,
+    заданная через configure, тоже хранится там и действует на все процессы,
+    пока жив задавший её процесс.
+    """
+
+    def __init__(self, rate, capacity, state_path=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.state_path = state_path
+        self._local_state = {'tokens': capacity, 'updated': time.time(), 'blocked_until': 0.0}
+        self._local_lock = threading.Lock()
+
+    @contextmanager
+    def _state(self):
+        """Состояние корзины под блокировкой"""
+        if self.state_path:
+            default = {'tokens': self.capacity, 'updated': time.time(), 'blocked_until': 0.0}
+            with locked_json(self.state_path, default) as state:
+                yield state
+        else:
+            with self._local_lock:
+                yield self._local_state
+
+    def _limits(self, state):
+        """Скорость и размер пачки: заданные живым процессом в общем состоянии или свои"""
+        owner = state.get('owner')
+        if owner and _is_owner_alive(owner):
+            return state['rate'], state['capacity']
+        return self.rate, self.capacity
+
+    def configure(self, rate, capacity=None):
+        """Меняет скорость (и пачку) для всех процессов, разделяющих состояние"""
+        self.rate = rate
+        if capacity is not None:
+            self.capacity = capacity
+        if self.state_path:
+            with self._state() as state:
+                state.update(rate=self.rate, capacity=self.capacity, owner=_process_owner())
+
+    def _try_acquire(self, tokens):
+        """Пытается взять токены, возвращает 0 или сколько секунд ждать"""
+        with self._state() as state:
+            now = time.time()
+            if state['blocked_until'] > now:
+                return state['blocked_until'] - now
+
+            rate, capacity = self._limits(state)
+            elapsed = max(0.0, now - state['updated'])
+            state['tokens'] = min(capacity, state['tokens'] + elapsed * rate)
+            state['updated'] = now
+
+            if state['tokens'] >= tokens:
+                state['tokens'] -= tokens
+                return 0
+            return (tokens - state['tokens']) / rate
+
+    def acquire(self, tokens=1, should_stop=None):
+        """
+        Ждёт, пока можно сделать запрос
+
+        Returns:
+            True если токены получены, False если ожидание прервано should_stop
+        """
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait <= 0:
+                return True
+            if should_stop and should_stop():
+                return False
+            time.sleep(min(wait, 0.5))
+
+    def cooldown(self, seconds):
+        """Приостанавливает выдачу токенов на seconds (для всех процессов)"""
+        with self._state() as state:
+            state['blocked_until'] = max(state['blocked_until'], time.time() + seconds)
+            state['tokens'] = 0.0
+
+
+def get_request_limiter():
+    """Общий на все процессы хоста лимитер запросов поиска и извлечения"""
+    global _request_limiter
+    with _request_limiter_lock:
+        if _request_limiter is None:
+            _request_limiter = TokenBucket(
+                DEFAULT_REQUEST_RATE,
+                DEFAULT_REQUEST_BURST,
+                state_path=get_cache_dir('state') / 'request_bucket.json'
+            )
+        return _request_limiter
+
+
+def configure_request_limiter(rate, burst=None):
+    """
+    Меняет скорость общего лимитера (например, из --rate)
+
+    Скорость записывается в общее состояние: пока процесс жив, она действует
+    и на остальные процессы хоста, после его завершения - снова по умолчанию.
+    """
+    limiter = get_request_limiter()
+    limiter.configure(rate, burst)
+    return limiter
+
+
+class AIMDConcurrency:
+    """
+    Адаптивный лимит параллельности (additive increase / multiplicative decrease)
+
+    Каждый успешный запрос увеличивает лимит на 1/limit (то есть на 1 за «окно»),
+    троттлинг уменьшает его в decrease_factor раз, но не чаще decrease_interval,
+    чтобы одна волна ошибок от уже запущенных запросов не обвалила лимит до минимума.
+    """
+
+    def __init__(self, initial=1, minimum=1, maximum=4, decrease_factor=0.5, decrease_interval=10.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.decrease_interval = decrease_interval
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    @property
+    def current_limit(self):
+        """Текущий целочисленный лимит"""
+        return max(self.minimum, int(self.limit))
+
+    def acquire(self, should_stop=None):
+        """
+        Ждёт свободный слот
+
+        Returns:
+            True если слот получен, False если ожидание прервано should_stop
+        """
+        with self._cond:
+            while self.in_flight >= self.current_limit:
+                if should_stop and should_stop():
+                    return False
+                self._cond.wait(0.5)
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        """Освобождает слот"""
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self):
+        """Успешный запрос: аддитивное увеличение"""
+        with self._cond:
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def on_throttle(self):
+        """
+        Троттлинг: мультипликативное уменьшение
+
+        Returns:
+            True если лимит был уменьшен
+        """
+        with self._cond:
+            now = time.monotonic()
+            if now - self._last_decrease < self.decrease_interval:
+                return False
+            self._last_decrease = now
+            self.limit = max(self.minimum, self.limit * self.decrease_factor)
+            return True
+
+
+def parse_rate(text):
+    """
+    Скорость из строки вида 500K, 2M, 1.5M (байт/с)
+
+    Raises:
+        ValueError: неверный формат
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMG]?)(?:i?B)?(?:/s)?\s*', text, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Неверная скорость: {text}")
+    return int(float(match.group(1)) * RATE_UNITS[match.group(2).upper()])
+
+
+def format_rate(rate):
+    """Скорость для лога: 1.5 MiB/s"""
+    if rate >= 1024 ** 2:
+        return f"{rate / 1024 ** 2:.1f} MiB/s"
+    return f"{rate / 1024:.0f} KiB/s"
+
+
+def parse_schedule(text):
+    """
+    Расписание бюджета полосы
+
+    Формат: "2M" (всегда) или окна времени суток через запятую:
+    "08:00-19:00=2M,19:00-08:00=20M" (окно может переходить через полночь).
+    Вне окон скорость не ограничена.
+
+    Returns:
+        Список (начало, конец, байт/с), начало и конец в минутах от полуночи
+
+    Raises:
+        ValueError: неверный формат
+    """
+    if '=' not in text:
+        return [(0, 24 * 60, parse_rate(text))]
+
+    def minutes(value):
+        hours, _, mins = value.strip().partition(':')
+        total = int(hours) * 60 + int(mins or 0)
+        if not 0 <= total <= 24 * 60:
+            raise ValueError(f"Неверное время: {value}")
+        return total
+
+    schedule = []
+    for window in text.split(','):
+        span, _, rate = window.partition('=')
+        start, sep, end = span.partition('-')
+        if not sep:
+            raise ValueError(f"Неверное окно расписания: {window}")
+        schedule.append((minutes(start), minutes(end), parse_rate(rate)))
+    return schedule
+
+
+def scheduled_budget(schedule, now=None):
+    """
+    Бюджет полосы по расписанию на момент now
+
+    Returns:
+        байт/с или None если ограничения нет
+    """
+    local = time.localtime(now)
+    minute = local.tm_hour * 60 + local.tm_min
+    for start, end, rate in schedule:
+        if start <= end:
+            if start <= minute < end:
+                return rate
+        elif minute >= start or minute < end:
+            return rate
+    return None
+
+
+def _process_owner():
+    """Владелец записей в общем состоянии: хост:pid"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _is_owner_alive(owner):
+    """Жив ли процесс-владелец записи (хост:pid); записи других хостов считаются живыми"""
+    host, _, pid = owner.rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class BandwidthShaper:
+    """
+    Общий на все процессы хоста бюджет полосы для скачиваний
+
+    Каждое скачивание на время работы yt-dlp занимает запись в файле состояния
+    и получает долю бюджета: поровну между потоками скачивания активных
+    процессов (declare_workers), но не меньше MIN_DOWNLOAD_RATE. Сумма долей
+    не превышает бюджет: если свободной полосы меньше доли, скачивание ждёт,
+    пока закончатся другие. yt-dlp не умеет менять --limit-rate на ходу,
+    поэтому освободившаяся полоса достаётся следующим трекам (ожидающим или
+    новым), а доли пересчитываются при старте каждого трека.
+
+    Расписание хранится в файле состояния вместе с владельцем: оно действует
+    на все процессы хоста, пока жив задавший его процесс, а с persist -
+    пока его не снимут через 'off'.
+    """
+
+    def __init__(self, state_path=None):
+        self.state_path = state_path or get_cache_dir('state') / 'bandwidth.json'
+        self._ids = itertools.count(1)
+        self._owner = _process_owner()
+        self._workers = 1
+
+    def set_schedule(self, schedule_text, persist=False):
+        """
+        Задаёт расписание для всех процессов хоста (None или 'off' - без ограничения)
+
+        Args:
+            schedule_text: расписание (см. parse_schedule)
+            persist: расписание остаётся и после завершения процесса
+
+        Raises:
+            ValueError: неверный формат расписания
+        """
+        schedule = None if schedule_text in (None, 'off') else parse_schedule(schedule_text)
+        with locked_json(self.state_path, {}) as state:
+            if schedule is None:
+                for key in ('schedule', 'schedule_text', 'schedule_owner'):
+                    state.pop(key, None)
+            else:
+                state['schedule'] = schedule
+                state['schedule_text'] = schedule_text
+                state['schedule_owner'] = None if persist else self._owner
+
+    def declare_workers(self, workers):
+        """
+        Сколько скачиваний процесс может вести одновременно
+
+        Первое скачивание процесса сразу получает долю с учётом остальных
+        потоков, а не весь бюджет.
+        """
+        self._workers = max(self._workers, workers)
+
+    @staticmethod
+    def _state_budget(state, now=None):
+        """Бюджет по расписанию из состояния (None, если расписания нет или его процесс завершился)"""
+        schedule = state.get('schedule')
+        owner = state.get('schedule_owner')
+        if not schedule or (owner and not _is_owner_alive(owner)):
+            return None
+        return scheduled_budget(schedule, now)
+
+    def budget(self, now=None):
+        """Текущий бюджет полосы (байт/с) или None"""
+        return self._state_budget(load_json(self.state_path, {}), now)
+
+    def _try_take_slot(self, slot_id):
+        """
+        Пытается занять долю бюджета
+
+        Returns:
+            (True, скорость или None) или (False, None), если свободной полосы пока мало
+        """
+        with locked_json(self.state_path, {}) as state:
+            budget = self._state_budget(state)
+            slots = state.setdefault('slots', {})
+
+            # Записи упавших процессов не должны занимать бюджет
+            now = time.time()
+            for stale_id in [key for key, slot in slots.items()
+                             if now - slot['started_at'] > DOWNLOAD_SLOT_TTL or not _is_owner_alive(slot['owner'])]:
+                del slots[stale_id]
+
+            rate = None
+            if budget:
+                # Скачивание без ограничения (начатое вне окна расписания) занимает весь бюджет
+                assigned = sum(slot['rate'] or budget for slot in slots.values())
+                # Делим на все потоки процессов, которые сейчас качают (включая этот)
+                workers = {slot['owner']: slot.get('workers', 1) for slot in slots.values()}
+                workers[self._owner] = self._workers
+                fair_share = budget // max(len(slots) + 1, sum(workers.values()))
+                rate = min(budget, max(MIN_DOWNLOAD_RATE, fair_share))
+                if budget - assigned < rate:
+                    return False, None
+            slots[slot_id] = {'owner': self._owner, 'workers': self._workers, 'rate': rate, 'started_at': now}
+            return True, rate
+
+    @contextmanager
+    def download_slot(self, cancel_token=None):
+        """
+        Занимает долю бюджета на время одного скачивания (ждёт, если полосы не хватает)
+
+        Yields:
+            Скорость для --limit-rate (байт/с) или None, если ограничения нет
+
+        Raises:
+            OperationCancelled: ожидание прервано cancel_token
+        """
+        slot_id = f"{self._owner}:{next(self._ids)}"
+        while True:
+            taken, rate = self._try_take_slot(slot_id)
+            if taken:
+                break
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+            time.sleep(SLOT_POLL_INTERVAL)
+
+        try:
+            yield rate
+        finally:
+            with locked_json(self.state_path, {}) as state:
+                state.get('slots', {}).pop(slot_id, None)
+
+
+def get_bandwidth_shaper():
+    """Общий бюджет полосы скачиваний на хосте"""
+    global _bandwidth_shaper
+    with _bandwidth_shaper_lock:
+        if _bandwidth_shaper is None:
+            _bandwidth_shaper = BandwidthShaper()
+        return _bandwidth_shaper
+
+
+def configure_bandwidth(schedule_text, persist=False):
+    """
+    Задаёт расписание бюджета полосы (например, из --bandwidth)
+
+    Без persist расписание действует, пока жив этот процесс
+    (--bandwidth-persist - и после его завершения).
+    """
+    shaper = get_bandwidth_shaper()
+    shaper.set_schedule(schedule_text, persist)
+    return shaper
@@ -24,6 +24,13 @@ TRANSLATIONS = {
         'output_folder_label': 'Output folder:',
         'btn_browse': 'Browse',
         'normalize_checkbox': '♪ Volume normalization (equalize audio levels)',
+        'format_label': 'Format:',
+        'format_mp3': 'MP3 (re-encode)',
+        'format_opus': 'Opus (no re-encode)',
+        'format_m4a': 'M4A / AAC (no re-encode)',
+        'format_native': 'Original stream (Opus or M4A)',
+        'format_mp3_opus': 'MP3 + Opus (one download, two folders)',
+        'log_daemon_job': 'Job {id} sent to the daemon',
 
         # Progress
         'progress_group_title': '▶ Progress',
@@ -56,6 +63,8 @@ TRANSLATIONS = {
         'log_tracks_loaded': 'Loaded tracks: {count}...',
         'log_recommended_found': 'Found "Recommended" section, stopping',
         'log_all_tracks_loaded': 'All tracks loaded: {count}',
+        'log_snapshot_confirmed': 'Known tracks in place, new: {new} (other {known} from the previous scan)',
+        'log_snapshot_changed': 'Playlist changed beyond the top, scanning it fully',
         'log_parsing_tracks': 'Parsing {count} tracks...',
         'log_processed_tracks': 'Processed {count} tracks...',
         'log_tracks_found': 'Tracks found: {count}',
@@ -70,6 +79,24 @@ TRANSLATIONS = {
         'log_stopping_parse': 'Stopping parsing...',
         'log_stopping_download': 'Stopping download...',
 
+        # Track table
+        'col_number': '#',
+        'col_track': 'Track',
+        'col_stage': 'Stage',
+        'col_percent': '%',
+        'col_speed': 'Speed',
+        'col_eta': 'ETA',
+        'stage_waiting': 'Waiting',
+        'stage_searching': 'Searching',
+        'stage_downloading': 'Downloading',
+        'stage_converting': 'Converting',
+        'stage_normalizing': 'Normalizing',
+        'stage_retrying': 'Retrying',
+        'stage_done': 'Done',
+        'stage_skipped': 'Already there',
+        'stage_failed': 'Failed',
+        'stage_cancelled': 'Cancelled',
+
         # Language selector
         'language': 'Language:',
     },
@@ -93,6 +120,13 @@ TRANSLATIONS = {
         'output_folder_label': 'Carpeta de salida:',
         'btn_browse': 'Examinar',
         'normalize_checkbox': 'Normalización de volumen (igualar niveles de audio)',
+        'format_label': 'Formato:',
+        'format_mp3': 'MP3 (recodificar)',
+        'format_opus': 'Opus (sin recodificar)',
+        'format_m4a': 'M4A / AAC (sin recodificar)',
+        'format_native': 'Flujo original (Opus o M4A)',
+        'format_mp3_opus': 'MP3 + Opus (una descarga, dos carpetas)',
+        'log_daemon_job': 'Tarea {id} enviada al daemon',
 
         # Progress
         'progress_group_title': 'Progreso',
@@ -125,6 +159,8 @@ TRANSLATIONS = {
         'log_tracks_loaded': 'Pistas cargadas: {count}...',
         'log_recommended_found': 'Encontrada sección "Recomendadas", deteniendo',
         'log_all_tracks_loaded': 'Todas las pistas cargadas: {count}',
+        'log_snapshot_confirmed': 'Pistas conocidas en su lugar, nuevas: {new} (otras {known} del análisis anterior)',
+        'log_snapshot_changed': 'La lista cambió más allá del inicio, análisis completo',
         'log_parsing_tracks': 'Analizando {count} pistas...',
         'log_processed_tracks': 'Procesadas {count} pistas...',
         'log_tracks_found': 'Pistas encontradas: {count}',
@@ -139,6 +175,24 @@ TRANSLATIONS = {
         'log_stopping_parse': 'Deteniendo análisis...',
         'log_stopping_download': 'Deteniendo descarga...',
 
+        # Track table
+        'col_number': '#',
+        'col_track': 'Pista',
+        'col_stage': 'Etapa',
+        'col_percent': '%',
+        'col_speed': 'Velocidad',
+        'col_eta': 'Restante',
+        'stage_waiting': 'En espera',
+        'stage_searching': 'Buscando',
+        'stage_downloading': 'Descargando',
+        'stage_converting': 'Convirtiendo',
+        'stage_normalizing': 'Normalizando',
+        'stage_retrying': 'Reintentando',
+        'stage_done': 'Listo',
+        'stage_skipped': 'Ya descargada',
+        'stage_failed': 'Error',
+        'stage_cancelled': 'Cancelada',
+
         # Language selector
         'language': 'Idioma:',
     },
@@ -162,6 +216,13 @@ TRANSLATIONS = {
         'output_folder_label': 'Dossier de sortie:',
         'btn_browse': 'Parcourir',
         'normalize_checkbox': 'Normalisation du volume (égaliser les niveaux audio)',
+        'format_label': 'Format :',
+        'format_mp3': 'MP3 (réencodage)',
+        'format_opus': 'Opus (sans réencodage)',
+        'format_m4a': 'M4A / AAC (sans réencodage)',
+        'format_native': 'Flux d\'origine (Opus ou M4A)',
+        'format_mp3_opus': 'MP3 + Opus (un téléchargement, deux dossiers)',
+        'log_daemon_job': 'Tâche {id} envoyée au démon',
 
         # Progress
         'progress_group_title': 'Progression',
@@ -194,6 +255,8 @@ TRANSLATIONS = {
         'log_tracks_loaded': 'Pistes chargées: {count}...',
         'log_recommended_found': 'Section "Recommandées" trouvée, arrêt',
         'log_all_tracks_loaded': 'Toutes les pistes chargées: {count}',
+        'log_snapshot_confirmed': 'Pistes connues en place, nouvelles: {new} (autres {known} de l\'analyse précédente)',
+        'log_snapshot_changed': 'La playlist a changé au-delà du début, analyse complète',
         'log_parsing_tracks': 'Analyse de {count} pistes...',
         'log_processed_tracks': '{count} pistes traitées...',
         'log_tracks_found': 'Pistes trouvées: {count}',
@@ -208,6 +271,24 @@ TRANSLATIONS = {
         'log_stopping_parse': 'Arrêt de l\'analyse...',
         'log_stopping_download': 'Arrêt du téléchargement...',
 
+        # Track table
+        'col_number': '#',
+        'col_track': 'Piste',
+        'col_stage': 'Étape',
+        'col_percent': '%',
+        'col_speed': 'Vitesse',
+        'col_eta': 'Restant',
+        'stage_waiting': 'En attente',
+        'stage_searching': 'Recherche',
+        'stage_downloading': 'Téléchargement',
+        'stage_converting': 'Conversion',
+        'stage_normalizing': 'Normalisation',
+        'stage_retrying': 'Nouvel essai',
+        'stage_done': 'Terminé',
+        'stage_skipped': 'Déjà téléchargée',
+        'stage_failed': 'Erreur',
+        'stage_cancelled': 'Annulée',
+
         # Language selector
         'language': 'Langue:',
     }